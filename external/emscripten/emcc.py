@@ -2170,6 +2170,10 @@ There is NO warranty; not even for MERCHANTABILITY or FITNESS FOR A PARTICULAR P
         else:
           return in_temp(unsuffixed(uniquename(input_file)) + options.default_object_extension)
 
+      # Compile commands are collected first and then run together, so that the
+      # source files of a multi-source invocation can be compiled in parallel.
+      compile_jobs = []
+
       def compile_source_file(i, input_file):
         logger.debug('compiling source file: ' + input_file)
         output_file = get_object_filename(input_file)
@@ -2192,10 +2196,7 @@ There is NO warranty; not even for MERCHANTABILITY or FITNESS FOR A PARTICULAR P
               cmd += ['-mllvm', a]
         else:
           cmd.append('-emit-llvm')
-        shared.print_compiler_stage(cmd)
-        shared.check_call(cmd)
-        if output_file != '-':
-          assert(os.path.exists(output_file))
+        compile_jobs.append((input_file, output_file, cmd))
 
       # First, generate LLVM bitcode. For each input file, we get base.o with bitcode
       for i, input_file in input_files:
@@ -2229,6 +2230,11 @@ There is NO warranty; not even for MERCHANTABILITY or FITNESS FOR A PARTICULAR P
         else:
           exit_with_error(input_file + ': unknown input file suffix')
 
+      shared.Building.parallel_compile([(input_file, cmd) for input_file, _, cmd in compile_jobs])
+      for _, output_file, _ in compile_jobs:
+        if output_file != '-':
+          assert(os.path.exists(output_file))
+
     # exit block 'compile inputs'
     log_time('compile inputs')
 
@@ -16,6 +16,8 @@ from __future__ import print_function
 import argparse
 import atexit
 import cgi
+import gzip
+import hashlib
 import json
 import os
 import platform
@@ -30,6 +32,9 @@ import sys
 import tempfile
 import threading
 import time
+from array import array
+from collections import OrderedDict
+from email.utils import formatdate
 from operator import itemgetter
 
 if sys.version_info.major == 2:
@@ -43,6 +48,11 @@ else:
   from http.server import HTTPServer, SimpleHTTPRequestHandler
   from urllib.parse import unquote, urlsplit
 
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
 # Populated from cmdline params
 emrun_options = None
 
@@ -403,12 +413,261 @@ def kill_browser_process():
     processname_killed_atexit = ''
 
 
+# Files that the --fast_serve mode sends compressed to browsers that accept it.
+compressible_suffixes = ('.wasm', '.js', '.data')
+
+# Suffixes of precompressed copies of files, which the --fast_serve mode sends in place of the originals.
+precompressed_suffixes = {'br': '.br', 'gzip': '.gz'}
+
+# How long the --fast_serve mode keeps an idle keep-alive connection open, in seconds.
+keepalive_timeout = 60
+
+# Directory that holds the files compressed by --compress, created on first use.
+compressed_files_dir = None
+
+
+def strip_gz_suffix(path):
+  """Returns the given name of a gzip-compressed file without its gz suffix, e.g. x.jsgz -> x.js."""
+  path = path[:-2]
+  if path.endswith('.'):
+    path = path[:-1]
+  return path
+
+
+def accepted_encodings(header):
+  """Returns the set of content codings that the given Accept-Encoding header value allows."""
+  encodings = set()
+  for item in header.split(','):
+    params = item.split(';')
+    coding = params[0].strip().lower()
+    q = 1.0
+    for param in params[1:]:
+      name, _, value = param.partition('=')
+      if name.strip() == 'q':
+        try:
+          q = float(value)
+        except ValueError:
+          q = 0
+    if coding and q > 0:
+      encodings.add(coding)
+  return encodings
+
+
+def parse_byte_range(header, size):
+  """Parses a Range header value for a file of the given size. Returns the inclusive (start, end) byte
+  range, None if the header should be ignored and the whole file served, or False if the range is not
+  satisfiable. Only single ranges are supported, the whole file is served for multiple ranges."""
+  if not header.startswith('bytes=') or ',' in header:
+    return None
+  first, sep, last = header[len('bytes='):].strip().partition('-')
+  if not sep:
+    return None
+  try:
+    if first:
+      start = int(first)
+      end = int(last) if last else size - 1
+    else:
+      # bytes=-n asks for the last n bytes of the file.
+      length = int(last)
+      if length <= 0:
+        return False
+      start = max(size - length, 0)
+      end = size - 1
+  except ValueError:
+    return None
+  if start >= size:
+    return False
+  if start > end:
+    return None
+  return (start, min(end, size - 1))
+
+
+def etag_matches(header, etag):
+  """Returns True if the given If-None-Match header value matches the given ETag."""
+  if not header:
+    return False
+  if header.strip() == '*':
+    return True
+  for tag in header.split(','):
+    tag = tag.strip()
+    if tag.startswith('W/'):
+      tag = tag[2:]
+    if tag == etag:
+      return True
+  return False
+
+
+def compress_file(src, dst, encoding):
+  """Compresses the file src to dst with the given content coding, 'br' or 'gzip'."""
+  with open(src, 'rb') as f_in:
+    with open(dst, 'wb') as f_out:
+      if encoding == 'br':
+        # The highest qualities are far too slow for files of hundreds of megabytes.
+        compressor = brotli.Compressor(quality=5)
+        while True:
+          data = f_in.read(1024 * 1024)
+          if not data:
+            break
+          f_out.write(compressor.process(data))
+        f_out.write(compressor.finish())
+      else:
+        with gzip.GzipFile(filename='', mode='wb', compresslevel=6, fileobj=f_out, mtime=0) as gz:
+          shutil.copyfileobj(f_in, gz, 1024 * 1024)
+
+
+def delete_compressed_files_dir():
+  if compressed_files_dir:
+    shutil.rmtree(compressed_files_dir, ignore_errors=True)
+
+
+class StaticFile(object):
+  """Metadata of a file served in the --fast_serve mode, kept between requests."""
+  def __init__(self, path, st, ctype, gz_ctype):
+    self.path = path
+    self.stat_key = (st.st_mtime, st.st_size, st.st_ino)
+    self.size = st.st_size
+    self.tag = '%x-%x' % (int(st.st_mtime * 1000000), st.st_size)
+    self.etag = '"' + self.tag + '"'
+    self.last_modified = formatdate(st.st_mtime, usegmt=True)
+    self.ctype = ctype
+    self.gz_ctype = gz_ctype
+    self.compressible = path.lower().endswith(compressible_suffixes)
+    # Maps a content coding to the (path, size, etag) of the compressed file, or None if there is none.
+    self.variants = {}
+    self.lock = threading.Lock()
+
+  def variant(self, encoding):
+    """Returns the (path, size, etag) of this file compressed with the given content coding. Uses a
+    precompressed copy next to the file if one is up to date, otherwise compresses the file once if
+    --compress was passed. Returns None if no compressed file is available."""
+    with self.lock:
+      if encoding not in self.variants:
+        self.variants[encoding] = self.find_variant(encoding)
+      return self.variants[encoding]
+
+  def find_variant(self, encoding):
+    global compressed_files_dir
+    etag = '"%s-%s"' % (self.tag, encoding)
+    precompressed = self.path + precompressed_suffixes[encoding]
+    try:
+      st = os.stat(precompressed)
+      if st.st_mtime >= self.stat_key[0]:
+        return (precompressed, st.st_size, etag)
+    except OSError:
+      pass
+
+    if not emrun_options.compress or (encoding == 'br' and not brotli):
+      return None
+    with http_mutex:
+      if compressed_files_dir is None:
+        compressed_files_dir = tempfile.mkdtemp(prefix='emrun_compressed_')
+        atexit.register(delete_compressed_files_dir)
+    name = hashlib.sha1((self.path + self.tag + encoding).encode('utf-8')).hexdigest()
+    compressed = os.path.join(compressed_files_dir, name)
+    start_time = tick()
+    try:
+      compress_file(self.path, compressed, encoding)
+    except (IOError, OSError) as e:
+      loge('Failed to compress ' + self.path + ': ' + str(e))
+      return None
+    size = os.path.getsize(compressed)
+    logv('Compressed %s with %s in %.2f seconds: %d -> %d bytes.' % (self.path, encoding, tick() - start_time, self.size, size))
+    if size >= self.size:
+      # Already compressed data, e.g. a file package of images.
+      os.remove(compressed)
+      return None
+    return (compressed, size, etag)
+
+  def delete_compressed_files(self):
+    for variant in self.variants.values():
+      if variant and compressed_files_dir and variant[0].startswith(compressed_files_dir):
+        try:
+          os.remove(variant[0])
+        except OSError:
+          pass
+
+
+class StaticFileCache(object):
+  """LRU cache of the metadata of the files most recently served in the --fast_serve mode. Each request
+  still stats its file, so that files rebuilt while emrun is running are picked up."""
+  max_entries = 512
+
+  def __init__(self):
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, path, st):
+    with self.lock:
+      entry = self.entries.pop(path, None)
+      if entry is None:
+        return None
+      if entry.stat_key != (st.st_mtime, st.st_size, st.st_ino):
+        entry.delete_compressed_files()
+        return None
+      # Reinsert to mark as the most recently used.
+      self.entries[path] = entry
+      return entry
+
+  def put(self, entry):
+    with self.lock:
+      old = self.entries.pop(entry.path, None)
+      if old is not None and old is not entry:
+        old.delete_compressed_files()
+      self.entries[entry.path] = entry
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)[1].delete_compressed_files()
+      return entry
+
+
+static_files = StaticFileCache()
+
+
+class ServerStats(object):
+  """Counts the GET requests served in the --fast_serve mode, with their latencies."""
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.requests = 0
+    self.not_modified = 0
+    self.bytes_sent = 0
+    self.latencies = array('d')
+    self.first_request_time = None
+    self.last_response_time = None
+
+  def record(self, code, bytes_sent, start_time, latency):
+    with self.lock:
+      self.requests += 1
+      if code == 304:
+        self.not_modified += 1
+      self.bytes_sent += bytes_sent
+      self.latencies.append(latency)
+      if self.first_request_time is None:
+        self.first_request_time = start_time
+      self.last_response_time = start_time + latency
+
+  def summary(self):
+    with self.lock:
+      if not self.requests:
+        return 'Web server served no files.'
+      latencies = sorted(self.latencies)
+      elapsed = max(self.last_response_time - self.first_request_time, 1e-6)
+
+      def percentile(fraction):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000
+
+      return ('Web server served %d requests (%d not modified), %.1f MB in %.2f seconds (%.1f MB/s). '
+              'Latency: median %.2f ms, 99th percentile %.2f ms, max %.2f ms.' %
+              (self.requests, self.not_modified, self.bytes_sent / (1024.0 * 1024.0), elapsed,
+               self.bytes_sent / (1024.0 * 1024.0) / elapsed, percentile(0.5), percentile(0.99), latencies[-1] * 1000))
+
+
 # Our custom HTTP web server that will server the target page to run via .html.
 # This is used so that we can load the page via a http:// URL instead of a file:// URL, since those wouldn't work too well unless user allowed XHR without CORS rules.
 # Also, the target page will route its stdout and stderr back to here via HTTP requests.
 class HTTPWebServer(socketserver.ThreadingMixIn, HTTPServer):
   """Log messaging arriving via HTTP can come in out of sequence. Implement a
   sequencing mechanism to enforce ordered transmission."""
+  # Request counters of the --fast_serve mode.
+  stats = None
   expected_http_seq_num = -1
   # Stores messages that have arrived out of order, pending for a send as soon as the missing message arrives.
   # Kept in sorted order, first element is the oldest message received.
@@ -552,6 +811,8 @@ class HTTPHandler(SimpleHTTPRequestHandler):
       if not self.path.endswith('/'):
         self.send_response(301)
         self.send_header("Location", self.path + "/")
+        if emrun_options.fast_serve:
+          self.send_header("Content-Length", "0")
         self.end_headers()
         return None
       for index in "index.html", "index.htm":
@@ -563,6 +824,9 @@ class HTTPHandler(SimpleHTTPRequestHandler):
         # Manually implement directory listing support.
         return self.list_directory(path)
 
+    if emrun_options.fast_serve:
+      return self.send_static_file_head(path)
+
     try:
       f = open(path, 'rb')
     except IOError:
@@ -579,39 +843,181 @@ class HTTPHandler(SimpleHTTPRequestHandler):
     if 'Accept-Encoding' in self.headers and 'gzip' in self.headers['Accept-Encoding'] and path.lower().endswith('gz'):
       self.send_header('Content-Encoding', 'gzip')
       logv('Serving ' + path + ' as gzip-compressed.')
-      guess_file_type = guess_file_type[:-2]
-      if guess_file_type.endswith('.'):
-        guess_file_type = guess_file_type[:-1]
+      guess_file_type = strip_gz_suffix(guess_file_type)
 
-    ctype = self.guess_type(guess_file_type)
-    if guess_file_type.lower().endswith('.wasm'):
-      ctype = 'application/wasm'
-    if guess_file_type.lower().endswith('.js'):
-      ctype = 'application/javascript'
-    self.send_header('Content-type', ctype)
+    self.send_header('Content-type', self.content_type(guess_file_type))
     fs = os.fstat(f.fileno())
     self.send_header("Content-Length", str(fs[6]))
     self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
     self.send_header('Cache-Control', 'no-cache, must-revalidate')
     self.send_header('Connection', 'close')
     self.send_header('Expires', '-1')
+    self.send_cross_origin_headers()
+    self.end_headers()
+    page_last_served_time = tick()
+    return f
+
+  # Serves a file in the --fast_serve mode: file metadata is cached between requests, the browser can
+  # revalidate its cached copy with If-None-Match and fetch parts of the file with Range, and .wasm/.js/.data
+  # files are served compressed when the browser accepts that.
+  def send_static_file_head(self, path):
+    global page_last_served_time
+    try:
+      st = os.stat(path)
+    except OSError:
+      self.send_error(404, "File not found: " + path)
+      return None
+    entry = static_files.get(path, st)
+    if entry is None:
+      gz_ctype = self.content_type(strip_gz_suffix(path)) if path.lower().endswith('gz') else None
+      entry = static_files.put(StaticFile(path, st, self.content_type(path), gz_ctype))
+
+    accepted = accepted_encodings(self.headers.get('Accept-Encoding', ''))
+    byte_range = self.headers.get('Range')
+    ctype = entry.ctype
+    encoding = None
+    served = (entry.path, entry.size, entry.etag)
+    if entry.gz_ctype and 'gzip' in accepted:
+      # Files with a *gz suffix are already compressed, see send_head() above.
+      ctype = entry.gz_ctype
+      encoding = 'gzip'
+    elif entry.compressible and not byte_range:
+      for coding in ('br', 'gzip'):
+        if coding in accepted:
+          variant = entry.variant(coding)
+          if variant:
+            encoding = coding
+            served = variant
+            break
+    served_path, size, etag = served
+
+    if etag_matches(self.headers.get('If-None-Match'), etag):
+      self.send_response(304)
+      self.send_header('ETag', etag)
+      self.send_header('Cache-Control', 'no-cache')
+      if entry.compressible or entry.gz_ctype:
+        self.send_header('Vary', 'Accept-Encoding')
+      self.send_cross_origin_headers()
+      self.end_headers()
+      page_last_served_time = tick()
+      return None
+
+    start, end = 0, size - 1
+    status = 200
+    # A Range request with a stale If-Range validator gets the whole file.
+    if byte_range and self.headers.get('If-Range', etag) == etag:
+      requested = parse_byte_range(byte_range, size)
+      if requested is False:
+        self.send_response(416)
+        self.send_header('Content-Range', 'bytes */%d' % size)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return None
+      if requested:
+        start, end = requested
+        status = 206
+
+    try:
+      f = open(served_path, 'rb')
+    except IOError:
+      self.send_error(404, "File not found: " + path)
+      return None
+
+    self.send_response(status)
+    if encoding:
+      self.send_header('Content-Encoding', encoding)
+    self.send_header('Content-type', ctype)
+    self.send_header('Content-Length', str(end - start + 1))
+    if status == 206:
+      self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+    self.send_header('Accept-Ranges', 'bytes')
+    self.send_header('ETag', etag)
+    self.send_header('Last-Modified', entry.last_modified)
+    self.send_header('Cache-Control', 'no-cache')
+    if entry.compressible or entry.gz_ctype:
+      self.send_header('Vary', 'Accept-Encoding')
+    self.send_cross_origin_headers()
+    self.end_headers()
+    self.body_range = (start, end - start + 1)
+    self.served_encoding = encoding
+    page_last_served_time = tick()
+    return f
+
+  def content_type(self, path):
+    ctype = self.guess_type(path)
+    if path.lower().endswith('.wasm'):
+      ctype = 'application/wasm'
+    if path.lower().endswith('.js'):
+      ctype = 'application/javascript'
+    return ctype
+
+  def send_cross_origin_headers(self):
     self.send_header('Access-Control-Allow-Origin', '*')
     self.send_header('Cross-Origin-Opener-Policy', 'same-origin')
     self.send_header('Cross-Origin-Embedder-Policy', 'require-corp')
     self.send_header('Cross-Origin-Resource-Policy', 'cross-origin')
-    self.end_headers()
-    page_last_served_time = tick()
-    return f
+
+  def setup(self):
+    if emrun_options.fast_serve:
+      # Keep connections alive between requests, but drop the ones that stay idle.
+      self.protocol_version = 'HTTP/1.1'
+      self.timeout = keepalive_timeout
+    SimpleHTTPRequestHandler.setup(self)
+
+  def send_response(self, code, message=None):
+    self.status_code = code
+    SimpleHTTPRequestHandler.send_response(self, code, message)
+
+  def do_GET(self):
+    if not emrun_options.fast_serve:
+      return SimpleHTTPRequestHandler.do_GET(self)
+    start_time = tick()
+    self.status_code = None
+    self.body_range = None
+    self.served_encoding = None
+    bytes_sent = 0
+    f = self.send_head()
+    if f:
+      try:
+        bytes_sent = self.send_body(f)
+      finally:
+        f.close()
+    latency = tick() - start_time
+    self.server.stats.record(self.status_code, bytes_sent, start_time, latency)
+    logv('GET "%s": %s, %d bytes%s in %.2f ms' % (self.path, self.status_code, bytes_sent,
+                                                  ' (' + self.served_encoding + ')' if self.served_encoding else '',
+                                                  latency * 1000))
+
+  # Writes the response body of a GET request in the --fast_serve mode and returns its size.
+  def send_body(self, f):
+    if self.body_range is None:
+      # Directory listings are generated in memory.
+      self.copyfile(f, self.wfile)
+      return f.tell()
+    offset, count = self.body_range
+    if hasattr(self.connection, 'sendfile'):
+      # Python 3.5+ hands the transfer over to os.sendfile() where the OS supports it, so the file data
+      # is not copied through userspace.
+      return self.connection.sendfile(f, offset, count)
+    f.seek(offset)
+    sent = 0
+    while sent < count:
+      data = f.read(min(count - sent, 1024 * 1024))
+      if not data:
+        break
+      self.wfile.write(data)
+      sent += len(data)
+    return sent
 
   def log_request(self, code):
-    # Filter out 200 OK messages to remove noise.
-    if code != 200:
+    # Filter out 200 OK messages to remove noise. Partial Content and Not Modified are routine in the --fast_serve mode.
+    if code != 200 and not (emrun_options.fast_serve and code in (206, 304)):
       SimpleHTTPRequestHandler.log_request(self, code)
 
   def log_message(self, format, *args):
     msg = '%s - - [%s] %s\n' % (self.address_string(), self.log_date_time_string(), format % args)
-    # Filter out 404 messages on favicon.ico not being found to remove noise.
-    if 'favicon.ico' not in msg:
+    # Filter out 404 messages on favicon.ico not being found, and idle keep-alive connections timing out, to remove noise.
+    if 'favicon.ico' not in msg and 'Request timed out' not in msg:
       sys.stderr.write(msg)
 
   def do_POST(self):
@@ -1479,6 +1885,12 @@ def run():
   parser.add_argument('--private_browsing', dest='private_browsing', action='store_true', default=False,
                       help='If specified, opens browser in private/incognito mode.')
 
+  parser.add_argument('--fast_serve', dest='fast_serve', action='store_true', default=False,
+                      help='If specified, the web server keeps HTTP/1.1 connections alive, transfers files with sendfile(), lets the browser revalidate its cached files with ETags and fetch parts of files with Range requests, and serves precompressed .br/.gz copies of .wasm, .js and .data files that are next to them. Request counts, throughput and latencies are printed when the server quits.')
+
+  parser.add_argument('--compress', dest='compress', action='store_true', default=False,
+                      help='With --fast_serve, compresses .wasm, .js and .data files with brotli (if the Python brotli module is installed) or gzip, for browsers that accept that, the first time they are requested. The compressed files are kept until emrun quits.')
+
   parser.add_argument('serve', nargs='*')
 
   opts_with_param = ['--browser', '--browser_args', '--timeout_returncode',
@@ -1518,6 +1930,10 @@ def run():
     elif MACOS:
       options.browser = 'open'
 
+  if options.compress and not options.fast_serve:
+    loge('--compress requires --fast_serve.')
+    return 1
+
   if options.list_browsers:
     if options.android:
       list_android_browsers()
@@ -1702,6 +2118,10 @@ def run():
   if not options.no_server:
     logv('Starting web server: http://%s:%i/' % (options.hostname, options.port))
     httpd = HTTPWebServer((options.hostname, options.port), HTTPHandler)
+    if options.fast_serve:
+      httpd.stats = ServerStats()
+      # Don't wait for the threads of idle keep-alive connections when quitting.
+      httpd.daemon_threads = True
 
   if not options.no_browser:
     logi("Starting browser: %s" % ' '.join(browser))
@@ -1735,6 +2155,8 @@ def run():
     httpd.server_close()
 
     logv('Closed web server.')
+    if httpd.stats:
+      logi(httpd.stats.summary())
 
   if not options.no_browser:
     if options.kill_on_exit:
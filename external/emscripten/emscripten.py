@@ -12,10 +12,12 @@ headers, for the libc implementation in JS).
 from __future__ import print_function
 
 import difflib
+import hashlib
 import os
 import json
 import subprocess
 import re
+import sys
 import time
 import logging
 import pprint
@@ -38,6 +40,14 @@ if STDERR_FILE:
   logger.info('logging stderr in js compiler phase into %s' % STDERR_FILE)
   STDERR_FILE = open(STDERR_FILE, 'w')
 
+# The output of the JS compiler (src/compiler.js) is cached on disk, keyed on
+# all of its inputs (see get_glue_cache_key). Setting EMCC_GLUE_CACHE=0
+# bypasses that cache, and EMCC_GLUE_CACHE=verify runs the JS compiler anyway
+# and checks that a cached result matches what it produced.
+GLUE_CACHE = os.environ.get('EMCC_GLUE_CACHE', '1')
+# The number of JS compiler results to keep, least recently used ones are evicted.
+GLUE_CACHE_MAX_ENTRIES = 64
+
 
 def get_configuration():
   if hasattr(get_configuration, 'configuration'):
@@ -763,18 +773,140 @@ def apply_forwarded_data(forwarded_data):
   StaticCodeHooks.atexits = str(forwarded_json['ATEXITS'])
 
 
-def compile_settings(temp_files):
-  # Save settings to a file to work around v8 issue 1579
-  with temp_files.get_file('.txt') as settings_file:
-    with open(settings_file, 'w') as s:
-      json.dump(shared.Settings.to_dict(), s, sort_keys=True)
-
-    # Call js compiler
-    env = os.environ.copy()
-    env['EMCC_BUILD_DIR'] = os.getcwd()
+def hash_js_compiler_file(h, filename, seen):
+  # Hashes a file read by the JS compiler, along with any files it #includes
+  # from outside of src/ (the contents of src/ are hashed as a whole).
+  if filename in seen or not os.path.isfile(filename):
+    return
+  seen.add(filename)
+  with open(filename, 'rb') as f:
+    contents = f.read()
+  h.update(filename.encode('utf-8') + b'\0' + contents + b'\0')
+  for include in re.findall(br'^#include\s+"?([^"\r\n]+)', contents, re.MULTILINE):
+    include = include.decode('utf-8')
+    if os.path.isabs(include):
+      hash_js_compiler_file(h, include, seen)
+
+
+def get_src_digest():
+  if not hasattr(get_src_digest, 'digest'):
+    h = hashlib.sha256()
+    src_dir = path_from_root('src')
+    for root, dirs, files in os.walk(src_dir):
+      dirs.sort()
+      for name in sorted(files):
+        path = os.path.join(root, name)
+        h.update(os.path.relpath(path, src_dir).encode('utf-8') + b'\0')
+        with open(path, 'rb') as f:
+          h.update(f.read())
+    get_src_digest.digest = h.hexdigest()
+  return get_src_digest.digest
+
+
+def get_glue_cache_key(settings_json):
+  """Returns a key for everything that the output of the JS compiler depends
+  on: the settings, the compiler itself and its libraries in src/, and any
+  other file the settings point to (user JS libraries, struct info, response
+  files)."""
+  h = hashlib.sha256()
+  h.update(shared.EMSCRIPTEN_VERSION.encode('utf-8'))
+  h.update(json.dumps(shared.NODE_JS).encode('utf-8'))
+  h.update(get_src_digest().encode('utf-8'))
+  h.update(settings_json.encode('utf-8'))
+  seen = set()
+  for key, value in sorted(shared.Settings.to_dict().items()):
+    for item in (value if isinstance(value, list) else [value]):
+      if isinstance(item, str) and item:
+        if item[0] == '@':
+          item = item[1:]
+        if os.path.isabs(item):
+          hash_js_compiler_file(h, item, seen)
+  return h.hexdigest()
+
+
+def run_js_compiler(settings_file):
+  env = os.environ.copy()
+  env['EMCC_BUILD_DIR'] = os.getcwd()
+  if STDERR_FILE:
     out = jsrun.run_js_tool(path_from_root('src', 'compiler.js'), shared.NODE_JS,
                             [settings_file], stdout=subprocess.PIPE, stderr=STDERR_FILE,
                             cwd=path_from_root('src'), env=env)
+    return out, ''
+  # Capture the warnings of the JS compiler, so that a cached result can
+  # replay them.
+  cmd = jsrun.make_command(path_from_root('src', 'compiler.js'), shared.NODE_JS, [settings_file])
+  proc = shared.run_process(cmd, check=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            cwd=path_from_root('src'), env=env)
+  sys.stderr.write(proc.stderr)
+  if proc.returncode != 0:
+    exit_with_error("'%s' failed (%d)", ' '.join(cmd), proc.returncode)
+  return proc.stdout, proc.stderr
+
+
+def evict_glue_cache(cache_dir):
+  entries = sorted((os.path.getmtime(os.path.join(cache_dir, f)), f) for f in os.listdir(cache_dir) if f.endswith('.json'))
+  for _, f in entries[:-GLUE_CACHE_MAX_ENTRIES]:
+    shared.try_delete(os.path.join(cache_dir, f))
+
+
+def store_glue_cache(cache_dir, cache_file, out, err):
+  temp = '%s.%d.tmp' % (cache_file, os.getpid())
+  try:
+    shared.safe_ensure_dirs(cache_dir)
+    with open(temp, 'w') as f:
+      json.dump({'out': out, 'stderr': err}, f)
+    try:
+      os.rename(temp, cache_file)
+    except OSError:
+      # another process stored the same entry first
+      shared.try_delete(temp)
+    evict_glue_cache(cache_dir)
+  except (IOError, OSError) as e:
+    # The cache is only an optimization, so e.g. a read-only cache dir just
+    # means that the output isn't stored.
+    logger.debug('could not store JS compiler output in the cache: %s' % e)
+    shared.try_delete(temp)
+
+
+def compile_settings(temp_files):
+  settings_json = json.dumps(shared.Settings.to_dict(), sort_keys=True)
+  cached = None
+  if GLUE_CACHE != '0':
+    cache_dir = shared.Cache.get_path('compiler_glue')
+    cache_file = os.path.join(cache_dir, get_glue_cache_key(settings_json) + '.json')
+    if os.path.exists(cache_file):
+      try:
+        with open(cache_file) as f:
+          cached = json.load(f)
+      except (IOError, OSError, ValueError):
+        cached = None
+      if cached and not shared.FROZEN_CACHE:
+        # Eviction goes by mtime, so touch the entry to mark it recently used.
+        try:
+          os.utime(cache_file, None)
+        except OSError:
+          pass
+
+  if cached and GLUE_CACHE != 'verify':
+    logger.debug('using cached JS compiler output: ' + cache_file)
+    out = cached['out']
+    sys.stderr.write(cached['stderr'])
+  else:
+    # Save settings to a file to work around v8 issue 1579
+    with temp_files.get_file('.txt') as settings_file:
+      with open(settings_file, 'w') as s:
+        s.write(settings_json)
+
+      # Call js compiler
+      out, err = run_js_compiler(settings_file)
+
+    if GLUE_CACHE != '0':
+      if cached and cached['out'] != out:
+        exit_with_error('EMCC_GLUE_CACHE=verify: cached JS compiler output %s does not match the actual output', cache_file)
+      # A frozen cache is only read from.
+      if not shared.FROZEN_CACHE:
+        store_glue_cache(cache_dir, cache_file, out, err)
+
   assert '//FORWARDED_DATA:' in out, 'Did not receive forwarded data in pre output - process failed?'
   glue, forwarded_data = out.split('//FORWARDED_DATA:')
 
@@ -12,6 +12,10 @@ import sys
 import time
 import unittest
 import zlib
+try:
+  import resource
+except ImportError:
+  resource = None  # not available on Windows
 
 if __name__ == '__main__':
   raise Exception('do not run this file directly; do something like: tests/runner.py benchmark')
@@ -1050,3 +1054,77 @@ class benchmark(runner.RunnerCore):
                                  path_from_root('tests', 'poppler', 'emscripten_html5.pdf') + '@input.pdf', '-s', 'ERROR_ON_UNDEFINED_SYMBOLS=0',
                                  '-s', 'MINIMAL_RUNTIME=0'], # not minimal because of files
                       lib_builder=lib_builder, skip_native=True)
+
+  @non_core
+  @runner.no_wasm_backend('uses the python archive linker')
+  def test_zzz_link_symbol_index(self):
+    # Measures the time a link spends resolving symbols against a large archive,
+    # with a cold and a warm llvm-nm symbol index.
+    members = []
+    for i in range(500):
+      name = 'member%d.c' % i
+      with open(name, 'w') as f:
+        f.write('int f%d(int x) { return x + %d; }\n' % (i, i))
+        if i < 499:
+          f.write('int f%d(int x);\nint g%d(int x) { return f%d(x); }\n' % (i + 1, i, i + 1))
+      run_process([EMCC, '-c', name, '-o', name + '.o'])
+      members.append(name + '.o')
+    try_delete('liblarge.a')
+    run_process([PYTHON, shared.EMAR, 'cr', 'liblarge.a'] + members)
+    with open('main.c', 'w') as f:
+      f.write('int g0(int x);\nint main(int argc, char **argv) { return g0(argc); }\n')
+    run_process([EMCC, '-c', 'main.c', '-o', 'main.o'])
+
+    def link():
+      start = time.time()
+      run_process([EMCC, 'main.o', 'liblarge.a', '-o', 'main.js'])
+      return time.time() - start
+
+    with runner.env_modify({'EMCC_SYMBOL_INDEX': '0'}):
+      without_index = link()
+    try_delete(shared.Cache.get_path('symbol_index.sqlite'))
+    cold = link()
+    warm = link()
+    print('   link without symbol index: %.3f seconds' % without_index)
+    print('   link with cold symbol index: %.3f seconds' % cold)
+    print('   link with warm symbol index: %.3f seconds' % warm)
+
+  @non_core
+  def test_zzz_wasm_sourcemap(self):
+    # Measures wasm-sourcemap.py on the llvm-dwarfdump output of a synthetic
+    # program with a million line table rows.
+    units = 1000
+    rows = 1000
+    with open('synthetic.dump', 'w') as f:
+      f.write('synthetic.wasm:\tfile format WASM\n\n.debug_info contents:\n')
+      for unit in range(units):
+        f.write('0x%08x: DW_TAG_compile_unit\n'
+                '              DW_AT_stmt_list\t(0x%08x)\n'
+                '              DW_AT_comp_dir\t("/src/dir%d")\n\n' % (unit, unit * 0x1000, unit % 10))
+      f.write('.debug_line contents:\n')
+      # emit the line tables out of address order, like a link would
+      for unit in reversed(range(units)):
+        f.write('debug_line[0x%08x]\n'
+                'include_directories[  1] = "/usr/include"\n'
+                'file_names[  1]:\n           name: "unit%d.c"\n      dir_index: 0\n'
+                'file_names[  2]:\n           name: "stdio.h"\n      dir_index: 1\n\n'
+                'Address            Line   Column File   ISA Discriminator Flags\n'
+                '------------------ ------ ------ ------ --- ------------- -------------\n' % (unit * 0x1000, unit))
+        address = 16 + unit * rows * 4
+        for row in range(rows):
+          address += 1 + row % 4
+          flags = 'is_stmt end_sequence' if row % 50 == 49 else 'is_stmt'
+          f.write('0x%016x %6d %6d %6d   0             0  %s\n' % (address, 1 + row * 7 % 3000, row % 80, 1 + (row % 9 == 0), flags))
+        f.write('\n')
+    with open('synthetic.wasm', 'wb') as f:
+      # just a header and an empty code section
+      f.write(b'\0asm\x01\0\0\0\x0a\x01\x00')
+
+    start = time.time()
+    run_process([PYTHON, path_from_root('tools', 'wasm-sourcemap.py'), 'synthetic.wasm',
+                 '--dwarfdump-output', 'synthetic.dump', '-o', 'synthetic.wasm.map',
+                 '--basepath=' + os.getcwd()])
+    print('   wasm-sourcemap.py on %d rows: %.3f seconds' % (units * rows, time.time() - start))
+    if resource:
+      print('   peak memory of child processes: %d MB' % (resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // 1024))
+    self.assertExists('synthetic.wasm.map')
@@ -10,6 +10,7 @@ from __future__ import print_function
 from functools import wraps
 import glob
 import gzip
+import io
 import itertools
 import json
 import os
@@ -483,6 +484,32 @@ There is NO warranty; not even for MERCHANTABILITY or FITNESS FOR A PARTICULAR P
     self.assertNotExists(path_from_root('tests', 'twopart_main.o'))
     self.assertNotExists(path_from_root('tests', 'twopart_side.o'))
 
+  @with_env_modify({'EMCC_CORES': '4'})
+  def test_multiple_sources_parallel(self):
+    # Several sources in one invocation are compiled in parallel, but the
+    # diagnostics still come out in input order.
+    create_test_file('src0.c', '#warning "first"\nint f0(int x) { return x; }')
+    create_test_file('src1.c', 'int f1(int x) { return x; }')
+    create_test_file('src2.c', '#warning "second"\nint main() { return 0; }')
+    create_test_file('src3.c', '#warning "third"\nint f3(int x) { return x; }')
+    srcs = ['src%d.c' % i for i in range(4)]
+    err = run_process([PYTHON, EMCC] + srcs, stderr=PIPE).stderr
+    self.assertContained('first', err)
+    self.assertLess(err.index('first'), err.index('second'))
+    self.assertLess(err.index('second'), err.index('third'))
+    self.assertExists('a.out.js')
+
+    # A broken source file fails the whole compile step.
+    create_test_file('src1.c', 'int f1(int x) { return y; }')
+    err = self.expect_fail([PYTHON, EMCC, '-c'] + srcs)
+    self.assertContained("use of undeclared identifier 'y'", err)
+    self.assertContained('src1.c', err)
+
+    # A source read from stdin is not lost when there are other sources.
+    create_test_file('src1.c', 'int f1(int x) { return x; }')
+    run_process([PYTHON, EMCC, '-x', 'c', '-', 'src0.c', 'src1.c'], input='#include <stdio.h>\nint main() { puts("from stdin"); }')
+    self.assertContained('from stdin', run_js('a.out.js'))
+
   def test_combining_object_files(self):
     # Compiling two files with -c will generate separate object files
     run_process([PYTHON, EMCC, path_from_root('tests', 'twopart_main.cpp'), path_from_root('tests', 'twopart_side.cpp'), '-c'])
@@ -1495,6 +1522,47 @@ int f() {
     run_process([PYTHON, EMCC, 'main.c', '-L.', '-la', '-lb'])
     self.assertContained('a\nb\n', run_js('a.out.js'))
 
+  @no_wasm_backend('uses the python archive linker')
+  def test_symbol_index(self):
+    create_test_file('a.c', 'int a() { return 1; }')
+    create_test_file('b.c', 'int b() { return 2; }')
+    create_test_file('main.c', r'''
+      #include <stdio.h>
+      int a();
+      int main() {
+        printf("a: %d\n", a());
+      }
+    ''')
+    run_process([PYTHON, EMCC, '-c', 'a.c', 'b.c'])
+    run_process([PYTHON, EMAR, 'cr', 'libab.a', 'a.o', 'b.o'])
+
+    def link():
+      with env_modify({'EMCC_DEBUG': '1'}):
+        return run_process([PYTHON, EMCC, 'main.c', 'libab.a'], stderr=PIPE).stderr
+
+    link()
+    # The second link finds everything in the persistent index.
+    self.assertContained('symbol index: 0 of', link())
+    self.assertContained('a: 1', run_js('a.out.js'))
+
+    # An updated archive is scanned again.
+    create_test_file('a.c', 'int a() { return 3; } int c() { return 4; }')
+    run_process([PYTHON, EMCC, '-c', 'a.c'])
+    run_process([PYTHON, EMAR, 'cr', 'libab.a', 'a.o', 'b.o'])
+    self.assertNotContained('symbol index: 0 of', link())
+    self.assertContained('a: 3', run_js('a.out.js'))
+
+    # A frozen cache only has its index read.
+    index = open(shared.Cache.get_path('symbol_index.sqlite'), 'rb').read()
+    create_test_file('a.c', 'int a() { return 5; }')
+    run_process([PYTHON, EMCC, '-c', 'a.c'])
+    run_process([PYTHON, EMAR, 'cr', 'libab.a', 'a.o', 'b.o'])
+    with env_modify({'EM_FROZEN_CACHE': '1'}):
+      self.assertNotContained('symbol index: 0 of', link())
+      self.assertNotContained('symbol index: 0 of', link())
+    self.assertContained('a: 5', run_js('a.out.js'))
+    self.assertEqual(open(shared.Cache.get_path('symbol_index.sqlite'), 'rb').read(), index)
+
   def test_archive_duplicate_basenames(self):
     ensure_dir('a')
     create_test_file(os.path.join('a', 'common.c'), r'''
@@ -2265,6 +2333,48 @@ int f() {
       with open('wasm2js.js.jsopt.js') as actual:
         self.assertIdentical(expected.read(), actual.read())
 
+  @no_fastcomp('wasm2js-only')
+  def test_js_optimizer_chunk_cache(self):
+    shutil.copyfile(path_from_root('tests', 'optimizer', 'wasm2js.js'), 'wasm2js.js')
+
+    def optimize(cache='1', frozen=None):
+      # tiny chunks, so that the functions are spread over many of them
+      with env_modify({'EM_CACHE': os.path.abspath('cache'), 'EMCC_DEBUG': '1', 'EMCC_JSOPT_CACHE': cache,
+                       'EMCC_JSOPT_MIN_CHUNK_SIZE': '1', 'EMCC_JSOPT_MAX_CHUNK_SIZE': '1', 'EM_FROZEN_CACHE': frozen}):
+        err = run_process([PYTHON, path_from_root('tools', 'js_optimizer.py'), 'wasm2js.js', 'minifyNames', 'last'], stderr=PIPE).stderr
+      stats = re.search(r'chunk cache: (\d+) hits, (\d+) misses', err)
+      with open('wasm2js.js.jsopt.js') as f:
+        return f.read(), stats and (int(stats.group(1)), int(stats.group(2)))
+
+    first, (hits, misses) = optimize()
+    self.assertEqual(hits, 0)
+    self.assertGreater(misses, 1)
+
+    # nothing changed, so every chunk comes from the cache
+    second, stats = optimize()
+    self.assertEqual(stats, (misses, 0))
+    self.assertIdentical(first, second)
+
+    # changing one function only optimizes the chunk it is in again
+    create_test_file('wasm2js.js', open('wasm2js.js').read().replace('HEAP32[300] = $0_1;', 'HEAP32[301] = $0_1;'))
+    changed, stats = optimize()
+    self.assertEqual(stats, (misses - 1, 1))
+    self.assertContained('[301] = ', changed)
+    self.assertNotContained('[300] = ', changed)
+
+    # a frozen cache is still used, but the changed chunk is not stored in it
+    create_test_file('wasm2js.js', open('wasm2js.js').read().replace('HEAP32[301] = $0_1;', 'HEAP32[302] = $0_1;'))
+    for i in range(2):
+      frozen, stats = optimize(frozen='1')
+      self.assertEqual(stats, (misses - 1, 1))
+      self.assertContained('[302] = ', frozen)
+    create_test_file('wasm2js.js', open('wasm2js.js').read().replace('HEAP32[302] = $0_1;', 'HEAP32[301] = $0_1;'))
+
+    uncached, stats = optimize(cache='0')
+    self.assertEqual(stats, None)
+    # chunking differs without the cache, which can move empty lines around
+    self.assertIdentical(uncached.replace('\n', ''), changed.replace('\n', ''))
+
   def test_m_mm(self):
     create_test_file('foo.c', '#include <emscripten.h>')
     for opt in ['M', 'MM']:
@@ -2573,6 +2683,37 @@ int f() {
     # can only assert the uuid format is correct, the uuid's value is expected to differ in between invocation
     uuid.UUID(metadata['package_uuid'], version=4)
 
+  def test_file_packager_incremental(self):
+    create_test_file('data1.txt', 'data1')
+    create_test_file('data2.txt', 'data2')
+    cmd = [PYTHON, FILE_PACKAGER, 'test.data', '--js-output=test.js', '--incremental', '--preload', 'data1.txt', 'data2.txt']
+    run_process(cmd)
+    self.assertExists('test.data.manifest')
+    self.assertEqual(open('test.data').read(), 'data1data2')
+
+    # An unchanged file is left alone, a changed one is rewritten in place.
+    create_test_file('data2.txt', 'DATA2')
+    with env_modify({'EMCC_DEBUG': '1'}):
+      err = run_process(cmd, stderr=PIPE).stderr
+    self.assertContained('rewrote 5 of 10 bytes', err)
+    self.assertEqual(open('test.data').read(), 'data1DATA2')
+
+    # Files moving to another offset are rewritten, and the bundle shrinks.
+    create_test_file('data1.txt', 'd1')
+    run_process(cmd)
+    self.assertEqual(open('test.data').read(), 'd1DATA2')
+
+    # Appended files don't cause the earlier ones to be rewritten.
+    create_test_file('data3.txt', 'data3')
+    with env_modify({'EMCC_DEBUG': '1'}):
+      err = run_process(cmd + ['data3.txt'], stderr=PIPE).stderr
+    self.assertContained('rewrote 5 of 12 bytes', err)
+    self.assertEqual(open('test.data').read(), 'd1DATA2data3')
+
+    # Embedded files are bundled along with the preloaded ones.
+    run_process([PYTHON, FILE_PACKAGER, 'test.data', '--js-output=test.js', '--incremental', '--embed', 'data1.txt', '--preload', 'data2.txt'])
+    self.assertEqual(open('test.data').read(), 'd1DATA2')
+
   def test_file_packager_unicode(self):
     unicode_name = 'unicode…☃'
     try:
@@ -3205,6 +3346,47 @@ mergeInto(LibraryManager.library, {
     run_process([PYTHON, EMCC, path_from_root('tests', 'hello_world.cpp'), '--js-library', 'lib.js'])
     self.assertContained('hello, world!', run_js('a.out.js'))
 
+  def test_js_compiler_glue_cache(self):
+    create_test_file('lib.js', r'''
+mergeInto(LibraryManager.library, {
+  jslibfunc: function(x) { return 2 * x }
+});
+''')
+    create_test_file('src.c', r'''
+      #include <stdio.h>
+      int jslibfunc(int x);
+      int main() {
+        printf("c calling: %d\n", jslibfunc(6));
+      }
+    ''')
+    cmd = [PYTHON, EMCC, 'src.c', '--js-library', 'lib.js']
+
+    def build():
+      with env_modify({'EMCC_DEBUG': '1'}):
+        return run_process(cmd, stderr=PIPE).stderr
+
+    build()
+    self.assertContained('using cached JS compiler output', build())
+    self.assertContained('c calling: 12', run_js('a.out.js'))
+
+    # Changing a JS library invalidates the cached output.
+    create_test_file('lib.js', open('lib.js').read().replace('2 * x', '3 * x'))
+    self.assertNotContained('using cached JS compiler output', build())
+    self.assertContained('c calling: 18', run_js('a.out.js'))
+
+    with env_modify({'EMCC_GLUE_CACHE': 'verify'}):
+      self.assertNotContained('using cached JS compiler output', build())
+    with env_modify({'EMCC_GLUE_CACHE': '0'}):
+      self.assertNotContained('using cached JS compiler output', build())
+
+    # A frozen cache is used, but nothing new is stored in it.
+    with env_modify({'EM_FROZEN_CACHE': '1'}):
+      self.assertContained('using cached JS compiler output', build())
+      create_test_file('lib.js', open('lib.js').read().replace('3 * x', '4 * x'))
+      self.assertNotContained('using cached JS compiler output', build())
+      self.assertNotContained('using cached JS compiler output', build())
+      self.assertContained('c calling: 24', run_js('a.out.js'))
+
   def test_js_lib_exported(self):
     create_test_file('lib.js', r'''
 mergeInto(LibraryManager.library, {
@@ -8940,6 +9122,30 @@ end
     # replaced subprocess functions should not cause errors
     run_process([PYTHON, EMCC, path_from_root('tests', 'hello_world.c')], env=environ)
 
+  def test_emprofile_summary(self):
+    run_process([PYTHON, path_from_root('tools', 'emprofile.py'), '--reset'])
+    try:
+      with env_modify({'EM_PROFILE_TOOLCHAIN': '1'}):
+        run_process([PYTHON, EMCC, path_from_root('tests', 'hello_world.c'), '-O2'])
+      out = run_process([PYTHON, path_from_root('tools', 'emprofile_summary.py'), '--chrome-trace=trace.json'], stdout=PIPE).stdout
+    finally:
+      run_process([PYTHON, path_from_root('tools', 'emprofile.py'), '--reset'])
+    self.assertTrue(out.startswith('Elapsed '), out)
+    self.assertContained('Critical path:', out)
+    self.assertContained('emcc.py', out)
+
+    trace = json.load(open('trace.json'))
+    names = [e['name'] for e in trace['traceEvents'] if e['ph'] == 'X']
+    self.assertIn('emcc.py', names)
+    self.assertEqual(trace['emprofileSummary']['criticalPath'][0]['name'], 'emcc.py')
+    summary = trace['emprofileSummary']
+    self.assertLessEqual(max(summary['coresBusy']), summary['cores'])
+    self.assertLessEqual(summary['criticalPath'][0]['cpu'], summary['cpu'])
+
+    # A run compared against itself has no regressions.
+    out = run_process([PYTHON, path_from_root('tools', 'emprofile_summary.py'), 'trace.json', '--compare=trace.json'], stdout=PIPE).stdout
+    self.assertContained('0 phases regressed', out)
+
   def test_noderawfs(self):
     fopen_write = open(path_from_root('tests', 'asmfs', 'fopen_write.cpp')).read()
     create_test_file('main.cpp', fopen_write)
@@ -10854,3 +11060,61 @@ int main() {
   def test_chained_js_error_diagnostics(self):
     err = self.expect_fail([PYTHON, EMCC, path_from_root('tests', 'test_chained_js_error_diagnostics.c'), '--js-library', path_from_root('tests', 'test_chained_js_error_diagnostics.js')])
     self.assertContained("error: undefined symbol: nonexistent_function (referenced by bar__deps: ['nonexistent_function'], referenced by foo__deps: ['bar'], referenced by top-level compiled C/C++ code)", err)
+
+  def test_emrun_fast_serve(self):
+    try:
+      from http.client import HTTPConnection
+    except ImportError:
+      from httplib import HTTPConnection
+
+    create_test_file('test.data', 'x' * 1000)
+    create_test_file('test.js', 'var x = 1;\n' * 1000)
+    port = 6945
+    proc = subprocess.Popen([PYTHON, path_from_root('emrun.py'), '--no_browser', '--fast_serve', '--compress', '--timeout', '30', '--port', str(port), '.'], stdout=PIPE, stderr=PIPE)
+    conn = HTTPConnection('127.0.0.1', port)
+
+    def get(path, headers={}):
+      conn.request('GET', path, headers=headers)
+      response = conn.getresponse()
+      return response, response.read()
+
+    try:
+      for i in range(50):
+        try:
+          response, body = get('/test.data')
+          break
+        except (IOError, OSError):
+          conn.close()
+          time.sleep(0.1)
+      # All the requests below reuse the same keep-alive connection.
+      self.assertEqual(response.status, 200)
+      self.assertEqual(body, b'x' * 1000)
+      etag = response.getheader('ETag')
+
+      response, body = get('/test.data', {'If-None-Match': etag})
+      self.assertEqual(response.status, 304)
+      self.assertEqual(body, b'')
+
+      response, body = get('/test.data', {'Range': 'bytes=10-19'})
+      self.assertEqual(response.status, 206)
+      self.assertEqual(response.getheader('Content-Range'), 'bytes 10-19/1000')
+      self.assertEqual(body, b'x' * 10)
+
+      response, body = get('/test.data', {'Range': 'bytes=2000-'})
+      self.assertEqual(response.status, 416)
+
+      response, body = get('/test.js', {'Accept-Encoding': 'gzip'})
+      self.assertEqual(response.getheader('Content-Encoding'), 'gzip')
+      self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(body)).read(), b'var x = 1;\n' * 1000)
+      self.assertNotEqual(response.getheader('ETag'), get('/test.js')[0].getheader('ETag'))
+
+      conn.request('POST', '/stdio.html', body='^exit^0', headers={'Content-Length': '7'})
+      conn.getresponse().read()
+      out = proc.communicate()[0]
+    finally:
+      conn.close()
+      if proc.poll() is None:
+        proc.kill()
+        proc.wait()
+    self.assertEqual(proc.returncode, 0)
+    self.assertContained('Web server served 6 requests (1 not modified)', out.decode('utf-8'))
@@ -825,6 +825,68 @@ fi
     # Unless --force is specified
     self.assertContained('generating system library', self.do([PYTHON, EMBUILDER, 'build', 'libemmalloc', '--force']))
 
+  def test_object_cache(self):
+    restore_and_set_up()
+    local = self.in_dir('object_cache')
+    shared_dir = self.in_dir('object_cache_shared')
+    with env_modify({'EM_OBJECT_CACHE': shared_dir}):
+      out = self.do([PYTHON, EMBUILDER, 'build', 'libemmalloc', '--force'])
+      self.assertContained(' 0 hits, 0 shared hits', out)
+    # A cold local cache is populated from the shared one, even though the
+    # emscripten cache itself has been cleared.
+    self.do([PYTHON, EMCC, '--clear-cache'])
+    with env_modify({'EM_OBJECT_CACHE': local, 'EM_OBJECT_CACHE_SHARED': shared_dir}):
+      out = self.do([PYTHON, EMBUILDER, 'build', 'libemmalloc'])
+      self.assertContained(' 0 hits, 1 shared hits, 0 misses', out)
+      out = self.do([PYTHON, EMBUILDER, 'build', 'libemmalloc', '--force'])
+      self.assertContained(' 1 hits, 0 shared hits, 0 misses', out)
+    # Entries beyond the size limit get evicted.
+    with env_modify({'EM_OBJECT_CACHE': local, 'EM_OBJECT_CACHE_MAX_SIZE': '0'}):
+      self.do([PYTHON, EMBUILDER, 'build', 'libemmalloc', '--force'])
+    self.assertEqual(list(system_libs.get_all_files_under(local)), [])
+
+  def test_object_cache_relocatable(self):
+    # Cache keys don't depend on where the emscripten cache and the ports are,
+    # so objects can be shared between cache dirs and machines.
+    restore_and_set_up()
+    objects = self.in_dir('object_cache')
+    with env_modify({'EM_OBJECT_CACHE': objects, 'EM_CACHE': self.in_dir('cache_a')}):
+      out = self.do([PYTHON, EMBUILDER, 'build', 'libemmalloc', '--force'])
+      self.assertContained(' 0 hits, 0 shared hits', out)
+    with env_modify({'EM_OBJECT_CACHE': objects, 'EM_CACHE': self.in_dir('cache_b')}):
+      out = self.do([PYTHON, EMBUILDER, 'build', 'libemmalloc', '--force'])
+      self.assertContained(' 1 hits, 0 shared hits, 0 misses', out)
+
+    keys = []
+    for ports in ['ports_a', 'ports_b']:
+      ensure_dir(os.path.join(ports, 'foo', 'include'))
+      create_test_file(os.path.join(ports, 'foo', 'include', 'foo.h'), '#define FOO 1\n')
+      create_test_file(os.path.join(ports, 'foo', 'foo.c'), '#include <foo.h>\nint foo() { return FOO; }\n')
+      ports = self.in_dir(ports)
+      with env_modify({'EM_PORTS': ports}):
+        keys.append(system_libs.get_object_cache_key([PYTHON, EMCC, '-c', os.path.join(ports, 'foo', 'foo.c'),
+                                                      '-I' + os.path.join(ports, 'foo', 'include'),
+                                                      '-I' + shared.Cache.get_path('ports-builds'), '-o', 'foo.o'])[0])
+    self.assertEqual(keys[0], keys[1])
+
+  def test_object_cache_include_dirs(self):
+    # Headers found through any form of the include flags are part of the key.
+    restore_and_set_up()
+    ensure_dir('inc')
+    create_test_file('foo.c', '#include <foo.h>\nint foo() { return FOO; }\n')
+    for flags in [['-Iinc'], ['-I', 'inc'], ['-isystem', 'inc'], ['-Xclang', '-isysteminc'], ['-iquote', 'inc'],
+                  ['-idirafter', 'inc'], ['-include', os.path.join('inc', 'foo.h')]]:
+      keys = []
+      for value in ['1', '2']:
+        create_test_file(os.path.join('inc', 'foo.h'), '#define FOO %s\n' % value)
+        system_libs.include_dir_digests.clear()
+        keys.append(system_libs.get_object_cache_key([PYTHON, EMCC, '-c', 'foo.c', '-o', 'foo.o'] + flags)[0])
+      self.assertNotEqual(keys[0], keys[1], flags)
+
+    self.assertTrue(system_libs.uses_port_settings([PYTHON, EMCC, '-c', 'foo.c', '-s', 'USE_SDL=2']))
+    self.assertTrue(system_libs.uses_port_settings([PYTHON, EMCC, '-c', 'foo.c', '-sUSE_ZLIB=1']))
+    self.assertFalse(system_libs.uses_port_settings([PYTHON, EMCC, '-c', 'foo.c', '-s', 'ASSERTIONS=1']))
+
   def test_embuilder_wasm_backend(self):
     if not Settings.WASM_BACKEND:
       self.skipTest('wasm backend only')
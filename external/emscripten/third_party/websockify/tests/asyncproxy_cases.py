@@ -0,0 +1,229 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+""" Unit tests for asyncproxy, imported by test_asyncproxy on Python 3.5.2 and later """
+
+import asyncio
+import base64
+import os
+import struct
+import unittest
+
+from websockify import asyncproxy
+from websockify import auth_plugins
+from websockify import token_plugins
+
+
+async def echo(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    writer.close()
+
+
+def encode_client_frame(payload, opcode=0x2):
+    """ Encodes a masked frame, like a browser would send it. """
+    length = len(payload)
+    if length <= 125:
+        header = struct.pack('>BB', 0x80 | opcode, 0x80 | length)
+    elif length < 65536:
+        header = struct.pack('>BBH', 0x80 | opcode, 0x80 | 126, length)
+    else:
+        header = struct.pack('>BBQ', 0x80 | opcode, 0x80 | 127, length)
+    mask = os.urandom(4)
+    return header + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+
+class WebSocketClient(object):
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, port, path='/', protocol='binary', headers=''):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(('GET %s HTTP/1.1\r\n'
+                      'Upgrade: websocket\r\n'
+                      'Connection: Upgrade\r\n'
+                      'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+                      'Sec-WebSocket-Version: 13\r\n'
+                      'Sec-WebSocket-Protocol: %s\r\n%s\r\n' % (path, protocol, headers)).encode('latin_1'))
+        try:
+            response = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError:
+            response = b''
+        return cls(reader, writer), response
+
+    def send(self, payload, opcode=0x2):
+        self.writer.write(encode_client_frame(payload, opcode))
+
+    async def recv(self):
+        b1, b2 = struct.unpack('>BB', await self.reader.readexactly(2))
+        length = b2 & 0x7f
+        if length == 126:
+            length, = struct.unpack('>H', await self.reader.readexactly(2))
+        elif length == 127:
+            length, = struct.unpack('>Q', await self.reader.readexactly(8))
+        return b1 & 0x0f, await self.reader.readexactly(length)
+
+    async def recv_data(self, length):
+        data = b''
+        while len(data) < length:
+            opcode, payload = await self.recv()
+            if opcode == 0x8:
+                raise Exception("connection closed: %r" % payload)
+            data += payload
+        return data
+
+
+class AsyncWebSocketProxyTestCase(unittest.TestCase):
+    def setUp(self):
+        super(AsyncWebSocketProxyTestCase, self).setUp()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        super(AsyncWebSocketProxyTestCase, self).tearDown()
+
+    def run_proxy(self, scenario, **kwargs):
+        """ Runs scenario(proxy_port) against a proxy in front of an echo
+        server. """
+        async def run():
+            echo_server = await asyncio.start_server(echo, '127.0.0.1', 0)
+            echo_port = echo_server.sockets[0].getsockname()[1]
+            if 'token_plugin' not in kwargs:
+                kwargs.setdefault('target_host', '127.0.0.1')
+                kwargs.setdefault('target_port', echo_port)
+            self.proxy = asyncproxy.AsyncWebSocketProxy(
+                listen_host='127.0.0.1', listen_port=0, **kwargs)
+            addresses = []
+            server = asyncio.ensure_future(self.proxy.serve(ready=addresses.append))
+            while not addresses:
+                await asyncio.sleep(0.01)
+            try:
+                return await asyncio.wait_for(scenario(addresses[0][1], echo_port), 30)
+            finally:
+                self.proxy.terminate()
+                await server
+                echo_server.close()
+        return self.loop.run_until_complete(run())
+
+    def test_binary_echo(self):
+        async def scenario(port, echo_port):
+            client, response = await WebSocketClient.connect(port)
+            self.assertTrue(response.startswith(b'HTTP/1.1 101'))
+            self.assertIn(b'Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=', response)
+            self.assertIn(b'Sec-WebSocket-Protocol: binary', response)
+
+            client.send(b'Hello')
+            self.assertEqual(await client.recv_data(5), b'Hello')
+
+            # Several frames in one write, and frames larger than the buffers
+            large = os.urandom(3 * asyncproxy.AsyncWebSocketProxy.buffer_size + 7)
+            client.writer.write(encode_client_frame(b'a' * 300) + encode_client_frame(large))
+            self.assertEqual(await client.recv_data(300 + len(large)), b'a' * 300 + large)
+
+            client.send(struct.pack('>H', 1000), opcode=0x8)
+            opcode, payload = await client.recv()
+            self.assertEqual(opcode, 0x8)
+            self.assertEqual(struct.unpack('>H', payload[:2])[0], 1000)
+        self.run_proxy(scenario)
+
+    def test_base64_echo(self):
+        async def scenario(port, echo_port):
+            client, response = await WebSocketClient.connect(port, protocol='base64')
+            self.assertIn(b'Sec-WebSocket-Protocol: base64', response)
+            client.send(base64.b64encode(b'\x00\x01\xff'), opcode=0x1)
+            opcode, payload = await client.recv()
+            self.assertEqual(opcode, 0x1)
+            self.assertEqual(base64.b64decode(payload), b'\x00\x01\xff')
+        self.run_proxy(scenario)
+
+    def test_token_plugin(self):
+        class TestPlugin(token_plugins.BasePlugin):
+            def lookup(self, token):
+                if token == 'echo':
+                    return ('127.0.0.1', self.source[0])
+                return None
+
+        plugin = TestPlugin([None])
+
+        async def scenario(port, echo_port):
+            plugin.source[0] = echo_port
+            client, response = await WebSocketClient.connect(port, path='/?token=echo')
+            self.assertTrue(response.startswith(b'HTTP/1.1 101'))
+            client.send(b'tokens')
+            self.assertEqual(await client.recv_data(6), b'tokens')
+
+            client, response = await WebSocketClient.connect(port, path='/?token=other')
+            self.assertEqual(response, b'')
+        self.run_proxy(scenario, token_plugin=plugin)
+
+    def test_auth_plugin(self):
+        class TestPlugin(auth_plugins.BasePlugin):
+            def authenticate(self, headers, target_host, target_port):
+                if headers.get('X-Secret') != self.source:
+                    raise auth_plugins.AuthenticationError(response_msg="Forbidden")
+
+        async def scenario(port, echo_port):
+            client, response = await WebSocketClient.connect(port)
+            self.assertTrue(response.startswith(b'HTTP/1.1 403 Forbidden'))
+
+            client, response = await WebSocketClient.connect(port, headers='X-Secret: sesame\r\n')
+            self.assertTrue(response.startswith(b'HTTP/1.1 101'))
+        self.run_proxy(scenario, auth_plugin=TestPlugin('sesame'))
+
+    def test_frame_too_large(self):
+        async def scenario(port, echo_port):
+            client, response = await WebSocketClient.connect(port)
+            # Announce a frame larger than the limit, and send part of it
+            client.writer.write(struct.pack('>BBQ', 0x82, 0x80 | 127, 1 << 40) + b'mask' + b'x' * 100)
+            opcode, payload = await client.recv()
+            self.assertEqual(opcode, 0x8)
+            self.assertEqual(struct.unpack('>H', payload[:2])[0], 1009)
+        self.run_proxy(scenario)
+
+    def test_unmasked_frame_refused(self):
+        async def scenario(port, echo_port):
+            client, response = await WebSocketClient.connect(port)
+            client.writer.write(b'\x82\x05Hello')
+            opcode, payload = await client.recv()
+            self.assertEqual(opcode, 0x8)
+            self.assertEqual(struct.unpack('>H', payload[:2])[0], 1002)
+        self.run_proxy(scenario)
+
+    def test_auto_pong(self):
+        async def scenario(port, echo_port):
+            client, response = await WebSocketClient.connect(port)
+            client.send(b'ping!', opcode=0x9)
+            self.assertEqual(await client.recv(), (0xA, b'ping!'))
+        self.run_proxy(scenario, auto_pong=True)
+
+    def test_run_once(self):
+        async def scenario(port, echo_port):
+            client, response = await WebSocketClient.connect(port)
+            client.send(struct.pack('>H', 1000), opcode=0x8)
+            await client.recv()
+            for i in range(100):
+                if not self.proxy.serving:
+                    break
+                await asyncio.sleep(0.05)
+            self.assertFalse(self.proxy.serving)
+        self.run_proxy(scenario, run_once=True)
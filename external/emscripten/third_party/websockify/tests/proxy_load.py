@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+'''
+Load test for the websockify proxy engines. Starts a TCP echo server and a
+websockify proxy in front of it, then connects many WebSocket clients
+through the proxy at once. Each client sends messages with a random length
+and content, and checks that they come back unchanged. Reports the time to
+connect all the clients, the memory used by the proxy, the throughput and
+the round trip latencies.
+
+    tests/proxy_load.py --engine asyncio --clients 500 --messages 100
+    tests/proxy_load.py --engine fork --clients 500 --messages 100
+'''
+
+import asyncio, base64, optparse, os, random, struct, subprocess, sys, time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+WEBSOCKIFY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+ENGINE_ARGS = {
+    'asyncio': ['--asyncio'],
+    'fork': [],
+    'libserver': ['--libserver'],
+}
+
+
+async def echo(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    writer.close()
+
+
+def free_port():
+    import socket
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def proxy_rss(pid):
+    """ Returns the resident memory of a process and all its descendants,
+    in bytes, or None where /proc is not available. """
+    if not os.path.isdir('/proc'):
+        return None
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    total = 0
+    todo = [pid]
+    while todo:
+        p = todo.pop()
+        todo.extend(children.get(p, []))
+        try:
+            with open('/proc/%d/status' % p) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except (IOError, OSError):
+            pass
+    return total
+
+
+class Client(object):
+    def __init__(self, port, opts):
+        self.port = port
+        self.opts = opts
+        self.latencies = []
+        self.errors = 0
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+        key = base64.b64encode(os.urandom(16)).decode('latin_1')
+        self.writer.write(('GET / HTTP/1.1\r\n'
+                           'Host: 127.0.0.1:%d\r\n'
+                           'Upgrade: websocket\r\n'
+                           'Connection: Upgrade\r\n'
+                           'Sec-WebSocket-Key: %s\r\n'
+                           'Sec-WebSocket-Version: 13\r\n'
+                           'Sec-WebSocket-Protocol: binary\r\n\r\n' % (self.port, key)).encode('latin_1'))
+        response = await self.reader.readuntil(b'\r\n\r\n')
+        if not response.startswith(b'HTTP/1.1 101'):
+            raise Exception('handshake failed: %r' % response.split(b'\r\n')[0])
+
+    def send_frame(self, payload, opcode=0x2):
+        length = len(payload)
+        if length <= 125:
+            header = struct.pack('>BB', 0x80 | opcode, 0x80 | length)
+        elif length < 65536:
+            header = struct.pack('>BBH', 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack('>BBQ', 0x80 | opcode, 0x80 | 127, length)
+        mask = os.urandom(4)
+        masked = (int.from_bytes(payload, 'little') ^
+                  int.from_bytes((mask * (length // 4 + 1))[:length], 'little'))
+        self.writer.write(header + mask + masked.to_bytes(length, 'little'))
+
+    async def recv_frame(self):
+        b1, b2 = struct.unpack('>BB', await self.reader.readexactly(2))
+        length = b2 & 0x7f
+        if length == 126:
+            length, = struct.unpack('>H', await self.reader.readexactly(2))
+        elif length == 127:
+            length, = struct.unpack('>Q', await self.reader.readexactly(8))
+        return b1 & 0x0f, await self.reader.readexactly(length)
+
+    async def run(self):
+        for i in range(self.opts.messages):
+            payload = os.urandom(random.randint(1, self.opts.size))
+            start = time.time()
+            self.send_frame(payload)
+            await self.writer.drain()
+            # The proxy may split the echoed data over several frames
+            received = []
+            remaining = len(payload)
+            while remaining > 0:
+                opcode, data = await self.recv_frame()
+                if opcode == 0x8:
+                    raise Exception('connection closed by the proxy')
+                received.append(data)
+                remaining -= len(data)
+            self.latencies.append(time.time() - start)
+            if b''.join(received) != payload:
+                self.errors += 1
+
+    async def close(self):
+        self.send_frame(struct.pack('>H', 1000), opcode=0x8)
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+        self.writer.close()
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def load_test(opts):
+    echo_server = await asyncio.start_server(echo, '127.0.0.1', 0)
+    echo_port = echo_server.sockets[0].getsockname()[1]
+    proxy_port = free_port()
+
+    cmd = [sys.executable, os.path.join(WEBSOCKIFY_DIR, 'run')] + ENGINE_ARGS[opts.engine] + \
+          [str(proxy_port), '127.0.0.1:%d' % echo_port]
+    proxy = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        # Wait for the proxy to listen
+        for i in range(100):
+            try:
+                _, writer = await asyncio.open_connection('127.0.0.1', proxy_port)
+                writer.close()
+                break
+            except OSError:
+                await asyncio.sleep(0.1)
+
+        clients = [Client(proxy_port, opts) for i in range(opts.clients)]
+        start = time.time()
+        await asyncio.gather(*[client.connect() for client in clients])
+        connect_time = time.time() - start
+        rss = proxy_rss(proxy.pid)
+
+        start = time.time()
+        results = await asyncio.gather(*[client.run() for client in clients], return_exceptions=True)
+        run_time = time.time() - start
+        await asyncio.gather(*[client.close() for client in clients], return_exceptions=True)
+    finally:
+        proxy.terminate()
+        proxy.wait()
+        echo_server.close()
+        # The echo handlers finish once the proxy's connections are gone
+        others = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        if others:
+            await asyncio.wait(others, timeout=10)
+
+    failures = [r for r in results if isinstance(r, Exception)]
+    errors = sum(client.errors for client in clients) + len(failures)
+    latencies = sorted(l for client in clients for l in client.latencies)
+    round_trips = len(latencies)
+
+    print('engine: %s, clients: %d, messages: %d of up to %d bytes' % (
+          opts.engine, opts.clients, opts.messages, opts.size))
+    if rss is None:
+        print('connected in %.2fs' % connect_time)
+    else:
+        print('connected in %.2fs, proxy RSS: %.1f MB' % (connect_time, rss / (1024.0 * 1024)))
+    if round_trips:
+        print('%d round trips in %.2fs (%.0f/s, %.1f MB/s each way)' % (
+              round_trips, run_time, round_trips / run_time,
+              round_trips * (opts.size + 1) / 2.0 / run_time / (1024 * 1024)))
+        print('latency: p50 %.2f ms, p99 %.2f ms, max %.2f ms' % (
+              percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+              latencies[-1] * 1000))
+    for failure in failures[:5]:
+        print('client failed: %s' % failure)
+    print('errors: %d' % errors)
+    return errors
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--engine", default="asyncio", choices=sorted(ENGINE_ARGS.keys()),
+            help="proxy engine to test: asyncio (default), fork or libserver")
+    parser.add_option("--clients", type=int, default=200,
+            help="number of concurrent WebSocket clients")
+    parser.add_option("--messages", type=int, default=50,
+            help="messages sent by each client")
+    parser.add_option("--size", type=int, default=4096,
+            help="maximum message size in bytes")
+    (opts, args) = parser.parse_args()
+
+    if resource:
+        # Each client needs a few file descriptors, in the proxy and here
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+    loop = asyncio.new_event_loop()
+    try:
+        errors = loop.run_until_complete(load_test(opts))
+    finally:
+        loop.close()
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -413,6 +413,28 @@ class HyBiEncodeDecodeTestCase(unittest.TestCase):
 
         self.assertEqual(res, expected)
 
+    def test_encode_hybi_frames(self):
+        bufs = [b'Hello', b'\x01\x02\x03\x04' * 65]
+        res = websocket.WebSocketRequestHandler.encode_hybi_frames(bufs, 0x2)
+        expected = (websocket.WebSocketRequestHandler.encode_hybi(bufs[0], 0x2)[0] +
+                    websocket.WebSocketRequestHandler.encode_hybi(bufs[1], 0x2)[0])
+
+        self.assertEqual(res, expected)
+
+    def test_decode_hybi_memoryview(self):
+        # Two masked frames with payloads of 5 and 6 bytes
+        buf = (b'\x81\x85\x37\xfa\x21\x3d\x7f\x9f\x4d\x51\x58' +
+               b'\x82\x86\x01\x02\x03\x04\x41\x42\x43\x44\x45\x46')
+        view = memoryview(buf)
+        res1 = websocket.WebSocketRequestHandler.decode_hybi(view)
+        self.assertEqual(res1['payload'], b'Hello')
+        self.assertEqual(res1['left'], 12)
+
+        res2 = websocket.WebSocketRequestHandler.decode_hybi(view[-res1['left']:])
+        self.assertEqual(res2['opcode'], 0x2)
+        self.assertEqual(res2['payload'], b'@@@@DD')
+        self.assertEqual(res2['left'], 0)
+
     def test_strict_mode_refuses_unmasked_client_frames(self):
         buf = b'\x81\x05\x48\x65\x6c\x6c\x6f'
         self.assertRaises(websocket.WebSocketRequestHandler.CClose,
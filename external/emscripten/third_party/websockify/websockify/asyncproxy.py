@@ -0,0 +1,466 @@
+'''
+A single process WebSocket to TCP socket proxy built on asyncio.
+Licensed under LGPL version 3 (see docs/LICENSE.LGPL-3)
+
+WebSocketProxy and LibProxyServer handle each client in a process of its
+own. AsyncWebSocketProxy handles all of them in one event loop (epoll,
+kqueue, ... depending on the platform), so that it scales to many
+concurrent clients. Each connection reads at most buffer_size bytes at a
+time from either side and does not read more until the other side has
+taken them, so slow peers are throttled instead of queueing data without
+bound.
+
+The token and auth plugins are used the same way as by WebSocketProxy.
+The engine only proxies WebSocket connections: it has no web server, does
+not answer Flash policy requests, does not wrap commands and does not
+record sessions. TLS is used for all client connections when ssl_only is
+set, as there is no sniffing of the first byte. It requires Python 3.5.2.
+'''
+
+import asyncio, io, logging, os, signal, sys, time
+from base64 import b64encode
+from hashlib import sha1
+from http.client import parse_headers
+from urllib.parse import parse_qs, urlparse
+from websockify import websocket
+from websockify import auth_plugins as auth
+
+WebSocketRequestHandler = websocket.WebSocketRequestHandler
+CClose = WebSocketRequestHandler.CClose
+EClose = websocket.WebSocketServer.EClose
+
+
+class AsyncProxyConnection(object):
+    """
+    One WebSocket client connection and the target it is proxied to.
+    """
+
+    def __init__(self, server, reader, writer, handler_id):
+        self.server = server
+        self.client_reader = reader
+        self.client_writer = writer
+        self.target_reader = None
+        self.target_writer = None
+        self.handler_id = handler_id
+        self.base64 = False
+        # Bytes received from the client that do not form a complete frame yet
+        self.recv_buf = bytearray()
+
+        peer = writer.get_extra_info('peername')
+        self.client_addr = peer[0] if isinstance(peer, tuple) else ''
+
+    def msg(self, msg, *args):
+        self.server.msg("% 3d: " % self.handler_id + msg, *args)
+
+    def vmsg(self, msg, *args):
+        self.server.vmsg("% 3d: " % self.handler_id + msg, *args)
+
+    def print_traffic(self, token="."):
+        if self.server.traffic:
+            sys.stdout.write(token)
+            sys.stdout.flush()
+
+    async def run(self):
+        try:
+            try:
+                if not await self.do_websocket_handshake():
+                    return
+                self.server.ws_connection = True
+                await self.connect_target()
+                await self.do_proxy()
+            except CClose:
+                _, exc, _ = sys.exc_info()
+                self.send_close(exc.args[0], exc.args[1])
+                await self.client_writer.drain()
+        except EClose:
+            _, exc, _ = sys.exc_info()
+            if exc.args[0]:
+                self.msg("%s: %s", self.client_addr, exc.args[0])
+        except auth.AuthenticationError:
+            _, exc, _ = sys.exc_info()
+            self.msg("%s: %s", self.client_addr, exc)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            _, exc, _ = sys.exc_info()
+            self.vmsg("%s: connection lost: %s", self.client_addr, exc)
+        except Exception:
+            _, exc, _ = sys.exc_info()
+            self.msg("handler exception: %s", str(exc))
+            self.server.vmsg("exception", exc_info=True)
+        finally:
+            for writer in (self.target_writer, self.client_writer):
+                if writer:
+                    writer.close()
+
+    #
+    # Handshake
+    #
+
+    def send_response(self, code, message, headers=()):
+        lines = ["HTTP/1.1 %d %s" % (code, message),
+                 "Server: %s" % WebSocketRequestHandler.server_version]
+        lines += ["%s: %s" % header for header in headers]
+        self.client_writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin_1'))
+
+    def get_target(self, target_plugin, path):
+        """
+        Extracts the token from the path and looks up its target with the
+        token plugin, just like ProxyRequestHandler.get_target().
+        """
+        args = parse_qs(urlparse(path)[4]) # 4 is the query from url
+
+        if 'token' not in args or not len(args['token']):
+            raise EClose("Token not present")
+
+        token = args['token'][0].rstrip('\n')
+
+        result_pair = target_plugin.lookup(token)
+
+        if result_pair is not None:
+            return result_pair
+        else:
+            raise EClose("Token '%s' not found" % token)
+
+    async def do_websocket_handshake(self):
+        try:
+            head = await self.client_reader.readuntil(b'\r\n\r\n')
+        except asyncio.LimitOverrunError:
+            raise EClose("request headers too long")
+        except asyncio.IncompleteReadError:
+            raise EClose("ignoring empty handshake")
+
+        request_line, _, rest = head.partition(b'\r\n')
+        try:
+            method, path, _ = request_line.decode('latin_1').split(' ', 2)
+        except ValueError:
+            raise EClose("malformed request line")
+        headers = parse_headers(io.BytesIO(rest))
+
+        if method != 'GET' or (headers.get('upgrade') or '').lower() != 'websocket':
+            self.send_response(405, "Method Not Allowed",
+                               [("Connection", "close"), ("Content-Length", "0")])
+            raise EClose("")
+
+        # Determine the target and check that the connection is authorized
+        self.target_host = self.server.target_host
+        self.target_port = self.server.target_port
+        if self.server.token_plugin:
+            self.target_host, self.target_port = self.get_target(self.server.token_plugin, path)
+
+        if self.server.auth_plugin:
+            try:
+                self.server.auth_plugin.authenticate(
+                    headers=headers, target_host=self.target_host,
+                    target_port=self.target_port)
+            except auth.AuthenticationError:
+                _, ex, _ = sys.exc_info()
+                self.send_response(ex.code, ex.msg or '', list(ex.headers.items()) +
+                                   [("Content-Type", "text/html"), ("Content-Length", "0")])
+                raise
+
+        ver = headers.get('Sec-WebSocket-Version')
+        if ver not in ['7', '8', '13']:
+            self.send_response(400, "Unsupported protocol version %s" % ver,
+                               [("Connection", "close"), ("Content-Length", "0")])
+            raise EClose("unsupported protocol version %s" % ver)
+
+        prot = 'WebSocket-Protocol'
+        protocols = headers.get('Sec-' + prot, headers.get(prot, '')).split(',')
+        protocols = [p.strip() for p in protocols]
+        if 'binary' in protocols:
+            self.base64 = False
+        elif 'base64' in protocols:
+            self.base64 = True
+        else:
+            self.send_response(400, "Client must support 'binary' or 'base64' protocol",
+                               [("Connection", "close"), ("Content-Length", "0")])
+            raise EClose("client supports neither 'binary' nor 'base64'")
+
+        key = headers.get('Sec-WebSocket-Key', '')
+        accept = b64encode(sha1((key + WebSocketRequestHandler.GUID).encode('latin_1')).digest())
+        self.send_response(101, "Switching Protocols", [
+            ("Upgrade", "websocket"),
+            ("Connection", "Upgrade"),
+            ("Sec-WebSocket-Accept", accept.decode('latin_1')),
+            ("Sec-WebSocket-Protocol", "base64" if self.base64 else "binary")])
+
+        self.msg("%s: WebSocket connection, version hybi-%02d, base64: '%s'",
+                 self.client_addr, int(ver), self.base64)
+        if path != '/':
+            self.vmsg("%s: Path: '%s'", self.client_addr, path)
+        return True
+
+    async def connect_target(self):
+        server = self.server
+        if server.unix_target:
+            self.msg("connecting to unix socket: %s", server.unix_target)
+            self.target_reader, self.target_writer = await asyncio.open_unix_connection(
+                server.unix_target, limit=server.buffer_size)
+        else:
+            self.msg("connecting to: %s:%s%s", self.target_host, self.target_port,
+                     " (using SSL)" if server.ssl_target else "")
+            ssl_context = None
+            if server.ssl_target:
+                # Like WebSocketServer.socket(), do not verify the target
+                ssl_context = websocket.ssl.create_default_context()
+                ssl_context.check_hostname = False
+                ssl_context.verify_mode = websocket.ssl.CERT_NONE
+            self.target_reader, self.target_writer = await asyncio.open_connection(
+                self.target_host, int(self.target_port), ssl=ssl_context,
+                limit=server.buffer_size)
+        self.target_writer.transport.set_write_buffer_limits(high=server.buffer_size)
+
+    #
+    # Proxying
+    #
+
+    def send_frame(self, buf, opcode):
+        header = WebSocketRequestHandler.hybi_header(len(buf), opcode)
+        self.client_writer.writelines([header, buf])
+
+    def send_close(self, code=1000, reason=''):
+        reason = websocket.s2b(reason) if isinstance(reason, str) else reason
+        self.send_frame(websocket.pack(">H", code) + reason, 0x08)
+
+    def decode_frames(self):
+        """
+        Decodes the complete frames in recv_buf. Returns the payloads of
+        the data frames, and the close frame if there is one.
+        """
+        bufs = []
+        closed = None
+        view = memoryview(self.recv_buf)
+        consumed = 0
+        while consumed < len(view):
+            frame = WebSocketRequestHandler.decode_hybi(
+                view[consumed:], base64=self.base64, logger=self.server.logger,
+                strict=self.server.strict_mode)
+            if frame['payload'] is None:
+                # Incomplete frame, wait for more data
+                if frame['hlen'] + frame['masked'] * 4 + frame['length'] > self.server.max_frame_size:
+                    raise CClose(1009, "Frame too large")
+                self.print_traffic("}.")
+                break
+            consumed = len(view) - frame['left']
+            opcode = frame['opcode']
+            if opcode == 0x8: # connection close
+                closed = frame
+                break
+            elif opcode == 0x9: # ping
+                self.print_traffic("} ping %s\n" % repr(frame['payload']))
+                if self.server.auto_pong:
+                    self.send_frame(frame['payload'], 0x0A)
+            elif opcode == 0xA: # pong
+                self.print_traffic("} pong %s\n" % repr(frame['payload']))
+            else:
+                self.print_traffic("}")
+                bufs.append(frame['payload'])
+        view.release()
+        del self.recv_buf[:consumed]
+        return bufs, closed
+
+    async def client_to_target(self):
+        while True:
+            buf = await self.client_reader.read(self.server.buffer_size)
+            if not buf:
+                raise CClose(1000, "Client closed abruptly")
+            self.recv_buf += buf
+            bufs, closed = self.decode_frames()
+            if bufs:
+                self.target_writer.writelines(bufs)
+                self.print_traffic(">")
+                # Stop reading from the client while the target is behind
+                await self.target_writer.drain()
+            if closed:
+                self.vmsg("%s:%s: Client closed connection",
+                          self.target_host, self.target_port)
+                raise CClose(closed['close_code'], closed['close_reason'])
+
+    async def target_to_client(self):
+        opcode = 1 if self.base64 else 2
+        while True:
+            buf = await self.target_reader.read(self.server.buffer_size)
+            if not buf:
+                self.vmsg("%s:%s: Target closed connection",
+                          self.target_host, self.target_port)
+                raise CClose(1000, "Target closed")
+            self.print_traffic("{")
+            if self.base64:
+                buf = b64encode(buf)
+            self.send_frame(buf, opcode)
+            self.print_traffic("<")
+            # Stop reading from the target while the client is behind
+            await self.client_writer.drain()
+
+    async def send_heartbeats(self):
+        while True:
+            await asyncio.sleep(self.server.heartbeat)
+            self.send_frame(b'', 0x09)
+
+    async def do_proxy(self):
+        self.client_writer.transport.set_write_buffer_limits(high=self.server.buffer_size)
+        tasks = [asyncio.ensure_future(self.client_to_target()),
+                 asyncio.ensure_future(self.target_to_client())]
+        if self.server.heartbeat:
+            tasks.append(asyncio.ensure_future(self.send_heartbeats()))
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        for task in done:
+            # Raises the CClose (or error) that ended the proxying
+            task.result()
+
+
+class AsyncWebSocketProxy(object):
+    """
+    Proxy traffic to and from WebSockets clients to normal TCP socket
+    server targets, handling all clients in a single process.
+    Accepts the same options as WebSocketProxy; the ones it does not
+    support are ignored with a warning.
+    """
+
+    buffer_size = 65536
+
+    # Largest frame accepted from a client; larger frames close the
+    # connection, which bounds the memory used by each connection
+    max_frame_size = 4 * 1024 * 1024
+
+    log_prefix = websocket.WebSocketServer.log_prefix
+
+    def __init__(self, listen_host='', listen_port=None, target_host=None,
+                 target_port=None, unix_target=None, ssl_target=False,
+                 token_plugin=None, auth_plugin=None, heartbeat=None,
+                 verbose=False, traffic=False, cert='', key='',
+                 ssl_only=False, run_once=False, timeout=0, idle_timeout=0,
+                 auto_pong=False, strict_mode=True, **kwargs):
+        self.listen_host    = listen_host
+        self.listen_port    = listen_port
+        self.target_host    = target_host
+        self.target_port    = target_port
+        self.unix_target    = unix_target
+        self.ssl_target     = ssl_target
+        self.token_plugin   = token_plugin
+        self.auth_plugin    = auth_plugin
+        self.heartbeat      = heartbeat
+        self.verbose        = verbose
+        self.traffic        = traffic
+        self.ssl_only       = ssl_only
+        self.run_once       = run_once
+        self.timeout        = timeout
+        self.idle_timeout   = idle_timeout
+        self.auto_pong      = auto_pong
+        self.strict_mode    = strict_mode
+
+        self.cert = os.path.abspath(cert) if cert else ''
+        self.key = os.path.abspath(key) if key else ''
+
+        self.logger = websocket.WebSocketServer.get_logger()
+        self.launch_time = time.time()
+        self.ws_connection = False
+        self.handler_id = 1
+        self.connections = set()
+        self.server = None
+        self.serving = False
+
+        for arg, value in kwargs.items():
+            if value:
+                self.warn("option %s ignored when using --asyncio", arg)
+
+        if self.ssl_only and not websocket.ssl:
+            raise Exception("No 'ssl' module and SSL-only specified")
+
+        self.msg("WebSocket server settings:")
+        self.msg("  - Listen on %s:%s", self.listen_host, self.listen_port)
+        self.msg("  - Single process asyncio engine")
+        if self.ssl_only:
+            self.msg("  - SSL/TLS only")
+
+    def msg(self, *args, **kwargs):
+        self.logger.log(logging.INFO, *args, **kwargs)
+
+    def vmsg(self, *args, **kwargs):
+        self.logger.log(logging.DEBUG, *args, **kwargs)
+
+    def warn(self, *args, **kwargs):
+        self.logger.log(logging.WARN, *args, **kwargs)
+
+    def started(self):
+        if self.token_plugin:
+            self.msg("  - proxying from %s:%s to targets generated by %s",
+                     self.listen_host, self.listen_port, type(self.token_plugin).__name__)
+        else:
+            self.msg("  - proxying from %s:%s to %s", self.listen_host, self.listen_port,
+                     self.unix_target or "%s:%s" % (self.target_host, self.target_port))
+
+    async def new_client(self, reader, writer):
+        connection = AsyncProxyConnection(self, reader, writer, self.handler_id)
+        self.handler_id += 1
+        self.connections.add(connection)
+        try:
+            await connection.run()
+        finally:
+            self.connections.discard(connection)
+            if self.run_once and self.ws_connection:
+                self.msg('%s: exiting due to --run-once', connection.client_addr)
+                self.terminate()
+
+    def terminate(self):
+        # Server.is_serving() is only available from Python 3.7
+        self.serving = False
+        if self.server:
+            self.server.close()
+
+    async def serve(self, ready=None):
+        """
+        Runs the server in the current event loop until it is terminated.
+        If ready is given, it is called with the listening address once
+        connections are accepted.
+        """
+        ssl_context = None
+        if self.ssl_only:
+            ssl_context = websocket.ssl.create_default_context(websocket.ssl.Purpose.CLIENT_AUTH)
+            ssl_context.load_cert_chain(self.cert, self.key or None)
+
+        self.server = await asyncio.start_server(
+            self.new_client, self.listen_host or None, self.listen_port,
+            ssl=ssl_context, limit=self.buffer_size, backlog=100,
+            reuse_address=True)
+        self.serving = True
+        self.started()
+        if ready:
+            ready(self.server.sockets[0].getsockname())
+
+        last_active_time = self.launch_time
+        try:
+            while self.serving:
+                await asyncio.sleep(1 if not self.run_once else 0.1)
+                now = time.time()
+                if self.timeout and now - self.launch_time > self.timeout:
+                    self.msg('listener exit due to --timeout %s', self.timeout)
+                    break
+                if self.connections:
+                    last_active_time = now
+                elif self.idle_timeout and now - last_active_time > self.idle_timeout:
+                    self.msg('listener exit due to --idle-timeout %s', self.idle_timeout)
+                    break
+        finally:
+            self.vmsg("Closing socket listening at %s:%s",
+                      self.listen_host, self.listen_port)
+            self.serving = False
+            self.server.close()
+            await self.server.wait_closed()
+
+    def start_server(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.terminate)
+            except (NotImplementedError, RuntimeError):
+                pass
+        try:
+            loop.run_until_complete(self.serve())
+        finally:
+            loop.close()
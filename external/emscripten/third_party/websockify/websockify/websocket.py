@@ -118,41 +118,54 @@ class WebSocketRequestHandler(SimpleHTTPRequestHandler):
 
     @staticmethod
     def unmask(buf, hlen, plen):
+        """ Unmask the payload of a frame in buf (which may be a memoryview),
+        with the whole payload XORed in one batch. """
         pstart = hlen + 4
         pend = pstart + plen
+        view = memoryview(buf)
+        mask = view[hlen:pstart]
+        data = view[pstart:pend]
         if numpy:
-            b = c = s2b('')
-            if plen >= 4:
-                dtype=numpy.dtype('<u4')
-                if sys.byteorder == 'big':
-                    dtype = dtype.newbyteorder('>')
-                mask = numpy.frombuffer(buf, dtype, offset=hlen, count=1)
-                data = numpy.frombuffer(buf, dtype, offset=pstart,
-                        count=int(plen / 4))
-                #b = numpy.bitwise_xor(data, mask).data
-                b = numpy.bitwise_xor(data, mask).tostring()
-
-            if plen % 4:
-                #self.msg("Partial unmask")
-                dtype=numpy.dtype('B')
-                if sys.byteorder == 'big':
-                    dtype = dtype.newbyteorder('>')
-                mask = numpy.frombuffer(buf, dtype, offset=hlen,
-                        count=(plen % 4))
-                data = numpy.frombuffer(buf, dtype,
-                        offset=pend - (plen % 4), count=(plen % 4))
-                c = numpy.bitwise_xor(data, mask).tostring()
-            return b + c
+            out = bytearray(plen)
+            words = plen // 4
+            if words:
+                # The mask and the data have the same byte order, so any
+                # 32-bit type works for the XOR
+                numpy.bitwise_xor(numpy.frombuffer(data, numpy.uint32, count=words),
+                                  numpy.frombuffer(mask, numpy.uint32, count=1),
+                                  out=numpy.frombuffer(out, numpy.uint32, count=words))
+            tail = plen % 4
+            if tail:
+                numpy.bitwise_xor(numpy.frombuffer(data[plen - tail:], numpy.uint8),
+                                  numpy.frombuffer(mask[:tail], numpy.uint8),
+                                  out=numpy.frombuffer(out, numpy.uint8)[plen - tail:])
+            return bytes(out)
+        elif sys.hexversion > 0x3000000:
+            # XOR the payload as one big integer against the repeated mask
+            mask = (mask.tobytes() * (plen // 4 + 1))[:plen]
+            res = int.from_bytes(data, 'little') ^ int.from_bytes(mask, 'little')
+            return res.to_bytes(plen, 'little')
         else:
             # Slower fallback
-            mask = buf[hlen:hlen+4]
+            mask = s2a(mask.tobytes())
             data = array.array('B')
-            mask = s2a(mask)
-            data.fromstring(buf[pstart:pend])
+            data.fromstring(view[pstart:pend].tobytes())
             for i in range(len(data)):
                 data[i] ^= mask[i % 4]
             return data.tostring()
 
+    @staticmethod
+    def hybi_header(payload_len, opcode):
+        """ Return the header of a HyBi frame with a payload of
+        payload_len bytes. """
+        b1 = 0x80 | (opcode & 0x0f) # FIN + opcode
+        if payload_len <= 125:
+            return pack('>BB', b1, payload_len)
+        elif payload_len < 65536:
+            return pack('>BBH', b1, 126, payload_len)
+        else:
+            return pack('>BBQ', b1, 127, payload_len)
+
     @staticmethod
     def encode_hybi(buf, opcode, base64=False):
         """ Encode a HyBi style WebSocket frame.
@@ -167,22 +180,29 @@ class WebSocketRequestHandler(SimpleHTTPRequestHandler):
         if base64:
             buf = b64encode(buf)
 
-        b1 = 0x80 | (opcode & 0x0f) # FIN + opcode
-        payload_len = len(buf)
-        if payload_len <= 125:
-            header = pack('>BB', b1, payload_len)
-        elif payload_len > 125 and payload_len < 65536:
-            header = pack('>BBH', b1, 126, payload_len)
-        elif payload_len >= 65536:
-            header = pack('>BBQ', b1, 127, payload_len)
+        header = WebSocketRequestHandler.hybi_header(len(buf), opcode)
 
         #self.msg("Encoded: %s", repr(header + buf))
 
         return header + buf, len(header), 0
 
+    @staticmethod
+    def encode_hybi_frames(bufs, opcode, base64=False):
+        """ Encode a list of buffers as HyBi frames, all joined into a single
+        buffer so that they can be sent with one call. """
+        parts = []
+        for buf in bufs:
+            if base64:
+                buf = b64encode(buf)
+            parts.append(WebSocketRequestHandler.hybi_header(len(buf), opcode))
+            parts.append(buf)
+        return s2b('').join(parts)
+
     @staticmethod
     def decode_hybi(buf, base64=False, logger=None, strict=True):
-        """ Decode HyBi style WebSocket packets.
+        """ Decode HyBi style WebSocket packets. buf may be a memoryview,
+        so that several frames can be decoded from one buffer without
+        copying it.
         Returns:
             {'fin'          : 0_or_1,
              'opcode'       : number,
@@ -252,6 +272,8 @@ class WebSocketRequestHandler(SimpleHTTPRequestHandler):
                 raise WebSocketRequestHandler.CClose(1002, "The client sent an unmasked frame.")
 
             f['payload'] = buf[(f['hlen'] + f['masked'] * 4):full_len]
+            if isinstance(f['payload'], memoryview):
+                f['payload'] = f['payload'].tobytes()
 
         if base64 and f['opcode'] in [1, 2]:
             try:
@@ -309,18 +331,18 @@ class WebSocketRequestHandler(SimpleHTTPRequestHandler):
         tdelta = int(time.time()*1000) - self.start_time
 
         if bufs:
-            for buf in bufs:
-                if self.base64:
-                    encbuf, lenhead, lentail = self.encode_hybi(buf, opcode=1, base64=True)
-                else:
-                    encbuf, lenhead, lentail = self.encode_hybi(buf, opcode=2, base64=False)
+            opcode = 1 if self.base64 else 2
 
-                if self.rec:
+            if self.rec:
+                for buf in bufs:
+                    encbuf, lenhead, lentail = self.encode_hybi(buf, opcode=opcode, base64=self.base64)
                     self.rec.write("%s,\n" %
                             repr("{%s{" % tdelta
                                 + encbuf[lenhead:len(encbuf)-lentail]))
 
-                self.send_parts.append(encbuf)
+            # Encode all the new frames into one buffer, so that they go out
+            # with as few send calls as possible
+            self.send_parts.append(self.encode_hybi_frames(bufs, opcode=opcode, base64=self.base64))
 
         while self.send_parts:
             # Send pending frames
@@ -331,7 +353,7 @@ class WebSocketRequestHandler(SimpleHTTPRequestHandler):
                 self.print_traffic("<")
             else:
                 self.print_traffic("<.")
-                self.send_parts.insert(0, buf[sent:])
+                self.send_parts.insert(0, memoryview(buf)[sent:])
                 break
 
         return len(self.send_parts)
@@ -357,8 +379,11 @@ class WebSocketRequestHandler(SimpleHTTPRequestHandler):
             buf = self.recv_part + buf
             self.recv_part = None
 
-        while buf:
-            frame = self.decode_hybi(buf, base64=self.base64,
+        # Decode the frames through a view of the read buffer, so that
+        # moving past each frame does not copy the rest of the buffer
+        view = memoryview(buf)
+        while len(view):
+            frame = self.decode_hybi(view, base64=self.base64,
                                      logger=self.logger,
                                      strict=self.strict_mode)
             #self.msg("Received buf: %s, frame: %s", repr(buf), frame)
@@ -367,7 +392,7 @@ class WebSocketRequestHandler(SimpleHTTPRequestHandler):
                 # Incomplete/partial frame
                 self.print_traffic("}.")
                 if frame['left'] > 0:
-                    self.recv_part = buf[-frame['left']:]
+                    self.recv_part = view[-frame['left']:].tobytes()
                 break
             else:
                 if frame['opcode'] == 0x8: # connection close
@@ -390,11 +415,11 @@ class WebSocketRequestHandler(SimpleHTTPRequestHandler):
                 start = frame['hlen']
                 end = frame['hlen'] + frame['length']
                 if frame['masked']:
-                    recbuf = WebSocketRequestHandler.unmask(buf, frame['hlen'],
+                    recbuf = WebSocketRequestHandler.unmask(view, frame['hlen'],
                                                    frame['length'])
                 else:
-                    recbuf = buf[frame['hlen']:frame['hlen'] +
-                                               frame['length']]
+                    recbuf = view[frame['hlen']:frame['hlen'] +
+                                                frame['length']].tobytes()
                 self.rec.write("%s,\n" %
                         repr("}%s}" % tdelta + recbuf))
 
@@ -402,9 +427,9 @@ class WebSocketRequestHandler(SimpleHTTPRequestHandler):
             bufs.append(frame['payload'])
 
             if frame['left']:
-                buf = buf[-frame['left']:]
+                view = view[-frame['left']:]
             else:
-                buf = ''
+                break
 
         return bufs, closed
 
@@ -184,13 +184,16 @@ Traffic Legend:
 
 
             if target in outs:
-                # Send queued client data to the target
+                # Send queued client data to the target, all in one call
+                if len(tqueue) > 1:
+                    tqueue = [websocket.s2b('').join(tqueue)]
                 dat = tqueue.pop(0)
                 sent = target.send(dat)
                 if sent == len(dat):
                     self.print_traffic(">")
                 else:
-                    # requeue the remaining data
+                    # requeue the remaining data, as bytes so that it can
+                    # be joined with what is received next on Python 2
                     tqueue.insert(0, dat[sent:])
                     self.print_traffic(".>")
 
@@ -388,6 +391,9 @@ def websockify_init():
             help="prefer IPv6 when resolving source_addr")
     parser.add_option("--libserver", action="store_true",
             help="use Python library SocketServer engine")
+    parser.add_option("--asyncio", action="store_true",
+            help="use single process asyncio engine (Python 3.5.2 or later), "
+            "for many concurrent connections")
     parser.add_option("--target-config", metavar="FILE",
             dest="target_cfg",
             help="Configuration file containing valid targets "
@@ -457,6 +463,12 @@ def websockify_init():
         if len(args) > 2:
             parser.error("Too many arguments")
 
+    if opts.asyncio and opts.libserver:
+        parser.error("--asyncio and --libserver are mutually exclusive")
+
+    if opts.asyncio and sys.hexversion < 0x30502f0:
+        parser.error("--asyncio requires Python 3.5.2 or later")
+
     if not websocket.ssl and opts.ssl_target:
         parser.error("SSL target requested and Python SSL module not loaded.");
 
@@ -515,7 +527,14 @@ def websockify_init():
     # Create and start the WebSockets proxy
     libserver = opts.libserver
     del opts.libserver
-    if libserver:
+    use_asyncio = opts.asyncio
+    del opts.asyncio
+    if use_asyncio:
+        # Handle all connections in a single process
+        from websockify.asyncproxy import AsyncWebSocketProxy
+        server = AsyncWebSocketProxy(**opts.__dict__)
+        server.start_server()
+    elif libserver:
         # Use standard Python SocketServer framework
         server = LibProxyServer(**opts.__dict__)
         server.serve_forever()
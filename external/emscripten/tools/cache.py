@@ -8,6 +8,7 @@ from .toolchain_profiler import ToolchainProfiler
 import os
 import shutil
 import logging
+import zlib
 from . import tempfiles, filelock
 
 logger = logging.getLogger('cache')
@@ -135,6 +136,118 @@ class Cache(object):
     return cachename
 
 
+# Content-addressed cache of compiled object files. Unlike Cache above, entries
+# are keyed by the caller on what went into building them (sources, flags,
+# compiler), so they survive erasing the emscripten cache and can be shared
+# between cache dirs and machines. The local directory is bounded in size by
+# evicting the least recently used objects; an optional read-only shared
+# directory (e.g. a network mount populated by CI) is consulted on local misses.
+# Other kinds of build outputs (e.g. optimized JS chunks) can be stored by
+# giving them a suffix of their own.
+class ObjectCache(object):
+  def __init__(self, dirname, max_size, shared_dirname=None, suffix='.o'):
+    self.dirname = os.path.normpath(dirname)
+    self.max_size = max_size
+    self.shared_dirname = os.path.normpath(shared_dirname) if shared_dirname else None
+    self.suffix = suffix
+    self.hits = 0
+    self.shared_hits = 0
+    self.misses = 0
+
+  def get_entry_path(self, dirname, key):
+    return os.path.join(dirname, key[:2], key + self.suffix)
+
+  @staticmethod
+  def materialize(entry, output):
+    # Hard link the cached object into place when possible, and fall back to a
+    # copy (e.g. when the cache is on another filesystem).
+    if not os.path.exists(entry):
+      return False
+    shared.safe_ensure_dirs(os.path.dirname(os.path.abspath(output)))
+    try:
+      os.link(entry, output)
+    except (OSError, AttributeError):
+      try:
+        shutil.copyfile(entry, output)
+      except (IOError, OSError):
+        # the entry was evicted by another process in the meantime
+        return False
+    return True
+
+  # Places the object cached for the given key at output, and returns whether
+  # that succeeded. Any previous file at output is removed either way, so that
+  # a compiler writing in place can never modify a hard linked cache entry.
+  def get(self, key, output):
+    tempfiles.try_delete(output)
+    entry = self.get_entry_path(self.dirname, key)
+    if self.materialize(entry, output):
+      # Eviction goes by mtime, so touch the entry to mark it recently used.
+      try:
+        os.utime(entry, None)
+      except OSError:
+        pass
+      self.hits += 1
+      return True
+    if self.shared_dirname and self.materialize(self.get_entry_path(self.shared_dirname, key), output):
+      self.shared_hits += 1
+      self.put(key, output)
+      return True
+    self.misses += 1
+    return False
+
+  def put(self, key, path):
+    entry = self.get_entry_path(self.dirname, key)
+    if os.path.exists(entry):
+      return
+    # Write to a temporary name first so that concurrent readers never see a
+    # partially written object.
+    temp = '%s.%d.tmp' % (entry, os.getpid())
+    try:
+      shared.safe_ensure_dirs(os.path.dirname(entry))
+      shutil.copyfile(path, temp)
+    except (IOError, OSError) as e:
+      # an unwritable cache just means a miss next time
+      logger.debug('ObjectCache: cannot store %s: %s' % (entry, e))
+      tempfiles.try_delete(temp)
+      return
+    try:
+      os.rename(temp, entry)
+    except OSError:
+      # another process stored the same entry first
+      tempfiles.try_delete(temp)
+
+  # Removes least recently used entries until the cache fits in max_size bytes.
+  def evict(self):
+    entries = []
+    total_size = 0
+    for root, dirs, files in os.walk(self.dirname):
+      for f in files:
+        if not f.endswith(self.suffix):
+          continue
+        path = os.path.join(root, f)
+        try:
+          st = os.stat(path)
+        except OSError:
+          continue
+        entries.append((st.st_mtime, st.st_size, path))
+        total_size += st.st_size
+    if total_size <= self.max_size:
+      return
+    for mtime, size, path in sorted(entries):
+      logger.debug('ObjectCache: evicting %s' % path)
+      tempfiles.try_delete(path)
+      total_size -= size
+      if total_size <= self.max_size:
+        break
+
+  def stats(self):
+    return {
+      'hits': self.hits,
+      'shared_hits': self.shared_hits,
+      'misses': self.misses,
+    }
+
+
 # Given a set of functions of form (ident, text), and a preferred chunk size,
 # generates a set of chunks for parallel processing and caching.
 def chunkify(funcs, chunk_size, DEBUG=False):
@@ -159,6 +272,24 @@ def chunkify(funcs, chunk_size, DEBUG=False):
     return [''.join(func[1] for func in chunk) for chunk in chunks] # remove function names
 
 
+# Like chunkify, but assigns each function to a chunk by a hash of its name
+# instead of by its position in the input (functions keep their relative order
+# within a chunk). Changing, adding or removing a function then only changes
+# the chunk it is in, and the others can be reused from a cache of processed
+# chunks. The number of chunks is a power of two, so that it only changes when
+# the total size doubles or halves.
+def stable_chunkify(funcs, chunk_size):
+  with ToolchainProfiler.profile_block('stable_chunkify'):
+    total_size = sum(len(func[1]) for func in funcs)
+    num_chunks = 1
+    while num_chunks * chunk_size < total_size and num_chunks < len(funcs):
+      num_chunks *= 2
+    chunks = [[] for i in range(num_chunks)]
+    for func in funcs:
+      chunks[(zlib.crc32(func[0].encode('utf-8')) & 0xffffffff) % num_chunks].append(func[1])
+    return [''.join(chunk) for chunk in chunks if chunk]
+
+
 try:
   from . import shared
 except ImportError:
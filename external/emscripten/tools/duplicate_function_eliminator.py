@@ -18,7 +18,7 @@ sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from tools import shared
 from tools.js_optimizer import DEBUG, temp_files, start_funcs_marker, end_funcs_marker, split_funcs, start_asm_marker, end_asm_marker
-from tools.js_optimizer import MIN_CHUNK_SIZE, MAX_CHUNK_SIZE, NUM_CHUNKS_PER_CORE
+from tools.js_optimizer import MIN_CHUNK_SIZE, MAX_CHUNK_SIZE, NUM_CHUNKS_PER_CORE, CHUNK_CACHE, run_chunk_commands
 
 DUPLICATE_FUNCTION_ELIMINATOR = shared.path_from_root('tools', 'eliminate-duplicate-functions.js')
 
@@ -241,7 +241,12 @@ def run_on_js(filename, gen_hash_info=False):
 
   intended_num_chunks = int(round(cores * NUM_CHUNKS_PER_CORE))
   chunk_size = min(MAX_CHUNK_SIZE, max(MIN_CHUNK_SIZE, total_size / intended_num_chunks))
-  chunks = shared.chunkify(funcs, chunk_size)
+  # the functions are sorted afterwards, so unless that is disabled they can
+  # be grouped into chunks that stay the same between builds
+  if CHUNK_CACHE != '0' and not os.environ.get('EMCC_NO_OPT_SORT'):
+    chunks = shared.stable_chunkify(funcs, chunk_size)
+  else:
+    chunks = shared.chunkify(funcs, chunk_size)
 
   chunks = [chunk for chunk in chunks if len(chunk)]
   if DEBUG and len(chunks):
@@ -268,18 +273,7 @@ def run_on_js(filename, gen_hash_info=False):
     if DEBUG and commands is not None:
       print([' '.join(command if command is not None else '(null)') for command in commands], file=sys.stderr)
 
-    cores = min(cores, len(filenames))
-    if len(chunks) > 1 and cores >= 2:
-      # We can parallelize
-      if DEBUG:
-        print('splitting up js optimization into %d chunks, using %d cores  (total: %.2f MB)' % (len(chunks), cores, total_size / (1024 * 1024.)), file=sys.stderr)
-      pool = shared.Building.get_multiprocessing_pool()
-      filenames = pool.map(run_on_chunk, commands, chunksize=1)
-    else:
-      # We can't parallize, but still break into chunks to avoid uglify/node memory issues
-      if len(chunks) > 1 and DEBUG:
-        print('splitting up js optimization into %d chunks' % (len(chunks)), file=sys.stderr)
-      filenames = [run_on_chunk(command) for command in commands]
+    filenames = run_chunk_commands(commands, filenames, DUPLICATE_FUNCTION_ELIMINATOR, run_on_chunk, cores, total_size)
   else:
     filenames = []
 
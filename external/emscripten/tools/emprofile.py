@@ -44,13 +44,14 @@ def list_files_in_directory(d):
     return []
 
 
-def create_profiling_graph():
-  log_files = [f for f in list_files_in_directory(profiler_logs_path) if 'toolchain_profiler.pid_' in f]
+def list_profiler_logs():
+  return [f for f in list_files_in_directory(profiler_logs_path) if 'toolchain_profiler.pid_' in f]
+
 
+def read_profiler_logs():
+  """Returns the events of all recorded profiling log files, sorted by time."""
   all_results = []
-  if len(log_files):
-    print('Processing ' + str(len(log_files)) + ' profile log files in "' + profiler_logs_path + '"...')
-  for f in log_files:
+  for f in list_profiler_logs():
     try:
       json_data = open(f, 'r').read()
       lines = json_data.split('\n')
@@ -63,12 +64,31 @@ def create_profiling_graph():
       print(str(e), file=sys.stderr)
       print('Failed to parse JSON file "' + f + '"!', file=sys.stderr)
       sys.exit(1)
+
+  all_results.sort(key=lambda x: x['time'])
+
+  # Multiprocessing pool workers are terminated without recording their exit, end them at their last event.
+  last_event = {}
+  exited = set()
+  for r in all_results:
+    last_event[r['pid']] = r
+    if r['op'] == 'exit':
+      exited.add(r['pid'])
+  for pid, r in last_event.items():
+    if pid not in exited:
+      all_results.append({'pid': pid, 'subprocessPid': pid, 'op': 'exit', 'time': r['time'], 'returncode': None})
+  return all_results
+
+
+def create_profiling_graph():
+  log_files = list_profiler_logs()
+  if len(log_files):
+    print('Processing ' + str(len(log_files)) + ' profile log files in "' + profiler_logs_path + '"...')
+  all_results = read_profiler_logs()
   if len(all_results) == 0:
     print('No profiler logs were found in path "' + profiler_logs_path + '". Try setting the environment variable EM_PROFILE_TOOLCHAIN=1 and run some emcc commands, and then rerun "python emprofile.py --graph" again.')
     return
 
-  all_results.sort(key=lambda x: x['time'])
-
   json_file = OUTFILE + '.json'
   open(json_file, 'w').write(json.dumps(all_results, indent=2))
   print('Wrote "' + json_file + '"')
@@ -82,8 +102,9 @@ def create_profiling_graph():
     delete_profiler_logs()
 
 
-if len(sys.argv) < 2:
-  print('''Usage:
+def main():
+  if len(sys.argv) < 2:
+    print('''Usage:
        emprofile.py --reset
          Deletes all previously recorded profiling log files.
 
@@ -94,14 +115,20 @@ Optional parameters:
 
         --outfile=x.html
           Specifies the name of the results file to generate.
+
+See also tools/emprofile_summary.py, which summarizes the recorded profiling log files.
 ''')
-  sys.exit(1)
+    return 1
+
+  if '--reset' in sys.argv:
+    delete_profiler_logs()
+  elif '--graph' in sys.argv:
+    create_profiling_graph()
+  else:
+    print('Unknown command "' + sys.argv[1] + '"!')
+    return 1
+  return 0
 
 
-if '--reset' in sys.argv:
-  delete_profiler_logs()
-elif '--graph' in sys.argv:
-  create_profiling_graph()
-else:
-  print('Unknown command "' + sys.argv[1] + '"!')
-  sys.exit(1)
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+# Copyright 2020 The Emscripten Authors.  All rights reserved.
+# Emscripten is available under two separate licenses, the MIT license and the
+# University of Illinois/NCSA Open Source License.  Both these licenses can be
+# found in the LICENSE file.
+
+"""Summarizes the profiling logs recorded with EM_PROFILE_TOOLCHAIN=1.
+
+Prints the wall and CPU time of each phase of the build (profiling blocks,
+subprocesses and tool processes, aggregated by name), the critical path through
+the build, and how many cores were busy over time. The same can be written as a
+Chrome trace, for chrome://tracing or https://ui.perfetto.dev, and a run can be
+compared against a baseline run to find regressions:
+
+  tools/emprofile.py --reset
+  EM_PROFILE_TOOLCHAIN=1 emcc ...
+  tools/emprofile_summary.py --chrome-trace=before.json
+  tools/emprofile.py --reset
+  (make changes) EM_PROFILE_TOOLCHAIN=1 emcc ...
+  tools/emprofile_summary.py --compare=before.json
+
+CPU times are those of the profiled processes and of the subprocesses they
+waited for, as reported by os.times(). They are approximate when a process runs
+several subprocesses at once.
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+from collections import OrderedDict
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools import emprofile
+
+# Number of time slices of the core utilization timeline.
+TIMELINE_SLICES = 40
+
+
+class Node(object):
+  """An interval of the build: a process, a multiprocessing pool worker, a profiling block or a subprocess."""
+  def __init__(self, kind, name, pid, start, parent):
+    self.kind = kind
+    self.name = name
+    self.pid = pid
+    self.start = start
+    self.end = None
+    # CPU time used during the interval, including the subprocesses waited for.
+    self.cpu = 0.0
+    self.cmdline = None
+    self.children = []
+    # Pool worker tasks that ran while this block of the parent process was active, see adopt_pool_tasks().
+    self.adopted = []
+    self.parent = None
+    if parent:
+      self.set_parent(parent)
+
+  def set_parent(self, parent):
+    self.parent = parent
+    parent.children.append(self)
+
+  @property
+  def wall(self):
+    return self.end - self.start
+
+  def self_cpu(self):
+    # Pool workers are not waited for, so their CPU time is not part of their parent's.
+    return max(0.0, self.cpu - sum(c.cpu for c in self.children if c.kind != 'worker'))
+
+  def walk(self):
+    yield self
+    for c in self.children:
+      for n in c.walk():
+        yield n
+
+
+def tool_name(cmdline):
+  """Returns a short name for the tool that the given command line runs."""
+  if not cmdline:
+    return '?'
+  name = os.path.basename(cmdline[0])
+  for ext in ('.exe', '.bat'):
+    if name.lower().endswith(ext):
+      name = name[:-len(ext)]
+  # Name python and node scripts after the script, not the interpreter.
+  if name.lower().startswith(('python', 'node')):
+    for arg in cmdline[1:]:
+      if arg in ('-c', '-e'):
+        return name + ' ' + arg
+      if not arg.startswith('-'):
+        return os.path.basename(arg)
+  return name
+
+
+def build_tree(events):
+  """Builds the trees of intervals from the profiling events. Returns the root nodes."""
+  events_by_pid = OrderedDict()
+  for e in events:
+    events_by_pid.setdefault(e['pid'], []).append(e)
+
+  processes = OrderedDict()
+  spawns = {}
+  for pid, pid_events in events_by_pid.items():
+    first = pid_events[0]
+    root = Node('process', '?', pid, first['time'], None)
+    stack = [root]
+    running = {}
+    # The CPU time of the subprocesses that have finished, as of the last one. Other children that the process waited
+    # for, such as the pool workers at exit, are left out since they have tracks of their own.
+    reaped_cpu = first.get('childCpu', 0)
+    # Like blocks, the process counts from its first event, which leaves out the interpreter startup before it.
+    root.cpu = -(first.get('cpu', 0) + reaped_cpu)
+    for e in pid_events:
+      op = e['op']
+      if op == 'finish':
+        sub = running.pop(e['targetPid'], None)
+        if sub:
+          sub.end = e['time']
+          # The children reaped since the previous one finished are attributed to this one.
+          sub.cpu = max(0.0, e.get('childCpu', 0) - reaped_cpu)
+        reaped_cpu = e.get('childCpu', 0)
+      cpu = e.get('cpu', 0) + reaped_cpu
+      if op == 'start':
+        root.kind = 'worker' if e.get('poolWorker') else 'process'
+        root.name = 'pool worker' if e.get('poolWorker') else tool_name(e.get('cmdLine'))
+        root.cmdline = e.get('cmdLine')
+        root.parent_pid = e.get('parentPid')
+        root.cores = e.get('cores')
+      elif op == 'enterBlock':
+        block = Node('block', e['name'], pid, e['time'], stack[-1])
+        block.cpu = -cpu
+        stack.append(block)
+      elif op == 'exitBlock':
+        for i in range(len(stack) - 1, 0, -1):
+          if stack[i].name == e['name']:
+            block = stack.pop(i)
+            block.end = e['time']
+            block.cpu += cpu
+            break
+      elif op == 'spawn':
+        sub = Node('subprocess', tool_name(e.get('cmdLine')), pid, e['time'], stack[-1])
+        sub.cmdline = e.get('cmdLine')
+        running[e['targetPid']] = sub
+        spawns[e['targetPid']] = sub
+      if op == 'exit' or e is pid_events[-1]:
+        # Close what is still open at the exit, or at the last event of processes without one.
+        for block in stack[1:]:
+          block.end = e['time']
+          block.cpu += cpu
+        for sub in running.values():
+          sub.end = e['time']
+        root.end = e['time']
+        root.cpu = max(0.0, root.cpu + cpu)
+        break
+    processes[pid] = root
+
+  roots = []
+  for pid, root in processes.items():
+    if pid in spawns:
+      root.set_parent(spawns[pid])
+    elif root.kind == 'worker' and getattr(root, 'parent_pid', None) in processes:
+      root.set_parent(processes[root.parent_pid])
+    else:
+      roots.append(root)
+  return roots
+
+
+def phase_name(node):
+  if node.kind == 'block':
+    # Aggregate per-file blocks such as "compile foo.c" as one phase.
+    words = node.name.split(' ', 1)
+    if len(words) == 2 and (os.path.splitext(words[1])[1] or '/' in words[1] or '\\' in words[1]):
+      return words[0]
+    return node.name
+  if node.kind == 'subprocess':
+    return 'run ' + node.name
+  return node.name
+
+
+def aggregate_phases(roots):
+  phases = {}
+  for root in roots:
+    for node in root.walk():
+      name = phase_name(node)
+      p = phases.get(name)
+      if p is None:
+        p = phases[name] = {'name': name, 'count': 0, 'wall': 0.0, 'cpu': 0.0, 'max': 0.0}
+      p['count'] += 1
+      p['wall'] += node.wall
+      p['cpu'] += node.cpu
+      p['max'] = max(p['max'], node.wall)
+  return sorted(phases.values(), key=lambda p: -p['wall'])
+
+
+def adopt_pool_tasks(roots):
+  """For the critical path, the tasks run by a pool worker belong to the block of the parent process that was
+  waiting for the pool when they ran, instead of to the long lived worker."""
+  for root in roots:
+    for node in list(root.walk()):
+      if node.kind != 'worker' or not node.parent:
+        continue
+      for task in node.children:
+        owner = node.parent
+        found = True
+        while found:
+          found = False
+          for c in owner.children:
+            if c.kind == 'block' and c.start <= task.start and task.end <= c.end:
+              owner = c
+              found = True
+              break
+        owner.adopted.append(task)
+
+
+def critical_path(node, depth=0, out=None):
+  """Returns the chain of intervals that the end of the given one waited for, as a list of (depth, node). Starting
+  from the end of the interval, repeatedly takes the child that finished last before that point."""
+  if out is None:
+    out = []
+  out.append((depth, node))
+  candidates = [c for c in node.children + node.adopted if c.kind != 'worker']
+  chain = []
+  t = node.end
+  while True:
+    done = [c for c in candidates if c.end <= t + 1e-6 and c.start >= node.start - 1e-6]
+    if not done:
+      break
+    last = max(done, key=lambda c: (c.end, c.wall))
+    chain.append(last)
+    t = last.start
+    candidates = [c for c in done if c is not last]
+  for c in reversed(chain):
+    critical_path(c, depth + 1, out)
+  return out
+
+
+def core_utilization(roots, start, end):
+  """Returns the CPU time used in each slice of the build, spreading the CPU time of each interval evenly over it."""
+  slices = [0.0] * TIMELINE_SLICES
+  width = max(end - start, 1e-6) / TIMELINE_SLICES
+  for root in roots:
+    for node in root.walk():
+      cpu = node.self_cpu()
+      if cpu <= 0:
+        continue
+      first = min(int((node.start - start) / width), TIMELINE_SLICES - 1)
+      last = min(int((node.end - start) / width), TIMELINE_SLICES - 1)
+      if node.wall <= 0:
+        slices[first] += cpu
+        continue
+      for i in range(first, last + 1):
+        overlap = min(node.end, start + (i + 1) * width) - max(node.start, start + i * width)
+        slices[i] += cpu * max(overlap, 0) / node.wall
+  return [cpu / width for cpu in slices]
+
+
+def summarize(events):
+  roots = build_tree(events)
+  if not roots:
+    return None, None
+  adopt_pool_tasks(roots)
+  start = min(r.start for r in roots)
+  end = max(r.end for r in roots)
+  if len(roots) == 1:
+    top = roots[0]
+  else:
+    # Several independent tool invocations, e.g. from a build system.
+    top = Node('process', 'all processes', 0, start, None)
+    top.end = end
+    top.children = roots
+  cores = max([getattr(r, 'cores', None) or 0 for r in roots] + [0]) or multiprocessing.cpu_count()
+  cpu = sum(n.self_cpu() for r in roots for n in r.walk())
+  summary = {
+    'start': start,
+    'elapsed': end - start,
+    'cpu': cpu,
+    'cores': cores,
+    'phases': aggregate_phases(roots),
+    'criticalPath': [{'name': phase_name(n) if n.kind != 'block' else n.name, 'depth': depth, 'start': n.start - start,
+                      'wall': n.wall, 'cpu': n.cpu} for depth, n in critical_path(top)],
+    # The CPU times are only sampled at the events, so short slices may seem busier than the machine can be.
+    'coresBusy': [min(busy, cores) for busy in core_utilization(roots, start, end)],
+  }
+  return summary, roots
+
+
+def print_summary(summary, top):
+  print('Elapsed %.2f s, CPU %.2f s on %d cores: %.2f cores busy on average (%.0f%% utilization)' % (
+        summary['elapsed'], summary['cpu'], summary['cores'], summary['cpu'] / max(summary['elapsed'], 1e-6),
+        100.0 * summary['cpu'] / max(summary['elapsed'], 1e-6) / summary['cores']))
+
+  print('\nPhases (total over all instances, nested phases are included in their parents):')
+  print('%10s %10s %10s %7s  %s' % ('wall (s)', 'cpu (s)', 'max (s)', 'count', 'phase'))
+  for p in summary['phases'][:top]:
+    print('%10.3f %10.3f %10.3f %7d  %s' % (p['wall'], p['cpu'], p['max'], p['count'], p['name']))
+  if len(summary['phases']) > top:
+    print('%d more phases not shown, see --top' % (len(summary['phases']) - top))
+
+  print('\nCritical path:')
+  print('%10s %10s %7s  %s' % ('start (s)', 'wall (s)', '%', 'interval'))
+  for item in summary['criticalPath']:
+    print('%10.3f %10.3f %6.1f%%  %s%s' % (item['start'], item['wall'], 100.0 * item['wall'] / max(summary['elapsed'], 1e-6),
+                                           '  ' * item['depth'], item['name']))
+
+  print('\nCores busy over time:')
+  busy = summary['coresBusy']
+  width = summary['elapsed'] / len(busy)
+  for i, cores in enumerate(busy):
+    print('%8.2f s %6.2f  %s' % (i * width, cores, '#' * min(int(round(cores / summary['cores'] * 50)), 50)))
+
+
+def compare(base, current, threshold, min_delta):
+  """Prints the phases whose wall time changed, and returns the number of regressions."""
+  base_phases = dict((p['name'], p) for p in base['phases'])
+  current_phases = dict((p['name'], p) for p in current['phases'])
+  rows = [('total elapsed', base['elapsed'], current['elapsed']), ('total cpu', base['cpu'], current['cpu'])]
+  for name in set(base_phases) | set(current_phases):
+    rows.append((name, base_phases[name]['wall'] if name in base_phases else 0.0,
+                 current_phases[name]['wall'] if name in current_phases else 0.0))
+  rows[2:] = sorted(rows[2:], key=lambda r: -abs(r[2] - r[1]))
+
+  regressions = 0
+  print('\nComparison against the baseline (wall time, CPU time for "total cpu"):')
+  print('%10s %10s %10s %8s  %s' % ('base (s)', 'now (s)', 'delta (s)', 'delta', 'phase'))
+  for name, before, after in rows:
+    delta = after - before
+    if abs(delta) < min_delta and name not in ('total elapsed', 'total cpu'):
+      continue
+    percent = (100.0 * delta / before) if before else float('inf')
+    regression = delta >= min_delta and percent > threshold
+    if regression:
+      regressions += 1
+    print('%10.3f %10.3f %+10.3f %8s  %s%s' % (before, after, delta, ('%+.1f%%' % percent) if before else 'new',
+                                               name, '  <-- regression' if regression else ''))
+  print('%d phases regressed by more than %g%% and %g s' % (regressions, threshold, min_delta))
+  return regressions
+
+
+def chrome_trace(roots, summary):
+  """Returns the build as a Chrome trace event list: a track for each process and pool worker, with its profiling
+  blocks, and its subprocesses on lanes underneath."""
+  t0 = summary['start']
+  trace = []
+
+  def us(t):
+    return int(round((t - t0) * 1000000))
+
+  def add_track(root, label):
+    trace.append({'ph': 'M', 'name': 'process_name', 'pid': root.pid, 'tid': 0, 'args': {'name': label}})
+    trace.append({'ph': 'M', 'name': 'thread_name', 'pid': root.pid, 'tid': 0, 'args': {'name': 'python'}})
+    lanes = []
+
+    def add(node):
+      args = {'cpu': round(node.cpu, 3)}
+      if node.cmdline:
+        args['cmdLine'] = ' '.join(node.cmdline)
+      tid = 0
+      if node.kind == 'subprocess':
+        # Subprocesses may overlap each other, give each a lane where nothing else is running.
+        for tid, lane_end in enumerate(lanes, 1):
+          if lane_end <= node.start:
+            break
+        else:
+          lanes.append(0)
+          tid = len(lanes)
+          trace.append({'ph': 'M', 'name': 'thread_name', 'pid': root.pid, 'tid': tid, 'args': {'name': 'subprocesses'}})
+        lanes[tid - 1] = node.end
+      trace.append({'ph': 'X', 'name': node.name, 'cat': node.kind, 'pid': root.pid, 'tid': tid,
+                    'ts': us(node.start), 'dur': max(us(node.end) - us(node.start), 1), 'args': args})
+      for c in sorted(node.children, key=lambda c: c.start):
+        if c.kind in ('process', 'worker'):
+          add_track(c, '%s (pid %s, %s of %s)' % (c.name, c.pid, 'pool worker' if c.kind == 'worker' else 'spawned by', node.pid))
+        else:
+          add(c)
+
+    add(root)
+
+  for root in roots:
+    add_track(root, '%s (pid %s)' % (root.name, root.pid))
+
+  # The summary gets a track of its own, with the critical path and the core utilization.
+  trace.append({'ph': 'M', 'name': 'process_name', 'pid': 0, 'tid': 0, 'args': {'name': 'summary'}})
+  trace.append({'ph': 'M', 'name': 'process_sort_index', 'pid': 0, 'tid': 0, 'args': {'sort_index': -1}})
+  trace.append({'ph': 'M', 'name': 'thread_name', 'pid': 0, 'tid': 1, 'args': {'name': 'critical path'}})
+  for item in summary['criticalPath']:
+    trace.append({'ph': 'X', 'name': item['name'], 'cat': 'critical path', 'pid': 0, 'tid': 1,
+                  'ts': us(t0 + item['start']), 'dur': max(us(t0 + item['start'] + item['wall']) - us(t0 + item['start']), 1),
+                  'args': {'cpu': round(item['cpu'], 3)}})
+  width = summary['elapsed'] / len(summary['coresBusy'])
+  for i, cores in enumerate(summary['coresBusy']):
+    trace.append({'ph': 'C', 'name': 'cores busy', 'pid': 0, 'tid': 0, 'ts': us(t0 + i * width), 'args': {'cores': round(cores, 2)}})
+  return trace
+
+
+def load_summary(filename):
+  """Loads the summary of a run from a Chrome trace written by this tool, or from the results .json of emprofile.py --graph."""
+  with open(filename) as f:
+    data = json.load(f)
+  if isinstance(data, dict) and 'emprofileSummary' in data:
+    return data['emprofileSummary'], None
+  return summarize(data)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('input', nargs='?',
+                      help='the results .json of "emprofile.py --graph", or a trace written by --chrome-trace. By default, the logs recorded since the last "emprofile.py --reset" are read.')
+  parser.add_argument('--chrome-trace', help='write the build and its summary as a Chrome trace to this file')
+  parser.add_argument('--compare', metavar='BASELINE', help='compare the phases against a baseline run, given like the input')
+  parser.add_argument('--threshold', type=float, default=10, help='percentage by which a phase must get slower to count as a regression (default: 10)')
+  parser.add_argument('--min-delta', type=float, default=0.1, help='seconds by which a phase must get slower to count as a regression (default: 0.1)')
+  parser.add_argument('--top', type=int, default=30, help='number of phases to print (default: 30)')
+  args = parser.parse_args()
+
+  if args.input:
+    summary, roots = load_summary(args.input)
+  else:
+    summary, roots = summarize(emprofile.read_profiler_logs())
+  if summary is None:
+    print('No profiling events found. Run emcc with the environment variable EM_PROFILE_TOOLCHAIN=1 first.', file=sys.stderr)
+    return 1
+
+  if args.chrome_trace and roots is None:
+    print('A Chrome trace can only be written from the profiling logs, or from the results .json of "emprofile.py --graph".', file=sys.stderr)
+    return 1
+
+  print_summary(summary, args.top)
+
+  if args.chrome_trace:
+    with open(args.chrome_trace, 'w') as f:
+      json.dump({'traceEvents': chrome_trace(roots, summary), 'displayTimeUnit': 'ms', 'emprofileSummary': summary}, f)
+    print('\nWrote "%s"' % args.chrome_trace)
+
+  if args.compare:
+    base, _ = load_summary(args.compare)
+    if base is None:
+      print('No profiling events found in "%s".' % args.compare, file=sys.stderr)
+      return 1
+    compare(base, summary, args.threshold, args.min_delta)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
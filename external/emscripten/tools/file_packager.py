@@ -22,7 +22,7 @@ data downloads.
 
 Usage:
 
-  file_packager.py TARGET [--preload A [B..]] [--embed C [D..]] [--exclude E [F..]]] [--js-output=OUTPUT.js] [--no-force] [--use-preload-cache] [--indexedDB-name=EM_PRELOAD_CACHE] [--no-heap-copy] [--separate-metadata] [--lz4] [--use-preload-plugins]
+  file_packager.py TARGET [--preload A [B..]] [--embed C [D..]] [--exclude E [F..]]] [--js-output=OUTPUT.js] [--no-force] [--use-preload-cache] [--indexedDB-name=EM_PRELOAD_CACHE] [--no-heap-copy] [--separate-metadata] [--lz4] [--use-preload-plugins] [--incremental]
 
   --preload  ,
   --embed    See emcc --help for more details on those options.
@@ -54,6 +54,9 @@ Usage:
   --use-preload-plugins Tells the file packager to run preload plugins on the files as they are loaded. This performs tasks like decoding images
                         and audio using the browser's codecs.
 
+  --incremental Keeps a manifest of the packaged files (size, mtime and content hash) next to TARGET, and on later runs only rewrites the
+                parts of TARGET whose files changed or moved, instead of repacking everything. Not applicable together with --lz4.
+
 Notes:
 
   * The file packager generates unix-style file paths. So if you are on windows and a file is accessed at
@@ -67,6 +70,8 @@ import shutil
 import random
 import uuid
 import ctypes
+import base64
+import hashlib
 
 sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
@@ -82,7 +87,7 @@ import fnmatch
 import json
 
 if len(sys.argv) == 1:
-  print('''Usage: file_packager.py TARGET [--preload A [B..]] [--embed C [D..]] [--exclude E [F..]]] [--js-output=OUTPUT.js] [--no-force] [--use-preload-cache] [--indexedDB-name=EM_PRELOAD_CACHE] [--no-heap-copy] [--separate-metadata] [--lz4] [--use-preload-plugins]
+  print('''Usage: file_packager.py TARGET [--preload A [B..]] [--embed C [D..]] [--exclude E [F..]]] [--js-output=OUTPUT.js] [--no-force] [--use-preload-cache] [--indexedDB-name=EM_PRELOAD_CACHE] [--no-heap-copy] [--separate-metadata] [--lz4] [--use-preload-plugins] [--incremental]
 See the source for more details.''')
   sys.exit(0)
 
@@ -96,6 +101,11 @@ AUDIO_MIMETYPES = {'ogg': 'audio/ogg', 'wav': 'audio/wav', 'mp3': 'audio/mpeg'}
 
 DDS_HEADER_SIZE = 128
 
+# Size of the chunks in which file contents are streamed, so that no file is
+# ever held in memory as a whole. A multiple of 3, so that base64 encoded
+# chunks can be concatenated.
+COPY_CHUNK_SIZE = 3 * 1024 * 1024
+
 # Set to 1 to randomize file order and add some padding,
 # to work around silly av false positives
 AV_WORKAROUND = 0
@@ -132,6 +142,89 @@ def should_ignore(fullname):
   return False
 
 
+def copy_file_data(data, srcpath, offset, size):
+  """Writes the contents of srcpath at the given offset of the (unbuffered)
+  data file. Uses sendfile() where it can copy between regular files, which
+  avoids passing the contents through Python at all."""
+  data.seek(offset)
+  with open(srcpath, 'rb') as f:
+    if sys.platform.startswith('linux') and hasattr(os, 'sendfile'):
+      copied = 0
+      while copied < size:
+        sent = os.sendfile(data.fileno(), f.fileno(), copied, size - copied)
+        if sent == 0:
+          break
+        copied += sent
+    else:
+      shutil.copyfileobj(f, data, COPY_CHUNK_SIZE)
+
+
+def hash_file(srcpath):
+  h = hashlib.sha256()
+  with open(srcpath, 'rb') as f:
+    for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+def base64_encode_file(srcpath):
+  with open(srcpath, 'rb') as f:
+    return ''.join(base64.b64encode(chunk).decode('ascii') for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b''))
+
+
+def load_manifest(manifest_path, data_target):
+  """Returns the list of files recorded by the last incremental run, or an
+  empty list if there is none or it doesn't describe the current TARGET."""
+  if not os.path.isfile(manifest_path) or not os.path.isfile(data_target):
+    return []
+  try:
+    with open(manifest_path) as f:
+      manifest = json.load(f)
+  except ValueError:
+    return []
+  if manifest.get('size') != os.path.getsize(data_target) or manifest.get('av_workaround') != AV_WORKAROUND:
+    return []
+  return manifest['files']
+
+
+def write_data_target(data_files, data_target, incremental):
+  """Bundles the files into data_target, after data_start/data_end
+  have been assigned to them. In incremental mode, files that sit at the same
+  offset as in the previous run and didn't change are left alone."""
+  manifest_path = data_target + '.manifest'
+  previous = load_manifest(manifest_path, data_target) if incremental else []
+  previous = dict((entry['srcpath'], entry) for entry in previous)
+  total = data_files[-1]['data_end'] + (1 if AV_WORKAROUND else 0) if data_files else 0
+  entries = []
+  written = 0
+  with open(data_target, 'r+b' if previous else 'wb', buffering=0) as data:
+    for file_ in data_files:
+      st = os.stat(file_['srcpath'])
+      size = file_['data_end'] - file_['data_start']
+      entry = {'srcpath': file_['srcpath'], 'start': file_['data_start'], 'size': size, 'mtime': st.st_mtime}
+      old = previous.get(file_['srcpath'])
+      if old and old['start'] == entry['start'] and old['size'] == size:
+        # Only hash files that were touched since the last run.
+        entry['sha256'] = old['sha256'] if old['mtime'] == st.st_mtime else hash_file(file_['srcpath'])
+        if entry['sha256'] == old['sha256']:
+          entries.append(entry)
+          continue
+      copy_file_data(data, file_['srcpath'], file_['data_start'], size)
+      if AV_WORKAROUND:
+        data.write(b'\x00')
+      if incremental and 'sha256' not in entry:
+        entry['sha256'] = hash_file(file_['srcpath'])
+      entries.append(entry)
+      written += size
+    data.truncate(total)
+
+  if incremental:
+    if DEBUG:
+      print('file packager: rewrote %d of %d bytes of %s' % (written, total, data_target), file=sys.stderr)
+    with open(manifest_path, 'w') as f:
+      json.dump({'size': total, 'av_workaround': AV_WORKAROUND, 'files': entries}, f)
+
+
 def add(mode, rootpathsrc, rootpathdst):
   """Expand directories into individual files
 
@@ -191,6 +284,7 @@ def main():
   separate_metadata = False
   lz4 = False
   use_preload_plugins = False
+  incremental = False
 
   for arg in sys.argv[2:]:
     if arg == '--preload':
@@ -221,6 +315,9 @@ def main():
     elif arg == '--use-preload-plugins':
       use_preload_plugins = True
       leading = ''
+    elif arg == '--incremental':
+      incremental = True
+      leading = ''
     elif arg.startswith('--js-output'):
       jsoutput = arg.split('=', 1)[1] if '=' in arg else None
       leading = ''
@@ -268,6 +365,9 @@ def main():
     assert not separate_metadata, (
        'cannot separate-metadata without both --preloaded files '
        'and a specified --js-output')
+  # The data target is rewritten by the LZ4 compressor, so there is nothing
+  # left to update incrementally.
+  assert not (incremental and lz4), 'cannot use --incremental with --lz4'
 
   if not from_emcc:
     print('Remember to build the main file with  -s FORCE_FILESYSTEM=1  '
@@ -393,16 +493,15 @@ def main():
     # Bundle all datafiles into one archive. Avoids doing lots of simultaneous
     # XHRs which has overhead.
     start = 0
-    with open(data_target, 'wb') as data:
-      for file_ in data_files:
-        file_['data_start'] = start
-        with open(file_['srcpath'], 'rb') as f:
-          curr = f.read()
-        file_['data_end'] = start + len(curr)
-        if AV_WORKAROUND:
-            curr += '\x00'
-        start += len(curr)
-        data.write(curr)
+    # Embedded files are bundled too, even though only the preloaded ones are
+    # read from the archive.
+    for file_ in data_files:
+      file_['data_start'] = start
+      file_['data_end'] = start + os.path.getsize(file_['srcpath'])
+      start = file_['data_end']
+      if AV_WORKAROUND:
+        start += 1
+    write_data_target(data_files, data_target, incremental)
 
     # TODO: sha256sum on data_target
     if start > 256 * 1024 * 1024:
@@ -463,23 +562,33 @@ def main():
   ''' if not lz4 else '')
 
   counter = 0
+  has_embedded = False
   for file_ in data_files:
     filename = file_['dstpath']
     dirname = os.path.dirname(filename)
     basename = os.path.basename(filename)
     if file_['mode'] == 'embed':
       # Embed
-      data = list(bytearray(open(file_['srcpath'], 'rb').read()))
-      code += '''var fileData%d = [];\n''' % counter
-      if data:
-        parts = []
-        chunk_size = 10240
-        start = 0
-        while start < len(data):
-          parts.append('''fileData%d.push.apply(fileData%d, %s);\n'''
-                       % (counter, counter, str(data[start:start + chunk_size])))
-          start += chunk_size
-        code += ''.join(parts)
+      if not has_embedded:
+        code += '''
+      function decodeBase64(data) {
+        var chars = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/';
+        var lookup = new Uint8Array(256);
+        for (var i = 0; i < chars.length; ++i) lookup[chars.charCodeAt(i)] = i;
+        var padding = data.charAt(data.length - 2) === '=' ? 2 : (data.charAt(data.length - 1) === '=' ? 1 : 0);
+        var bytes = new Uint8Array(data.length / 4 * 3 - padding);
+        for (var i = 0, j = 0; i < data.length; i += 4) {
+          var n = (lookup[data.charCodeAt(i)] << 18) | (lookup[data.charCodeAt(i + 1)] << 12) | (lookup[data.charCodeAt(i + 2)] << 6) | lookup[data.charCodeAt(i + 3)];
+          bytes[j++] = n >> 16;
+          if (j < bytes.length) bytes[j++] = (n >> 8) & 255;
+          if (j < bytes.length) bytes[j++] = n & 255;
+        }
+        return bytes;
+      }
+'''
+        has_embedded = True
+      code += ('''var fileData%d = decodeBase64('%s');\n'''
+               % (counter, base64_encode_file(file_['srcpath'])))
       code += ('''Module['FS_createDataFile']('%s', '%s', fileData%d, true, true, false);\n'''
                % (dirname, basename, counter))
       counter += 1
@@ -10,6 +10,7 @@ import subprocess
 import re
 import json
 import shutil
+import hashlib
 import logging
 
 __rootpath__ = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
@@ -24,6 +25,7 @@ try:
 except ImportError:
   # Python 2 circular import compatibility
   import shared
+from tools.cache import ObjectCache
 
 configuration = shared.configuration
 temp_files = configuration.get_temp_files()
@@ -42,6 +44,14 @@ NUM_CHUNKS_PER_CORE = 3
 MIN_CHUNK_SIZE = int(os.environ.get('EMCC_JSOPT_MIN_CHUNK_SIZE') or 512 * 1024) # configuring this is just for debugging purposes
 MAX_CHUNK_SIZE = int(os.environ.get('EMCC_JSOPT_MAX_CHUNK_SIZE') or 5 * 1024 * 1024)
 
+# Optimized chunks are cached on disk, keyed on the chunk contents, the
+# optimizer command and the optimizer itself (see get_chunk_cache_key), so that
+# relinking only needs to optimize the chunks that changed. Setting
+# EMCC_JSOPT_CACHE=0 bypasses that cache.
+CHUNK_CACHE = os.environ.get('EMCC_JSOPT_CACHE', '1')
+# The size of the chunk cache in bytes, least recently used chunks are evicted.
+CHUNK_CACHE_MAX_SIZE = int(os.environ.get('EMCC_JSOPT_CACHE_MAX_SIZE') or 512 * 1024 * 1024)
+
 WINDOWS = sys.platform.startswith('win')
 
 DEBUG = os.environ.get('EMCC_DEBUG')
@@ -316,6 +326,95 @@ def run_on_chunk(command):
     raise Exception()
 
 
+def get_chunk_cache():
+  if CHUNK_CACHE == '0':
+    return None
+  return ObjectCache(shared.Cache.get_path('jsopt_chunks'), CHUNK_CACHE_MAX_SIZE, suffix='.js')
+
+
+def get_tool_digest(tool):
+  """Returns a digest of an optimizer tool: the native optimizer executable, or
+  a JS tool together with the JS it loads."""
+  if tool not in get_tool_digest.digests:
+    h = hashlib.sha256()
+    h.update(shared.EMSCRIPTEN_VERSION.encode('utf-8'))
+    paths = [tool]
+    if tool.endswith('.js'):
+      paths.append(path_from_root('src', 'utility.js'))
+      for root, dirs, files in os.walk(path_from_root('third_party', 'uglify-js')):
+        dirs.sort()
+        paths += [os.path.join(root, f) for f in sorted(files) if f.endswith('.js')]
+    for path in paths:
+      with open(path, 'rb') as f:
+        h.update(f.read())
+    get_tool_digest.digests[tool] = h.hexdigest()
+  return get_tool_digest.digests[tool]
+
+
+get_tool_digest.digests = {}
+
+
+def get_chunk_cache_key(command, filename, tool):
+  """Returns a key for everything that the output of an optimizer command
+  depends on: the chunk file it runs on (which contains the extra info), the
+  rest of the command line, and the optimizer tool."""
+  h = hashlib.sha256()
+  h.update(get_tool_digest(tool).encode('utf-8'))
+  for arg in command:
+    if arg == filename:
+      with open(filename, 'rb') as f:
+        h.update(f.read())
+    else:
+      h.update(arg.encode('utf-8'))
+    h.update(b'\0')
+  return h.hexdigest()
+
+
+def run_chunk_commands(commands, filenames, tool, runner, cores, total_size):
+  """Runs the optimizer commands, one per chunk file in filenames, and returns
+  their output files. Chunks that were optimized before are taken from the
+  chunk cache, and only the others are run, in parallel if possible."""
+  outputs = [None] * len(commands)
+  chunk_cache = get_chunk_cache()
+  if chunk_cache:
+    with ToolchainProfiler.profile_block('chunk_cache_lookup'):
+      keys = [get_chunk_cache_key(command, filename, tool) for command, filename in zip(commands, filenames)]
+      for i, filename in enumerate(filenames):
+        output = temp_files.get(os.path.basename(filename) + '.cached.js').name
+        if chunk_cache.get(keys[i], output):
+          outputs[i] = output
+  dirty = [i for i in range(len(commands)) if outputs[i] is None]
+
+  cores = min(cores, len(dirty))
+  if len(dirty) > 1 and cores >= 2:
+    # We can parallelize
+    if DEBUG:
+      print('splitting up js optimization into %d chunks, using %d cores  (total: %.2f MB)' % (len(dirty), cores, total_size / (1024 * 1024.)), file=sys.stderr)
+    with ToolchainProfiler.profile_block('optimizer_pool'):
+      pool = shared.Building.get_multiprocessing_pool()
+      results = pool.map(runner, [commands[i] for i in dirty], chunksize=1)
+  else:
+    # We can't parallize, but still break into chunks to avoid uglify/node memory issues
+    if len(dirty) > 1 and DEBUG:
+      print('splitting up js optimization into %d chunks' % (len(dirty)), file=sys.stderr)
+    results = [runner(commands[i]) for i in dirty]
+  for i, output in zip(dirty, results):
+    outputs[i] = output
+
+  if chunk_cache:
+    # A frozen cache may be read-only, and failing to store the chunks does not
+    # make the optimized output any less valid.
+    if not shared.FROZEN_CACHE:
+      try:
+        for i in dirty:
+          chunk_cache.put(keys[i], outputs[i])
+        chunk_cache.evict()
+      except (IOError, OSError) as e:
+        shared.logging.debug('failed to store in the js optimizer chunk cache: %s' % e)
+    shared.logging.debug('js optimizer chunk cache: %(hits)d hits, %(misses)d misses' % chunk_cache.stats())
+  return outputs
+
+
 def run_on_js(filename, passes, js_engine, source_map=False, extra_info=None, just_split=False, just_concat=False, extra_closure_args=[]):
   with ToolchainProfiler.profile_block('js_optimizer.split_markers'):
     if not isinstance(passes, list):
@@ -436,7 +535,12 @@ EMSCRIPTEN_FUNCS();
     if not just_split:
       intended_num_chunks = int(round(cores * NUM_CHUNKS_PER_CORE))
       chunk_size = min(MAX_CHUNK_SIZE, max(MIN_CHUNK_SIZE, total_size / intended_num_chunks))
-      chunks = shared.chunkify(funcs, chunk_size)
+      # the functions are sorted after optimizing, so unless that is disabled
+      # they can be grouped into chunks that stay the same between builds
+      if CHUNK_CACHE != '0' and not source_map and not just_concat and not os.environ.get('EMCC_NO_OPT_SORT'):
+        chunks = shared.stable_chunkify(funcs, chunk_size)
+      else:
+        chunks = shared.chunkify(funcs, chunk_size)
     else:
       # keep same chunks as before
       chunks = [f[1] for f in funcs]
@@ -466,28 +570,18 @@ EMSCRIPTEN_FUNCS();
   with ToolchainProfiler.profile_block('run_optimizer'):
     if len(filenames):
       if not use_native(passes, source_map):
+        tool = JS_OPTIMIZER
         commands = [js_engine + [JS_OPTIMIZER, f, 'noPrintMetadata'] +
                     (['--debug'] if source_map else []) + passes for f in filenames]
       else:
         # use the native optimizer
         shared.logging.debug('js optimizer using native')
         assert not source_map # XXX need to use js optimizer
-        commands = [[get_native_optimizer(), f] + passes for f in filenames]
+        tool = get_native_optimizer()
+        commands = [[tool, f] + passes for f in filenames]
       # print [' '.join(command) for command in commands]
 
-      cores = min(cores, len(filenames))
-      if len(chunks) > 1 and cores >= 2:
-        # We can parallelize
-        if DEBUG:
-          print('splitting up js optimization into %d chunks, using %d cores  (total: %.2f MB)' % (len(chunks), cores, total_size / (1024 * 1024.)), file=sys.stderr)
-        with ToolchainProfiler.profile_block('optimizer_pool'):
-          pool = shared.Building.get_multiprocessing_pool()
-          filenames = pool.map(run_on_chunk, commands, chunksize=1)
-      else:
-        # We can't parallize, but still break into chunks to avoid uglify/node memory issues
-        if len(chunks) > 1 and DEBUG:
-          print('splitting up js optimization into %d chunks' % (len(chunks)), file=sys.stderr)
-        filenames = [run_on_chunk(command) for command in commands]
+      filenames = run_chunk_commands(commands, filenames, tool, run_on_chunk, cores, total_size)
     else:
       filenames = []
 
@@ -57,3 +57,7 @@ JAVA = 'java' # executable
 # Other options
 #
 # FROZEN_CACHE = True # never clears the cache, and disallows building to the cache
+#
+# OBJECT_CACHE = os.path.expanduser(os.path.join('~', '.emscripten_object_cache')) # content-addressed cache of system library and port objects
+# OBJECT_CACHE_SHARED = '/mnt/shared/emscripten_object_cache' # read-only object cache consulted on local misses
+# OBJECT_CACHE_MAX_SIZE = 4 * 1024 * 1024 * 1024 # bytes; least recently used objects are evicted beyond this
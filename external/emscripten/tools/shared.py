@@ -20,6 +20,7 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import time
 
 if sys.version_info < (2, 7, 0):
   print('emscripten requires python 2.7.0 or above (python 2.7.12 or newer is recommended, older python versions are known to run into SSL related issues, https://github.com/emscripten-core/emscripten/issues/6275)', file=sys.stderr)
@@ -34,6 +35,7 @@ from .tempfiles import try_delete
 from . import jsrun, cache, tempfiles, colored_logger
 from . import response_file
 from . import diagnostics
+from . import symbol_index
 
 
 __rootpath__ = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
@@ -285,6 +287,9 @@ def parse_config_file():
     'WASM_ENGINES',
     'FROZEN_CACHE',
     'CACHE',
+    'OBJECT_CACHE',
+    'OBJECT_CACHE_SHARED',
+    'OBJECT_CACHE_MAX_SIZE',
   )
 
   # Only propagate certain settings from the config file.
@@ -1075,7 +1080,23 @@ def g_llvm_nm_uncached(filename):
   return Building.llvm_nm_uncached(filename)
 
 
+def g_run_compile_command(job):
+  # Helper function used by Building.parallel_compile. The output of the
+  # compiler is captured so that the parent process can print the diagnostics
+  # of each command as a whole, without interleaving them.
+  index, input_file, cmd, cwd = job
+  start = time.time()
+  with ToolchainProfiler.profile_block('compile ' + input_file):
+    try:
+      proc = run_process(cmd, check=False, stdout=PIPE, stderr=PIPE, cwd=cwd)
+      returncode, stdout, stderr = proc.returncode, proc.stdout, proc.stderr
+    except OSError as e:
+      returncode, stdout, stderr = -1, '', str(e) + '\n'
+  return (index, returncode, stdout, stderr, time.time() - start)
+
+
 def g_multiprocessing_initializer(*args):
+  ToolchainProfiler.record_pool_worker_start()
   for item in args:
     (key, value) = item.split('=', 1)
     if key == 'EMCC_POOL_CWD':
@@ -1134,6 +1155,11 @@ class Building(object):
   uninternal_nm_cache = {}
   ar_contents = {} # Stores the object files contained in different archive files passed as input
   _is_ar_cache = {}
+  # Persistent index of llvm-nm results (see tools/symbol_index.py), and the
+  # content hashes that key it for the files of the current link.
+  nm_index = None
+  content_hashes = {}
+  archive_hashes = {}
 
   # clear internal caches. this is not normally needed, except if the clang/LLVM
   # used changes inside this invocation of Building, which can happen in the benchmarker
@@ -1144,6 +1170,8 @@ class Building(object):
     Building.uninternal_nm_cache = {}
     Building.ar_contents = {}
     Building._is_ar_cache = {}
+    Building.content_hashes = {}
+    Building.archive_hashes = {}
 
   @staticmethod
   def get_num_cores():
@@ -1221,6 +1249,50 @@ class Building(object):
 
     return Building.multiprocessing_pool
 
+  # Runs a list of independent (input_file, compiler command) jobs, e.g. one per
+  # source file of a multi-source emcc invocation, across the multiprocessing
+  # pool. The diagnostics of each command are printed in job order, and the
+  # first command to fail aborts the whole step.
+  @staticmethod
+  def parallel_compile(jobs):
+    cores = min(len(jobs), Building.get_num_cores())
+    # Pool workers have no stdin, so a source read from stdin ('-') has to be
+    # compiled by this process.
+    if cores <= 1 or DEBUG or any(input_file == '-' for input_file, _ in jobs):
+      for input_file, cmd in jobs:
+        with ToolchainProfiler.profile_block('compile ' + input_file):
+          print_compiler_stage(cmd)
+          check_call(cmd)
+      return
+
+    with ToolchainProfiler.profile_block('parallel_compile'):
+      for _, cmd in jobs:
+        print_compiler_stage(cmd)
+      pool = Building.get_multiprocessing_pool()
+      # Pool children run in EMCC_POOL_CWD, but input paths are relative to ours.
+      cwd = os.getcwd()
+      tasks = [(i, input_file, cmd, cwd) for i, (input_file, cmd) in enumerate(jobs)]
+      results = pool.imap_unordered(g_run_compile_command, tasks, chunksize=1)
+      outputs = [None] * len(jobs)
+      next_output = 0
+      for _ in range(len(jobs)):
+        # See run_build_commands in system_libs.py for the reason behind the timeout.
+        i, returncode, stdout, stderr, elapsed = results.next(999999)
+        outputs[i] = (stdout, stderr)
+        if returncode != 0:
+          # Don't lose the diagnostics of the jobs that finished before, but
+          # are still waiting for earlier ones to be written out.
+          for output in outputs[next_output:]:
+            if output is not None:
+              sys.stdout.write(output[0])
+              sys.stderr.write(output[1])
+          exit_with_error("'%s' failed (%d)", ' '.join(jobs[i][1]), returncode)
+        logger.debug('compiled %s in %.2f seconds' % (jobs[i][0], elapsed))
+        while next_output < len(outputs) and outputs[next_output] is not None:
+          sys.stdout.write(outputs[next_output][0])
+          sys.stderr.write(outputs[next_output][1])
+          next_output += 1
+
   # When creating environment variables for Makefiles to execute, we need to doublequote the commands if they have spaces in them..
   @staticmethod
   def doublequote_spaces(arg):
@@ -1435,14 +1507,96 @@ class Building(object):
   @staticmethod
   def parallel_llvm_nm(files):
     with ToolchainProfiler.profile_block('parallel_llvm_nm'):
+      index = Building.get_nm_index()
+      pending = []
+      for file in files:
+        info = index.get_object(Building.get_content_hash(file)) if index else None
+        if info:
+          Building.uninternal_nm_cache[file] = ObjectFileInfo(*info)
+        else:
+          pending.append(file)
+      if index:
+        # Don't keep the index locked for other links while llvm-nm runs.
+        index.commit()
+
       pool = Building.get_multiprocessing_pool()
-      object_contents = pool.map(g_llvm_nm_uncached, files)
+      object_contents = pool.map(g_llvm_nm_uncached, pending)
 
-      for i, file in enumerate(files):
+      for i, file in enumerate(pending):
         if object_contents[i].returncode != 0:
           logger.debug('llvm-nm failed on file ' + file + ': return code ' + str(object_contents[i].returncode) + ', error: ' + object_contents[i].output)
         Building.uninternal_nm_cache[file] = object_contents[i]
-      return object_contents
+        if index:
+          Building.index_object(file, object_contents[i])
+      if index:
+        logger.debug('symbol index: %d of %d files needed llvm-nm' % (len(pending), len(files)))
+        index.commit()
+      return [Building.uninternal_nm_cache[file] for file in files]
+
+  # The persistent llvm-nm index lives in the cache, and can be disabled with
+  # EMCC_SYMBOL_INDEX=0. A frozen cache only has its index read. Returns None if
+  # it is disabled or unavailable.
+  @staticmethod
+  def get_nm_index():
+    if Building.nm_index is None:
+      Building.nm_index = False
+      if os.environ.get('EMCC_SYMBOL_INDEX', '1') != '0':
+        if not FROZEN_CACHE:
+          safe_ensure_dirs(Cache.dirname)
+        Building.nm_index = symbol_index.open_index(Cache.get_path('symbol_index.sqlite'), read_only=bool(FROZEN_CACHE)) or False
+    return Building.nm_index or None
+
+  @staticmethod
+  def get_content_hash(filename):
+    if filename not in Building.content_hashes:
+      # Files in the temp dir won't be seen again, so there is no point in
+      # remembering their paths in the index.
+      temp_dirs = [os.path.join(os.path.abspath(d), '') for d in (EMSCRIPTEN_TEMP_DIR, configuration.CANONICAL_TEMP_DIR) if d]
+      record = not os.path.abspath(filename).startswith(tuple(temp_dirs))
+      Building.content_hashes[filename] = Building.get_nm_index().get_file_hash(filename, record)
+    return Building.content_hashes[filename]
+
+  @staticmethod
+  def index_object(filename, info):
+    Building.get_nm_index().put_object(Building.get_content_hash(filename), info.returncode, info.output, info.defs, info.undefs, info.commons)
+
+  # Records the content hashes of the members of an extracted archive, from the
+  # index if it knows the archive, and otherwise by hashing them (and then adds
+  # the archive to the index).
+  @staticmethod
+  def index_archive(archive, members):
+    index = Building.get_nm_index()
+    archive_hash = Building.get_content_hash(archive)
+    Building.archive_hashes[archive] = archive_hash
+    names = [os.path.basename(m) for m in members]
+    indexed = index.get_archive_members(archive_hash)
+    if indexed and [name for name, _ in indexed] == names:
+      for member, (_, member_hash) in zip(members, indexed):
+        Building.content_hashes[member] = member_hash
+      return
+    hashes = []
+    for member in members:
+      # Members are extracted to a new temp dir for each link, so there is no
+      # point in remembering their paths in the index.
+      Building.content_hashes[member] = symbol_index.hash_file(member)
+      hashes.append(Building.content_hashes[member])
+    index.put_archive_members(archive_hash, list(zip(names, hashes)))
+
+  # Returns a dict from each symbol defined in the given archive to the
+  # positions of the members defining it, or None if the index doesn't cover
+  # the archive. Members are checked the same way consider_object in link()
+  # does.
+  @staticmethod
+  def get_archive_providers(archive):
+    index = Building.get_nm_index()
+    if not index or archive not in Building.archive_hashes:
+      return None
+    for member in Building.ar_contents[archive]:
+      if not Building.llvm_nm(member).is_valid_for_nm():
+        diagnostics.warning('emcc', 'object %s is not valid according to llvm-nm, cannot link', member)
+      elif not Building.is_bitcode(member):
+        exit_with_error('unknown file type: %s', member)
+    return index.get_archive_providers(Building.archive_hashes[archive])
 
   @staticmethod
   def read_link_inputs(files):
@@ -1474,6 +1628,8 @@ class Building(object):
           raise Exception('llvm-ar failed on archive ' + archive_names[n] + '!')
         Building.ar_contents[archive_names[n]] = object_names_in_archives[n]['files']
         clean_temporary_archive_contents_directory(object_names_in_archives[n]['dir'])
+        if Building.get_nm_index():
+          Building.index_archive(archive_names[n], object_names_in_archives[n]['files'])
 
       for o in object_names_in_archives:
         for f in o['files']:
@@ -1687,6 +1843,27 @@ class Building(object):
       loop_again = True
       logger.debug('considering archive %s' % (f))
       contents = Building.ar_contents[f]
+      providers = None if force_add else Building.get_archive_providers(f)
+      if providers is not None:
+        # Same traversal as below, but rather than asking each member whether
+        # it provides a currently unresolved symbol, look the unresolved
+        # symbols up in the reverse symbol map of the archive to find the next
+        # member that does.
+        while loop_again:
+          loop_again = False
+          position = 0
+          while True:
+            candidates = [p for symbol in unresolved_symbols for p in providers.get(symbol, ()) if p >= position and contents[p] not in added_contents]
+            if not candidates:
+              break
+            position = min(candidates)
+            if consider_object(contents[position]):
+              added_contents.add(contents[position])
+              loop_again = True
+              added_any_objects = True
+            position += 1
+        logger.debug('done running loop of archive %s' % (f))
+        return added_any_objects
       while loop_again: # repeatedly traverse until we have everything we need
         loop_again = False
         for content in contents:
@@ -1760,6 +1937,10 @@ class Building(object):
       scan_archive_group(current_archive_group)
       current_archive_group = None
 
+    # Store what llvm-nm found while scanning in a single transaction.
+    if Building.get_nm_index():
+      Building.get_nm_index().commit()
+
     try_delete(target)
 
     # Finish link
@@ -1881,6 +2062,12 @@ class Building(object):
     elif not include_internal and filename in Building.uninternal_nm_cache:
       return Building.uninternal_nm_cache[filename]
 
+    if not include_internal and Building.get_nm_index() and os.path.isfile(filename):
+      info = Building.get_nm_index().get_object(Building.get_content_hash(filename))
+      if info:
+        Building.uninternal_nm_cache[filename] = ObjectFileInfo(*info)
+        return Building.uninternal_nm_cache[filename]
+
     ret = Building.llvm_nm_uncached(filename, stdout, stderr, include_internal)
 
     if ret.returncode != 0:
@@ -1891,6 +2078,9 @@ class Building(object):
       Building.internal_nm_cache[filename] = ret
     else:
       Building.uninternal_nm_cache[filename] = ret
+      if Building.get_nm_index() and os.path.isfile(filename):
+        # link() commits these once it has scanned its inputs.
+        Building.index_object(filename, ret)
 
     return ret
 
@@ -2801,6 +2991,12 @@ def reconfigure_cache():
   Cache = cache.Cache(CACHE)
 
 
+def create_object_cache():
+  if not OBJECT_CACHE:
+    return None
+  return cache.ObjectCache(OBJECT_CACHE, int(OBJECT_CACHE_MAX_SIZE), OBJECT_CACHE_SHARED)
+
+
 # Placeholder strings used for SINGLE_FILE
 class FilenameReplacementStrings:
   WASM_TEXT_FILE = '{{{ FILENAME_REPLACEMENT_STRINGS_WASM_TEXT_FILE }}}'
@@ -3394,6 +3590,9 @@ WASMTIME = None
 WASM_ENGINES = []
 CACHE = None
 FROZEN_CACHE = False
+OBJECT_CACHE = None
+OBJECT_CACHE_SHARED = None
+OBJECT_CACHE_MAX_SIZE = 4 * 1024 * 1024 * 1024
 
 # Emscripten compiler spawns other processes, which can reimport shared.py, so
 # make sure that those child processes get the same configuration file by
@@ -3514,4 +3713,6 @@ PRINT_STAGES = int(os.getenv('EMCC_VERBOSE', '0'))
 
 # compatibility with existing emcc, etc. scripts
 Cache = cache.Cache(CACHE)
+object_cache = create_object_cache()
 chunkify = cache.chunkify
+stable_chunkify = cache.stable_chunkify
@@ -0,0 +1,250 @@
+# Copyright 2020 The Emscripten Authors.  All rights reserved.
+# Emscripten is available under two separate licenses, the MIT license and the
+# University of Illinois/NCSA Open Source License.  Both these licenses can be
+# found in the LICENSE file.
+
+"""Persistent index of llvm-nm results, shared between emcc invocations.
+
+Object files are identified by a hash of their contents, so the index stays
+valid for archive members that get extracted to a fresh temp dir on every link.
+To avoid rehashing unchanged inputs, the hash of each input file is remembered
+along with its size and mtime. For archives the index also records the members
+(by name and content hash), so a warm index answers everything about an archive
+without running llvm-nm or hashing its members, and it keeps a reverse map from
+each defined symbol to the objects providing it.
+
+The index is an sqlite database, so it is only read as far as a link needs it.
+If Python was built without sqlite3, there is no persistent index. Errors from
+sqlite (e.g. when another link holds the database locked for too long) make the
+index unavailable for the rest of the process instead of failing the link.
+
+Entries remember when they were last used, and the least recently used ones are
+pruned once there are more than MAX_ENTRIES objects or files.
+
+A read only index (for a frozen cache) is only used if it already exists, and
+is never written to.
+"""
+
+import hashlib
+import logging
+import os
+import random
+import sys
+import time
+
+try:
+  import sqlite3
+except ImportError:
+  sqlite3 = None
+
+logger = logging.getLogger('symbol_index')
+
+# Bump this when the layout of the database changes.
+SCHEMA_VERSION = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, hash TEXT, used REAL);
+CREATE INDEX IF NOT EXISTS files_by_used ON files (used);
+CREATE TABLE IF NOT EXISTS objects (hash TEXT PRIMARY KEY, returncode INTEGER, output TEXT, used REAL);
+CREATE INDEX IF NOT EXISTS objects_by_used ON objects (used);
+CREATE TABLE IF NOT EXISTS symbols (hash TEXT, kind TEXT, name TEXT);
+CREATE INDEX IF NOT EXISTS symbols_by_hash ON symbols (hash);
+CREATE INDEX IF NOT EXISTS symbols_by_name ON symbols (name);
+CREATE TABLE IF NOT EXISTS archive_members (archive TEXT, position INTEGER, name TEXT, hash TEXT);
+CREATE INDEX IF NOT EXISTS archive_members_by_archive ON archive_members (archive);
+'''
+
+# The number of objects (and of files) to keep in the index.
+MAX_ENTRIES = 50000
+# Last use times are only updated when they are older than this, so that
+# lookups in a warm index don't need to write to it.
+USED_RESOLUTION = 60 * 60
+# Pruning has to count the entries, so only one in this many commits that added
+# entries does it.
+PRUNE_INTERVAL = 16
+
+# Kinds of the entries in the symbols table.
+DEFINED = 'D'
+UNDEFINED = 'U'
+COMMON = 'C'
+
+
+def hash_file(path):
+  h = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+class SymbolIndex(object):
+  def __init__(self, path, read_only=False):
+    self.path = path
+    self.read_only = read_only
+    self.added = False
+    if read_only and sys.version_info >= (3, 4):
+      self.db = sqlite3.connect('file:%s?mode=ro' % path, timeout=60, uri=True)
+    else:
+      # Python 2 can't open a database read only, but nothing is written to it.
+      self.db = sqlite3.connect(path, timeout=60)
+    version = self.db.execute('PRAGMA user_version').fetchone()[0]
+    if read_only:
+      if version != SCHEMA_VERSION:
+        raise sqlite3.DatabaseError('version %d, expected %d' % (version, SCHEMA_VERSION))
+    elif version != SCHEMA_VERSION:
+      logger.debug('symbol index %s has version %d, recreating it' % (path, version))
+      for table in ('files', 'objects', 'symbols', 'archive_members'):
+        self.db.execute('DROP TABLE IF EXISTS ' + table)
+      self.db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+    if not read_only:
+      self.db.executescript(SCHEMA)
+      self.db.commit()
+    self.now = time.time()
+
+  def disable(self, e):
+    logger.debug('symbol index %s is unavailable: %s' % (self.path, e))
+    try:
+      self.db.rollback()
+      self.db.close()
+    except sqlite3.Error:
+      pass
+    self.db = None
+
+  def mark_used(self, table, column, value, used):
+    if self.read_only:
+      return
+    if used is None or used < self.now - USED_RESOLUTION:
+      self.db.execute('UPDATE %s SET used = ? WHERE %s = ?' % (table, column), (self.now, value))
+
+  def get_file_hash(self, path, record=True):
+    """Returns the content hash of the file, reusing the one recorded for it if
+    its size and mtime did not change since. Unless record is false, the hash
+    is recorded for later."""
+    st = os.stat(path)
+    row = None
+    if self.db:
+      try:
+        row = self.db.execute('SELECT size, mtime, hash, used FROM files WHERE path = ?', (path,)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime:
+          self.mark_used('files', 'path', path, row[3])
+          return row[2]
+      except sqlite3.Error as e:
+        self.disable(e)
+    file_hash = hash_file(path)
+    if self.db and record and not self.read_only:
+      try:
+        self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', (path, st.st_size, st.st_mtime, file_hash, self.now))
+        self.added = True
+        if row and row[2] != file_hash:
+          # forget the members of the previous version of a rebuilt archive
+          self.db.execute('DELETE FROM archive_members WHERE archive = ? AND NOT EXISTS (SELECT 1 FROM files WHERE hash = ?)', (row[2], row[2]))
+      except sqlite3.Error as e:
+        self.disable(e)
+    return file_hash
+
+  def get_object(self, file_hash):
+    """Returns (returncode, output, defs, undefs, commons) for an object, or
+    None if it isn't in the index."""
+    if not self.db:
+      return None
+    try:
+      row = self.db.execute('SELECT returncode, output, used FROM objects WHERE hash = ?', (file_hash,)).fetchone()
+      if not row:
+        return None
+      symbols = {DEFINED: set(), UNDEFINED: set(), COMMON: set()}
+      for kind, name in self.db.execute('SELECT kind, name FROM symbols WHERE hash = ?', (file_hash,)):
+        symbols[kind].add(name)
+      self.mark_used('objects', 'hash', file_hash, row[2])
+    except sqlite3.Error as e:
+      self.disable(e)
+      return None
+    return row[0], row[1], symbols[DEFINED], symbols[UNDEFINED], symbols[COMMON]
+
+  def put_object(self, file_hash, returncode, output, defs, undefs, commons):
+    if not self.db or self.read_only:
+      return
+    try:
+      if self.db.execute('SELECT 1 FROM objects WHERE hash = ?', (file_hash,)).fetchone():
+        return
+      self.db.execute('INSERT INTO objects VALUES (?, ?, ?, ?)', (file_hash, returncode, output, self.now))
+      rows = [(file_hash, DEFINED, s) for s in defs]
+      rows += [(file_hash, UNDEFINED, s) for s in undefs]
+      rows += [(file_hash, COMMON, s) for s in commons]
+      self.db.executemany('INSERT INTO symbols VALUES (?, ?, ?)', rows)
+      self.added = True
+    except sqlite3.Error as e:
+      self.disable(e)
+
+  def get_archive_members(self, archive_hash):
+    """Returns the [(name, hash)] of the members of an archive, in archive
+    order, or None if the archive isn't in the index."""
+    if not self.db:
+      return None
+    try:
+      rows = self.db.execute('SELECT name, hash FROM archive_members WHERE archive = ? ORDER BY position', (archive_hash,)).fetchall()
+    except sqlite3.Error as e:
+      self.disable(e)
+      return None
+    return rows or None
+
+  def put_archive_members(self, archive_hash, members):
+    if not self.db or self.read_only:
+      return
+    try:
+      self.db.execute('DELETE FROM archive_members WHERE archive = ?', (archive_hash,))
+      self.db.executemany('INSERT INTO archive_members VALUES (?, ?, ?, ?)',
+                          [(archive_hash, i, name, member_hash) for i, (name, member_hash) in enumerate(members)])
+    except sqlite3.Error as e:
+      self.disable(e)
+
+  def get_archive_providers(self, archive_hash):
+    """Returns the reverse symbol map of an archive: a dict from each symbol
+    that a member defines (or has as common) to the positions of those members,
+    or None if the index is unavailable."""
+    if not self.db:
+      return None
+    providers = {}
+    try:
+      for position, name in self.db.execute('SELECT m.position, s.name FROM archive_members m JOIN symbols s ON s.hash = m.hash '
+                                            'WHERE m.archive = ? AND s.kind IN (?, ?) ORDER BY m.position', (archive_hash, DEFINED, COMMON)):
+        providers.setdefault(name, []).append(position)
+    except sqlite3.Error as e:
+      self.disable(e)
+      return None
+    return providers
+
+  def prune(self):
+    """Removes the least recently used objects and files beyond MAX_ENTRIES,
+    along with their symbols and the members of archives no longer known."""
+    for table, column in (('objects', 'hash'), ('files', 'path')):
+      count = self.db.execute('SELECT COUNT(*) FROM ' + table).fetchone()[0]
+      if count <= MAX_ENTRIES:
+        continue
+      logger.debug('symbol index: pruning %d %s' % (count - MAX_ENTRIES, table))
+      self.db.execute('DELETE FROM %s WHERE %s IN (SELECT %s FROM %s ORDER BY used LIMIT ?)' % (table, column, column, table),
+                      (count - MAX_ENTRIES,))
+      if table == 'objects':
+        self.db.execute('DELETE FROM symbols WHERE hash NOT IN (SELECT hash FROM objects)')
+      else:
+        self.db.execute('DELETE FROM archive_members WHERE archive NOT IN (SELECT hash FROM files)')
+
+  def commit(self):
+    if not self.db or self.read_only:
+      return
+    try:
+      if self.added and random.randrange(PRUNE_INTERVAL) == 0:
+        self.prune()
+      self.added = False
+      self.db.commit()
+    except sqlite3.Error as e:
+      self.disable(e)
+
+
+def open_index(path, read_only=False):
+  if not sqlite3 or (read_only and not os.path.exists(path)):
+    return None
+  try:
+    return SymbolIndex(path, read_only)
+  except sqlite3.Error as e:
+    logger.debug('cannot use symbol index %s: %s' % (path, e))
+    return None
@@ -41,6 +41,9 @@ LIBC_SOCKETS = ['socket.c', 'socketpair.c', 'shutdown.c', 'bind.c', 'connect.c',
                 'recv.c', 'sendto.c', 'recvfrom.c', 'sendmsg.c', 'recvmsg.c',
                 'getsockopt.c', 'setsockopt.c', 'freeaddrinfo.c']
 
+# Suffixes of the sources that system libraries and ports are built from.
+SOURCE_ENDINGS = ('.c', '.cc', '.cpp', '.cxx', '.s', '.S')
+
 
 def files_in_path(path_components, filenames):
   srcdir = shared.path_from_root(*path_components)
@@ -89,7 +92,141 @@ def run_one_command(cmd):
   shared.run_process(cmd, stdout=stdout, stderr=stderr, env=safe_env)
 
 
+def get_compiler_identity():
+  # Everything about the compiler that can change its output without changing
+  # the build command line. The InstalledDir line of clang --version is
+  # machine specific and doesn't affect the output, so it is left out.
+  if not hasattr(get_compiler_identity, 'identity'):
+    version = shared.run_process([shared.CLANG_CC, '--version'], stdout=shared.PIPE).stdout
+    version = '\n'.join(l for l in version.splitlines() if not l.startswith('InstalledDir'))
+    get_compiler_identity.identity = '\n'.join([version,
+                                                shared.EMSCRIPTEN_VERSION,
+                                                str(shared.Settings.WASM_BACKEND),
+                                                os.environ.get('EMCC_CFLAGS', '')])
+  return get_compiler_identity.identity
+
+
+include_dir_digests = {}
+
+
+def get_include_dir_digest(dirname):
+  # Digest of the contents of a directory that headers may be included from.
+  # Computed once per process, as the same directories are used by most of the
+  # commands of a build.
+  if dirname not in include_dir_digests:
+    h = hashlib.sha256()
+    if os.path.isdir(dirname):
+      for path in sorted(get_all_files_under(dirname)):
+        h.update(os.path.relpath(path, dirname).replace('\\', '/').encode('utf-8'))
+        with open(path, 'rb') as f:
+          h.update(f.read())
+    include_dir_digests[dirname] = h.hexdigest()
+  return include_dir_digests[dirname]
+
+
+def get_location_roots():
+  # The emscripten checkout, the ports dir and the cache are in different
+  # places on different machines, but what is compiled from them is the same.
+  # Longer roots come first, as the cache may be inside the checkout.
+  roots = [('<emscripten>', shared.path_from_root()),
+           ('<ports>', Ports.get_dir()),
+           ('<cache>', shared.Cache.root_dirname)]
+  roots = [(name, os.path.normpath(os.path.abspath(root))) for name, root in roots]
+  return sorted(roots, key=lambda r: len(r[1]), reverse=True)
+
+
+def get_location_independent_arg(arg, roots):
+  for name, root in roots:
+    arg = re.sub(re.escape(root) + r'(?=[/\\]|$)', name, arg)
+  return arg.replace('\\', '/')
+
+
+# Flags that add a directory to search for headers, and flags that include a
+# file. Each may be given joined with its argument or as a separate one.
+INCLUDE_DIR_FLAGS = ('-I', '-isystem', '-iquote', '-idirafter')
+INCLUDE_FILE_FLAGS = ('-include', '-imacros')
+
+
+def get_include_dirs(cmd):
+  # The directories that a command may read headers from (for included files,
+  # the directory they are in).
+  include_dirs = []
+  for i, arg in enumerate(cmd):
+    for flag in INCLUDE_DIR_FLAGS + INCLUDE_FILE_FLAGS:
+      if arg.startswith(flag):
+        value = arg[len(flag):] or (cmd[i + 1] if i + 1 < len(cmd) else '')
+        if flag in INCLUDE_FILE_FLAGS:
+          value = os.path.dirname(os.path.abspath(value))
+        include_dirs.append(value)
+        break
+  return include_dirs
+
+
+def uses_port_settings(cmd):
+  # Commands with -s USE_*=.. settings have emcc install the headers of those
+  # ports into the cache as they run.
+  for i, arg in enumerate(cmd):
+    if arg == '-s' and i + 1 < len(cmd):
+      arg = cmd[i + 1]
+    elif arg.startswith('-s'):
+      arg = arg[2:]
+    else:
+      continue
+    if arg.startswith('USE_'):
+      return True
+  return False
+
+
+def get_object_cache_key(cmd):
+  """
+  Returns the ObjectCache key and the output object of a build command, or
+  None if the command does not compile exactly one source file to an object.
+
+  The key covers the source contents, the full command line (and so all the
+  cflags of the library or port), the compiler, and the contents of every
+  directory the source can include headers from. That includes the ports
+  headers in the cache, which -s USE_* settings make available. Paths in the
+  command line are taken relative to the emscripten checkout, the ports dir and
+  the cache, so that the key is the same on other machines.
+  """
+  if '-c' not in cmd or '-o' not in cmd:
+    return None
+  output = cmd[cmd.index('-o') + 1]
+  sources = [a for a in cmd[2:] if not a.startswith('-') and a != output and a.endswith(SOURCE_ENDINGS)]
+  if len(sources) != 1 or not os.path.isfile(sources[0]):
+    return None
+  src = sources[0]
+
+  include_dirs = [os.path.dirname(os.path.abspath(src))]
+  include_dirs += get_include_dirs(cmd) + get_include_dirs(shared.emsdk_cflags())
+  include_dirs = shared.unique_ordered([os.path.normpath(os.path.abspath(d)) for d in include_dirs])
+
+  roots = get_location_roots()
+  h = hashlib.sha256()
+  h.update(get_compiler_identity().encode('utf-8'))
+  for arg in cmd[2:]:
+    if arg == output:
+      arg = '<output>'
+    h.update(get_location_independent_arg(arg, roots).encode('utf-8') + b'\0')
+  with open(src, 'rb') as f:
+    h.update(f.read())
+  for dirname in include_dirs:
+    h.update(get_include_dir_digest(dirname).encode('utf-8'))
+  return h.hexdigest(), output
+
+
 def run_build_commands(commands):
+  object_cache = shared.object_cache
+  if object_cache:
+    # Commands whose object is already in the object cache don't need to run.
+    pending = []
+    for cmd in commands:
+      key = get_object_cache_key(cmd)
+      if key and object_cache.get(*key):
+        continue
+      pending.append((cmd, key))
+    commands = [cmd for cmd, _ in pending]
+
   cores = min(len(commands), shared.Building.get_num_cores())
   if cores <= 1:
     for command in commands:
@@ -102,6 +239,17 @@ def run_build_commands(commands):
     # and is smaller than the maximum timeout value 4294967.0 for Python 3 on Windows (threading.TIMEOUT_MAX)
     pool.map_async(run_one_command, commands, chunksize=1).get(999999)
 
+  if object_cache:
+    if any(uses_port_settings(cmd) for cmd in commands):
+      # The commands may have installed ports headers, which changes their key.
+      include_dir_digests.clear()
+      pending = [(cmd, key and get_object_cache_key(cmd)) for cmd, key in pending]
+    for cmd, key in pending:
+      if key:
+        object_cache.put(key[0], key[1])
+    object_cache.evict()
+    logger.info(' - object cache: %(hits)d hits, %(shared_hits)d shared hits, %(misses)d misses' % object_cache.stats())
+
 
 def static_library_ext():
   return '.a' if shared.Settings.WASM_BACKEND else '.bc'
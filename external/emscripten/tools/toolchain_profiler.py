@@ -3,6 +3,9 @@
 # University of Illinois/NCSA Open Source License.  Both these licenses can be
 # found in the LICENSE file.
 
+import atexit
+import json
+import multiprocessing
 import subprocess
 import os
 import time
@@ -17,158 +20,165 @@ EM_PROFILE_TOOLCHAIN = int(os.getenv('EM_PROFILE_TOOLCHAIN', '0'))
 
 if EM_PROFILE_TOOLCHAIN:
   original_sys_exit = sys.exit
-  original_subprocess_call = subprocess.call
-  original_subprocess_check_call = subprocess.check_call
-  original_subprocess_check_output = subprocess.check_output
   original_Popen = subprocess.Popen
 
   def profiled_sys_exit(returncode):
     ToolchainProfiler.record_process_exit(returncode)
     original_sys_exit(returncode)
 
-  def profiled_call(cmd, *args, **kw):
-    pid = ToolchainProfiler.imaginary_pid()
-    ToolchainProfiler.record_subprocess_spawn(pid, cmd)
-    try:
-      returncode = original_subprocess_call(cmd, *args, **kw)
-    except Exception:
-      ToolchainProfiler.record_subprocess_finish(pid, 1)
-      raise
-    ToolchainProfiler.record_subprocess_finish(pid, returncode)
-    return returncode
-
-  def profiled_check_call(cmd, *args, **kw):
-    pid = ToolchainProfiler.imaginary_pid()
-    ToolchainProfiler.record_subprocess_spawn(pid, cmd)
-    try:
-      ret = original_subprocess_check_call(cmd, *args, **kw)
-    except Exception as e:
-      ToolchainProfiler.record_subprocess_finish(pid, e.returncode)
-      raise
-    ToolchainProfiler.record_subprocess_finish(pid, 0)
-    return ret
-
-  def profiled_check_output(cmd, *args, **kw):
-    pid = ToolchainProfiler.imaginary_pid()
-    ToolchainProfiler.record_subprocess_spawn(pid, cmd)
-    try:
-      ret = original_subprocess_check_output(cmd, *args, **kw)
-    except Exception as e:
-      ToolchainProfiler.record_subprocess_finish(pid, e.returncode)
-      raise
-    ToolchainProfiler.record_subprocess_finish(pid, 0)
-    return ret
-
+  # subprocess.call(), check_call(), check_output() and run() all go through Popen.
   class ProfiledPopen(original_Popen):
+    # Not set until the spawn is recorded, in case the constructor fails and waits for the process.
+    finish_recorded = True
+
     def __init__(self, args, *otherargs, **kwargs):
       super(ProfiledPopen, self).__init__(args, *otherargs, **kwargs)
       ToolchainProfiler.record_subprocess_spawn(self.pid, args)
+      self.finish_recorded = False
 
     def communicate(self, *args, **kwargs):
       ToolchainProfiler.record_subprocess_wait(self.pid)
       output = super(ProfiledPopen, self).communicate(*args, **kwargs)
-      ToolchainProfiler.record_subprocess_finish(self.pid, self.returncode)
+      self.record_finish()
       return output
 
+    def wait(self, *args, **kwargs):
+      returncode = super(ProfiledPopen, self).wait(*args, **kwargs)
+      self.record_finish()
+      return returncode
+
+    def record_finish(self):
+      if not self.finish_recorded:
+        self.finish_recorded = True
+        ToolchainProfiler.record_subprocess_finish(self.pid, self.returncode)
+
   sys.exit = profiled_sys_exit
-  subprocess.call = profiled_call
-  subprocess.check_call = profiled_check_call
-  subprocess.check_output = profiled_check_output
   subprocess.Popen = ProfiledPopen
 
   class ToolchainProfiler(object):
-    # Provide a running counter towards negative numbers for PIDs for which we don't know what the actual process ID is
-    imaginary_pid_ = 0
     profiler_logs_path = None # Log file not opened yet
 
+    # The PID of the process that recorded the events below. A process forked from this one (e.g. a multiprocessing pool
+    # worker) inherits them, and notices that the PID has changed.
+    mypid = None
     block_stack = []
 
+    # Events are buffered in memory, and written to the log file of the process when it exits, instead of writing each
+    # of them separately. Pool workers write theirs after each top level task instead, since the pool terminates them.
+    events = []
+    log_file_started = False
+    is_pool_worker = False
+
     # Because process spawns are tracked from multiple entry points, it is possible that record_process_start() and/or record_process_exit()
     # are called multiple times. Prevent recording multiple entries to the logs to keep them clean.
-    process_start_recorded = False
     process_exit_recorded = False
 
     @staticmethod
-    def timestamp():
-      return '{0:.3f}'.format(time.time())
-
-    @staticmethod
-    def log_access():
-      # If somehow the process escaped opening the log at startup, do so now. (this biases the startup time of the process, but best effort)
-      if not ToolchainProfiler.profiler_logs_path:
+    def record(op, **fields):
+      if ToolchainProfiler.mypid != os.getpid():
+        # If somehow the process escaped recording its start, do so now. (this biases the startup time of the process, but best effort)
         ToolchainProfiler.record_process_start()
+      times = os.times()
+      event = {'pid': ToolchainProfiler.mypid, 'subprocessPid': ToolchainProfiler.mypid, 'op': op, 'time': round(time.time(), 6),
+               # CPU time used by this process, and by its children that it has waited for, in seconds.
+               'cpu': round(times[0] + times[1], 3), 'childCpu': round(times[2] + times[3], 3)}
+      event.update(fields)
+      ToolchainProfiler.events.append(event)
 
-      # Note: This function is called in two importantly different contexts: in "main" process and in python subprocesses
-      # invoked via subprocessing.Pool.map(). The subprocesses have their own PIDs, and hence record their own data JSON
-      # files, but since the process pool is maintained internally by python, the toolchain profiler does not track the
-      # parent->child process spawns for the subprocessing pools. Therefore any profiling events that the subprocess
-      # children generate are virtually treated as if they were performed by the parent PID.
-      return open(os.path.join(ToolchainProfiler.profiler_logs_path, 'toolchain_profiler.pid_' + str(os.getpid()) + '.json'), 'a')
+    @staticmethod
+    def flush():
+      if not ToolchainProfiler.events:
+        return
+      lines = [json.dumps(e, separators=(',', ':')) for e in ToolchainProfiler.events]
+      ToolchainProfiler.events = []
+      with open(os.path.join(ToolchainProfiler.profiler_logs_path, 'toolchain_profiler.pid_' + str(os.getpid()) + '.json'), 'a') as f:
+        f.write((',\n' if ToolchainProfiler.log_file_started else '[\n') + ',\n'.join(lines))
+        if ToolchainProfiler.process_exit_recorded:
+          f.write('\n]\n')
+      ToolchainProfiler.log_file_started = True
 
     @staticmethod
-    def escape_args(args):
-      return map(lambda arg: arg.replace('\\', '\\\\').replace('"', '\\"'), args)
+    def flush_at_exit():
+      if not ToolchainProfiler.is_pool_worker and ToolchainProfiler.mypid == os.getpid():
+        ToolchainProfiler.record_process_exit(0)
 
     @staticmethod
     def record_process_start(write_log_entry=True):
-      # For subprocessing.Pool.map() child processes, this points to the PID of the parent process that spawned
-      # the subprocesses. This makes the subprocesses look as if the parent had called the functions.
-      ToolchainProfiler.mypid_str = str(os.getpid())
+      if ToolchainProfiler.mypid == os.getpid():
+        return
+      # Drop the state inherited from the parent, if this process was forked.
+      ToolchainProfiler.mypid = os.getpid()
+      ToolchainProfiler.events = []
+      ToolchainProfiler.block_stack = []
+      ToolchainProfiler.log_file_started = False
+      ToolchainProfiler.process_exit_recorded = False
       ToolchainProfiler.profiler_logs_path = os.path.join(tempfile.gettempdir(), 'emscripten_toolchain_profiler_logs')
       try:
         os.makedirs(ToolchainProfiler.profiler_logs_path)
       except OSError:
         pass
-
-      if ToolchainProfiler.process_start_recorded:
-        return
-      ToolchainProfiler.process_start_recorded = True
-      ToolchainProfiler.block_stack = []
+      # Processes that exit without calling sys.exit() still write their events.
+      atexit.register(ToolchainProfiler.flush_at_exit)
 
       if write_log_entry:
-        with ToolchainProfiler.log_access() as f:
-          f.write('[\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"op":"start","time":' + ToolchainProfiler.timestamp() + ',"cmdLine":["' + '","'.join(ToolchainProfiler.escape_args(sys.argv)) + '"]}')
+        if ToolchainProfiler.is_pool_worker:
+          ToolchainProfiler.record('start', cmdLine=sys.argv, poolWorker=True, parentPid=os.getppid(), cores=multiprocessing.cpu_count())
+        else:
+          ToolchainProfiler.record('start', cmdLine=sys.argv, cores=multiprocessing.cpu_count())
+
+    # Called in each multiprocessing pool worker when it starts, so that the work done in the pool gets a track of
+    # its own in the profile, with the process that created the pool as its parent.
+    @staticmethod
+    def record_pool_worker_start():
+      ToolchainProfiler.is_pool_worker = True
+      ToolchainProfiler.mypid = None
+      ToolchainProfiler.record_process_start()
 
     @staticmethod
     def record_process_exit(returncode):
-      if ToolchainProfiler.process_exit_recorded:
+      if ToolchainProfiler.process_exit_recorded or ToolchainProfiler.mypid != os.getpid():
         return
-      ToolchainProfiler.process_exit_recorded = True
 
       ToolchainProfiler.exit_all_blocks()
-      with ToolchainProfiler.log_access() as f:
-        f.write(',\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"op":"exit","time":' + ToolchainProfiler.timestamp() + ',"returncode":' + str(returncode) + '}\n]\n')
+      ToolchainProfiler.record('exit', returncode=returncode)
+      ToolchainProfiler.process_exit_recorded = True
+      ToolchainProfiler.flush()
+
+    # Pool workers write their events whenever they are not inside a block.
+    @staticmethod
+    def task_finished():
+      if ToolchainProfiler.is_pool_worker and not ToolchainProfiler.block_stack:
+        ToolchainProfiler.flush()
 
     @staticmethod
     def record_subprocess_spawn(process_pid, process_cmdline):
+      if not isinstance(process_cmdline, (list, tuple)):
+        # A command line string, run with shell=True.
+        process_cmdline = [process_cmdline]
       response_cmdline = []
       for item in process_cmdline:
         if item.startswith('@'):
           response_cmdline += response_file.read_response_file(item)
 
-      with ToolchainProfiler.log_access() as f:
-        f.write(',\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"op":"spawn","targetPid":' + str(process_pid) + ',"time":' + ToolchainProfiler.timestamp() + ',"cmdLine":["' + '","'.join(ToolchainProfiler.escape_args(process_cmdline + response_cmdline)) + '"]}')
+      ToolchainProfiler.record('spawn', targetPid=process_pid, cmdLine=list(process_cmdline) + response_cmdline)
 
     @staticmethod
     def record_subprocess_wait(process_pid):
-      with ToolchainProfiler.log_access() as f:
-        f.write(',\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"op":"wait","targetPid":' + str(process_pid) + ',"time":' + ToolchainProfiler.timestamp() + '}')
+      ToolchainProfiler.record('wait', targetPid=process_pid)
 
     @staticmethod
     def record_subprocess_finish(process_pid, returncode):
-      with ToolchainProfiler.log_access() as f:
-        f.write(',\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"op":"finish","targetPid":' + str(process_pid) + ',"time":' + ToolchainProfiler.timestamp() + ',"returncode":' + str(returncode) + '}')
+      ToolchainProfiler.record('finish', targetPid=process_pid, returncode=returncode)
+      ToolchainProfiler.task_finished()
 
     @staticmethod
     def enter_block(block_name):
-      with ToolchainProfiler.log_access() as f:
-        f.write(',\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"op":"enterBlock","name":"' + block_name + '","time":' + ToolchainProfiler.timestamp() + '}')
-
+      ToolchainProfiler.record('enterBlock', name=block_name)
       ToolchainProfiler.block_stack.append(block_name)
 
     @staticmethod
     def remove_last_occurrence_if_exists(lst, item):
-      for i in range(len(lst)):
+      for i in range(len(lst) - 1, -1, -1):
         if lst[i] == item:
           lst.pop(i)
           return True
@@ -177,8 +187,8 @@ if EM_PROFILE_TOOLCHAIN:
     @staticmethod
     def exit_block(block_name):
       if ToolchainProfiler.remove_last_occurrence_if_exists(ToolchainProfiler.block_stack, block_name):
-        with ToolchainProfiler.log_access() as f:
-          f.write(',\n{"pid":' + ToolchainProfiler.mypid_str + ',"subprocessPid":' + str(os.getpid()) + ',"op":"exitBlock","name":"' + block_name + '","time":' + ToolchainProfiler.timestamp() + '}')
+        ToolchainProfiler.record('exitBlock', name=block_name)
+        ToolchainProfiler.task_finished()
 
     @staticmethod
     def exit_all_blocks():
@@ -199,17 +209,16 @@ if EM_PROFILE_TOOLCHAIN:
     def profile_block(block_name):
       return ToolchainProfiler.ProfileBlock(block_name)
 
-    @staticmethod
-    def imaginary_pid():
-      ToolchainProfiler.imaginary_pid_ -= 1
-      return ToolchainProfiler.imaginary_pid_
-
 else:
   class ToolchainProfiler(object):
     @staticmethod
     def record_process_start():
       pass
 
+    @staticmethod
+    def record_pool_worker_start():
+      pass
+
     @staticmethod
     def record_process_exit(returncode):
       pass
@@ -11,7 +11,7 @@ sections from a wasm file.
 """
 
 import argparse
-from collections import OrderedDict
+from array import array
 import json
 import logging
 from math import floor, log
@@ -154,38 +154,109 @@ def get_code_section_offset(wasm):
     pos = pos + section_size
 
 
+class LineTable(object):
+  """The rows of the DWARF line tables, stored in parallel arrays rather than a
+  dict per row, as large programs have millions of rows. Rows refer to their
+  file by an index into file_names."""
+
+  def __init__(self):
+    self.addresses = array('L')
+    self.lines = array('I')
+    self.columns = array('I')
+    self.files = array('I')
+    self.eos = bytearray()
+    self.file_names = []
+    self.file_ids = {}
+
+  def __len__(self):
+    return len(self.addresses)
+
+  def get_file_id(self, name):
+    if name not in self.file_ids:
+      self.file_ids[name] = len(self.file_names)
+      self.file_names.append(name)
+    return self.file_ids[name]
+
+  def select(self, indices):
+    """Keeps only the rows with the given indices, in that order."""
+    for attr in ('addresses', 'lines', 'columns', 'files'):
+      old = getattr(self, attr)
+      setattr(self, attr, array(old.typecode, (old[i] for i in indices)))
+    self.eos = bytearray(self.eos[i] for i in indices)
+
+  def select_ranges(self, ranges):
+    """Keeps only the rows in the given [start, end) index ranges."""
+    for attr in ('addresses', 'lines', 'columns', 'files'):
+      old = getattr(self, attr)
+      new = array(old.typecode)
+      for start, end in ranges:
+        new.extend(old[start:end])
+      setattr(self, attr, new)
+    self.eos = bytearray().join(self.eos[start:end] for start, end in ranges)
+
+
 def remove_dead_entries(entries):
   # Remove entries for dead functions. It is a heuristics to ignore data if the
   # function starting address near to 0 (is equal to its size field length).
+  addresses = entries.addresses
+  live_ranges = []
   block_start = 0
-  cur_entry = 0
-  while cur_entry < len(entries):
-    if not entries[cur_entry]['eos']:
-      cur_entry += 1
-      continue
-    fn_start = entries[block_start]['address']
+  while block_start < len(entries):
+    cur_entry = entries.eos.find(b'\x01', block_start)
+    if cur_entry < 0:
+      # rows after the last end of sequence are kept
+      live_ranges.append((block_start, len(entries)))
+      break
+    fn_start = addresses[block_start]
     # Calculate the LEB encoded function size (including size field)
-    fn_size_length = floor(log(entries[cur_entry]['address'] - fn_start + 1, 128)) + 1
+    fn_size_length = floor(log(addresses[cur_entry] - fn_start + 1, 128)) + 1
     min_live_offset = 1 + fn_size_length # 1 byte is for code section entries
-    if fn_start < min_live_offset:
-      # Remove dead code debug info block.
-      del entries[block_start:cur_entry + 1]
-      cur_entry = block_start
-      continue
-    cur_entry += 1
-    block_start = cur_entry
+    if fn_start >= min_live_offset:
+      if live_ranges and live_ranges[-1][1] == block_start:
+        live_ranges[-1] = (live_ranges[-1][0], cur_entry + 1)
+      else:
+        live_ranges.append((block_start, cur_entry + 1))
+    block_start = cur_entry + 1
+  if live_ranges != [(0, len(entries))]:
+    entries.select_ranges(live_ranges)
+
+
+def sort_entries(entries):
+  # sort the rows by address, keeping the order of rows with the same address
+  addresses = entries.addresses
+  if all(addresses[i - 1] <= addresses[i] for i in range(1, len(addresses))):
+    return
+  # The rows of each sequence are in address order, so unless sequences
+  # overlap it is enough to sort the sequences.
+  sequences = []
+  start = 0
+  while start < len(entries):
+    end = entries.eos.find(b'\x01', start) + 1 or len(entries)
+    sequences.append((start, end))
+    start = end
+  sequences.sort(key=lambda seq: addresses[seq[0]])
+  if all(addresses[prev[1] - 1] < addresses[seq[0]] for prev, seq in zip(sequences, sequences[1:])) and \
+     all(addresses[i - 1] <= addresses[i] for start, end in sequences for i in range(start + 1, end)):
+    entries.select_ranges(sequences)
+  else:
+    entries.select(sorted(range(len(addresses)), key=addresses.__getitem__))
 
 
-def read_dwarf_entries(wasm, options):
+def read_dwarf_output(wasm, options):
+  """Yields the lines of the llvm-dwarfdump output as it is produced, so that
+  the whole output never needs to be in memory."""
   if options.dwarfdump_output:
-    output = open(options.dwarfdump_output, 'r').read()
+    with open(options.dwarfdump_output, 'rb') as f:
+      for line in f:
+        yield asstr(line)
   elif options.dwarfdump:
     logger.debug('Reading DWARF information from %s' % wasm)
     if not os.path.exists(options.dwarfdump):
       logger.error('llvm-dwarfdump not found: ' + options.dwarfdump)
       sys.exit(1)
     process = Popen([options.dwarfdump, '-debug-info', '-debug-line', '--recurse-depth=0', wasm], stdout=PIPE)
-    output, err = process.communicate()
+    for line in process.stdout:
+      yield asstr(line)
     exit_code = process.wait()
     if exit_code != 0:
       logger.error('Error during llvm-dwarfdump execution (%s)' % exit_code)
@@ -194,85 +265,145 @@ def read_dwarf_entries(wasm, options):
     logger.error('Please specify either --dwarfdump or --dwarfdump-output')
     sys.exit(1)
 
-  entries = []
-  debug_line_chunks = re.split(r"debug_line\[(0x[0-9a-f]*)\]", asstr(output))
-  maybe_debug_info_content = debug_line_chunks[0]
-  for i in range(1, len(debug_line_chunks), 2):
-    stmt_list = debug_line_chunks[i]
-    comp_dir_match = re.search(r"DW_AT_stmt_list\s+\(" + stmt_list + r"\)\s+" +
-                               r"DW_AT_comp_dir\s+\(\"([^\"]+)", maybe_debug_info_content)
-    comp_dir = comp_dir_match.group(1) if comp_dir_match is not None else ""
-
-    line_chunk = debug_line_chunks[i + 1]
-
-    # include_directories[  1] = "/Users/yury/Work/junk/sqlite-playground/src"
-    # file_names[  1]:
-    #            name: "playground.c"
-    #       dir_index: 1
-    #        mod_time: 0x00000000
-    #          length: 0x00000000
-    #
-    # Address            Line   Column File   ISA Discriminator Flags
-    # ------------------ ------ ------ ------ --- ------------- -------------
-    # 0x0000000000000006     22      0      1   0             0  is_stmt
-    # 0x0000000000000007     23     10      1   0             0  is_stmt prologue_end
-    # 0x000000000000000f     23      3      1   0             0
-    # 0x0000000000000010     23      3      1   0             0  end_sequence
-    # 0x0000000000000011     28      0      1   0             0  is_stmt
-
-    include_directories = {'0': comp_dir}
-    for dir in re.finditer(r"include_directories\[\s*(\d+)\] = \"([^\"]*)", line_chunk):
-      include_directories[dir.group(1)] = dir.group(2)
-
-    files = {}
-    for file in re.finditer(r"file_names\[\s*(\d+)\]:\s+name: \"([^\"]*)\"\s+dir_index: (\d+)", line_chunk):
-      dir = include_directories[file.group(3)]
-      file_path = (dir + '/' if file.group(2)[0] != '/' else '') + file.group(2)
-      files[file.group(1)] = file_path
-
-    for line in re.finditer(r"\n0x([0-9a-f]+)\s+(\d+)\s+(\d+)\s+(\d+)(.*?end_sequence)?", line_chunk):
-      entry = {'address': int(line.group(1), 16), 'line': int(line.group(2)), 'column': int(line.group(3)), 'file': files[line.group(4)], 'eos': line.group(5) is not None}
-      if not entry['eos']:
-        entries.append(entry)
-      else:
+
+def read_dwarf_entries(wasm, options):
+  entries = LineTable()
+  add_address = entries.addresses.append
+  add_line = entries.lines.append
+  add_column = entries.columns.append
+  add_file = entries.files.append
+  add_eos = entries.eos.append
+
+  # The .debug_info contents come first. The comp_dir of each compile unit is
+  # the directory 0 of its line table.
+  #
+  #   DW_AT_stmt_list	(0x00000000)
+  #   DW_AT_comp_dir	("/emscripten/tests/other/wasm_sourcemap")
+  comp_dirs = {}
+  stmt_list = None
+
+  # Then the line tables, each starting with debug_line[0x...].
+  #
+  # include_directories[  1] = "/Users/yury/Work/junk/sqlite-playground/src"
+  # file_names[  1]:
+  #            name: "playground.c"
+  #       dir_index: 1
+  #        mod_time: 0x00000000
+  #          length: 0x00000000
+  #
+  # Address            Line   Column File   ISA Discriminator Flags
+  # ------------------ ------ ------ ------ --- ------------- -------------
+  # 0x0000000000000006     22      0      1   0             0  is_stmt
+  # 0x0000000000000007     23     10      1   0             0  is_stmt prologue_end
+  # 0x000000000000000f     23      3      1   0             0
+  # 0x0000000000000010     23      3      1   0             0  end_sequence
+  # 0x0000000000000011     28      0      1   0             0  is_stmt
+  in_line_tables = False
+  include_directories = {}
+  files = {}
+  file_index = file_name = None
+
+  for line in read_dwarf_output(wasm, options):
+    if in_line_tables and line.startswith('0x'):
+      parts = line.split(None, 4)
+      if len(parts) < 4 or not (parts[1].isdigit() and parts[2].isdigit() and parts[3].isdigit()):
+        continue
+      address = int(parts[0], 16)
+      if 'end_sequence' in line:
         # move end of function to the last END operator
-        entry['address'] -= 1
-        if entries[-1]['address'] == entry['address']:
+        if address > 0:
+          address -= 1
+        if len(entries) and entries.addresses[-1] == address:
           # last entry has the same address, reusing
-          entries[-1]['eos'] = True
-        else:
-          entries.append(entry)
+          entries.eos[-1] = 1
+          continue
+        add_eos(1)
+      else:
+        add_eos(0)
+      add_address(address)
+      add_line(int(parts[1]))
+      add_column(int(parts[2]))
+      add_file(files[int(parts[3])])
+      continue
+
+    line = line.strip()
+    if not line:
+      continue
+
+    if 'debug_line[' in line:
+      m = re.search(r'debug_line\[(0x[0-9a-f]*)\]', line)
+      if m:
+        in_line_tables = True
+        include_directories = {0: comp_dirs.get(m.group(1), '')}
+        files = {}
+        file_index = file_name = None
+        continue
+
+    if not in_line_tables:
+      if line.startswith('DW_AT_stmt_list'):
+        m = re.match(r'DW_AT_stmt_list\s+\((0x[0-9a-f]*)\)', line)
+        stmt_list = m.group(1) if m else None
+        continue
+      if stmt_list is not None and line.startswith('DW_AT_comp_dir'):
+        m = re.match(r'DW_AT_comp_dir\s+\("([^"]+)', line)
+        if m and stmt_list not in comp_dirs:
+          comp_dirs[stmt_list] = m.group(1)
+      stmt_list = None
+      continue
+
+    # a file entry is a file_names line followed by its name and dir_index
+    if file_index is not None:
+      if file_name is None:
+        m = re.match(r'name: "([^"]*)"$', line)
+        if m:
+          file_name = m.group(1)
+          continue
+      else:
+        m = re.match(r'dir_index: (\d+)$', line)
+        if m:
+          dir = include_directories[int(m.group(1))]
+          file_path = (dir + '/' if not file_name.startswith('/') else '') + file_name
+          files[file_index] = entries.get_file_id(file_path)
+      file_index = file_name = None
+
+    if line.startswith('include_directories['):
+      m = re.match(r'include_directories\[\s*(\d+)\] = "([^"]*)', line)
+      if m:
+        include_directories[int(m.group(1))] = m.group(2)
+    elif line.startswith('file_names['):
+      m = re.match(r'file_names\[\s*(\d+)\]:$', line)
+      if m:
+        file_index = int(m.group(1))
 
   remove_dead_entries(entries)
 
   # return entries sorted by the address field
-  return sorted(entries, key=lambda entry: entry['address'])
+  sort_entries(entries)
+  return entries
 
 
 def normalize_path(path):
   return path.replace('\\', '/').replace('//', '/')
 
 
-def build_sourcemap(entries, code_section_offset, prefixes, collect_sources, base_path):
+def write_sourcemap(entries, code_section_offset, prefixes, collect_sources, base_path, outfile):
+  # The sources are listed in the order in which the rows first refer to them,
+  # and they must be known before the mappings are written, so map the files
+  # of the line tables to sources first.
   sources = []
   sources_content = [] if collect_sources else None
-  mappings = []
   sources_map = {}
-  last_address = 0
-  last_source_id = 0
-  last_line = 1
-  last_column = 1
-  for entry in entries:
-    line = entry['line']
-    column = entry['column']
+  file_sources = [None] * len(entries.file_names)
+  unmapped = len(file_sources)
+  lines = entries.lines
+  files = entries.files
+  for i in range(len(entries)):
+    if not unmapped:
+      break
     # ignore entries with line 0
-    if line == 0:
+    if lines[i] == 0 or file_sources[files[i]] is not None:
       continue
-    # start at least at column 1
-    if column == 0:
-      column = 1
-    address = entry['address'] + code_section_offset
-    file_name = entry['file']
+    file_name = entries.file_names[files[i]]
     file_name = normalize_path(file_name)
     # if prefixes were provided, we use that; otherwise, we emit a relative
     # path
@@ -295,23 +426,52 @@ def build_sourcemap(entries, code_section_offset, prefixes, collect_sources, bas
         except IOError:
           print('Failed to read source: %s' % load_name)
           sources_content.append(None)
-    else:
-      source_id = sources_map[source_name]
+    file_sources[files[i]] = sources_map[source_name]
+    unmapped -= 1
+
+  # Same output as json.dump() of the whole map with separators=(',', ':'),
+  # but the mappings are written as they are encoded
+  outfile.write('{"version":3,"names":[],"sources":%s,"sourcesContent":%s,"mappings":"' % (
+                json.dumps(sources, separators=(',', ':')),
+                json.dumps(sources_content, separators=(',', ':'))))
+
+  # Most deltas are small and repeat a lot
+  vlq_cache = {}
+
+  def vlq(n):
+    result = vlq_cache.get(n)
+    if result is None:
+      result = vlq_cache[n] = encode_vlq(n)
+    return result
 
-    address_delta = address - last_address
-    source_id_delta = source_id - last_source_id
-    line_delta = line - last_line
-    column_delta = column - last_column
-    mappings.append(encode_vlq(address_delta) + encode_vlq(source_id_delta) + encode_vlq(line_delta) + encode_vlq(column_delta))
+  addresses = entries.addresses
+  columns = entries.columns
+  mappings = []
+  separator = ''
+  last_address = 0
+  last_source_id = 0
+  last_line = 1
+  last_column = 1
+  for i in range(len(entries)):
+    line = lines[i]
+    if line == 0:
+      continue
+    # start at least at column 1
+    column = columns[i] or 1
+    address = addresses[i] + code_section_offset
+    source_id = file_sources[files[i]]
+    mappings.append(vlq(address - last_address) + vlq(source_id - last_source_id) + vlq(line - last_line) + vlq(column - last_column))
     last_address = address
     last_source_id = source_id
     last_line = line
     last_column = column
-  return OrderedDict([('version', 3),
-                      ('names', []),
-                      ('sources', sources),
-                      ('sourcesContent', sources_content),
-                      ('mappings', ','.join(mappings))])
+    if len(mappings) == 65536:
+      outfile.write(separator + ','.join(mappings))
+      separator = ','
+      mappings = []
+  if mappings:
+    outfile.write(separator + ','.join(mappings))
+  outfile.write('"}')
 
 
 def main():
@@ -328,9 +488,8 @@ def main():
   prefixes = SourceMapPrefixes(sources=Prefixes(options.prefix), load=Prefixes(options.load_prefix))
 
   logger.debug('Saving to %s' % options.output)
-  map = build_sourcemap(entries, code_section_offset, prefixes, options.sources, options.basepath)
   with open(options.output, 'w') as outfile:
-    json.dump(map, outfile, separators=(',', ':'))
+    write_sourcemap(entries, code_section_offset, prefixes, options.sources, options.basepath, outfile)
 
   if options.strip:
     wasm = strip_debug_sections(wasm)